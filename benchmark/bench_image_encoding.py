@@ -0,0 +1,95 @@
+# Stored bytes, base64 payload, encode time and vision tokens per encoding profile
+# Pages of a PDF are rendered once and encoded with every profile in
+# lib.extractpdf.ENCODING_PROFILES. With --caption, captions of each profile
+# are compared to the PNG baseline (calls Bedrock, needs .env)
+# Usage: python -m benchmark.bench_image_encoding --pdf ./pdf/bedrock.pdf [--pages 10]
+import argparse
+import base64
+import difflib
+import os
+import tempfile
+import time
+
+import fitz
+
+import lib.contextpack as contextpack
+import lib.extractpdf as extractpdf
+
+
+def encode_pages(doc, pages, profile_name, rendition_type, dpi, savedir):
+    profile = extractpdf.get_encoding_profile(profile_name, rendition_type)
+    results = []
+    for page_num in pages:
+        pix = doc[page_num].get_pixmap(dpi=profile["dpi"] or dpi)
+        start = time.perf_counter()
+        image_path, media_type = extractpdf.save_rendition(
+            pix, os.path.join(savedir, f"{profile_name}_{rendition_type}_{page_num}"), profile)
+        elapsed = time.perf_counter() - start
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+        width, height = contextpack.get_image_size(image_bytes)
+        results.append({
+            "page": page_num,
+            "file": image_path,
+            "media_type": media_type,
+            "bytes": len(image_bytes),
+            "base64_bytes": len(base64.b64encode(image_bytes)),
+            "encode_ms": elapsed * 1000,
+            "tokens": contextpack.estimate_image_tokens(width, height),
+        })
+    return results
+
+
+def caption_pages(results):
+    import lib.bedrock as bedrock
+    from dotenv import load_dotenv
+
+    load_dotenv(override=True)
+    session = bedrock.get_bedrock_session(
+        os.environ["AWS_ACCESS_KEY_ID"],
+        os.environ["AWS_SECRET_ACCESS_KEY"],
+        os.environ["AWS_REGION"]
+    )
+    return [bedrock.extract_text_from_image_using_bedrock(
+        session, os.environ["BEDROCK_MODEL_ID"], result["file"]) for result in results]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdf", default="./pdf/bedrock.pdf")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--dpi", type=int, default=150)
+    parser.add_argument("--rendition", choices=["main", "sub"], default="main")
+    parser.add_argument("--caption", action="store_true",
+                        help="compare captions to the PNG baseline (calls Bedrock)")
+    args = parser.parse_args()
+
+    doc = fitz.open(args.pdf)
+    pages = range(min(args.pages, doc.page_count))
+
+    with tempfile.TemporaryDirectory() as savedir:
+        baseline_captions = None
+        print(f"{len(pages)} pages, {args.rendition} renditions")
+        print(f"{'profile':10s} {'bytes/page':>12s} {'base64/page':>12s} "
+              f"{'encode ms':>10s} {'tokens':>8s}" + ("  caption similarity" if args.caption else ""))
+        for profile_name in extractpdf.ENCODING_PROFILES:
+            results = encode_pages(doc, pages, profile_name, args.rendition, args.dpi, savedir)
+            count = len(results)
+            line = (f"{profile_name:10s} {sum(r['bytes'] for r in results) // count:12d} "
+                    f"{sum(r['base64_bytes'] for r in results) // count:12d} "
+                    f"{sum(r['encode_ms'] for r in results) / count:10.1f} "
+                    f"{sum(r['tokens'] for r in results) // count:8d}")
+            if args.caption:
+                captions = caption_pages(results)
+                if baseline_captions is None:
+                    baseline_captions = captions
+                similarity = sum(difflib.SequenceMatcher(None, a, b).ratio()
+                                 for a, b in zip(baseline_captions, captions)) / count
+                line += f"  {similarity:.3f}"
+            print(line)
+
+    doc.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Import-time regression check for the query/serving path
+# Runs `python -X importtime` on the serving modules, fails (exit 1) if a heavy
+# ingestion dependency is imported or the cumulative import time exceeds the limit
+# Usage: python -m benchmark.bench_import_time [--max-ms 100] [--runs 5]
+import argparse
+import subprocess
+import sys
+
+SERVING_MODULES = [
+    "lib.bedrock",
+    "lib.opensearch",
+    "lib.streaming",
+    "lib.conversation",
+    "lib.contextpack",
+    "lib.quota",
+    "lib.answercache",
+]
+
+# Must never be imported by the serving path at import time
+FORBIDDEN_MODULES = ["fitz", "pymupdf", "PIL", "boto3", "botocore", "numpy"]
+
+
+# Returns {module: cumulative_us} for top-level imports of one run
+def measure(modules):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+        capture_output=True, text=True, check=True)
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # one leading space plus two per nesting level
+        indent = len(name) - len(name.lstrip())
+        timings[name.strip()] = (int(cumulative_us), indent)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-ms", type=float, default=100.0)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    best = None
+    for _ in range(args.runs):
+        timings = measure(SERVING_MODULES)
+        total_us = sum(cumulative for name, (cumulative, indent) in timings.items()
+                       if indent == 1 and name.split(".")[0] == "lib")
+        if best is None or total_us < best[0]:
+            best = (total_us, timings)
+    total_us, timings = best
+
+    print(f"serving path import time: {total_us / 1000:.1f} ms (best of {args.runs})")
+    top = sorted(((cumulative, name) for name, (cumulative, indent) in timings.items()
+                  if indent <= 3 and name.split(".")[0] != "encodings"), reverse=True)[:10]
+    for cumulative, name in top:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    imported = [name for name in timings
+                if name.split(".")[0] in FORBIDDEN_MODULES]
+    if imported:
+        print(f"FAIL: heavy modules imported: {sorted(imported)}")
+        failed = True
+    if total_us / 1000 > args.max_ms:
+        print(f"FAIL: import time above {args.max_ms:.0f} ms")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
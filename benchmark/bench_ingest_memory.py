@@ -0,0 +1,64 @@
+# Memory use of PDF extraction per stage and per page
+# Extraction runs in batch mode, so no Bedrock calls are made. Exits 1 when
+# peak RSS or the traced Python peak exceeds the given limits.
+# Usage: python -m benchmark.bench_ingest_memory --pdf ./pdf/bedrock.pdf
+#        [--max-rss-mb 1024] [--max-traced-mb 256] [--report memory.json]
+import argparse
+import os
+import tempfile
+
+import lib.batchcaption as batchcaption
+import lib.extractpdf as extractpdf
+from lib.profiling import MB, IngestionProfiler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdf", default="./pdf/bedrock.pdf")
+    parser.add_argument("--encoding-profile", default="png",
+                        choices=list(extractpdf.ENCODING_PROFILES))
+    parser.add_argument("--max-rss-mb", type=float, default=1024)
+    parser.add_argument("--max-traced-mb", type=float, default=256)
+    parser.add_argument("--report", help="also write the full JSON report here")
+    parser.add_argument("--no-page-snapshots", action="store_true",
+                        help="skip per-page tracemalloc snapshots (faster)")
+    args = parser.parse_args()
+
+    profiler = IngestionProfiler(page_snapshots=not args.no_page_snapshots)
+    with tempfile.TemporaryDirectory() as workdir:
+        savedir = os.path.join(workdir, "images")
+        with profiler.stage("extract"), \
+                batchcaption.BatchJobWriter(os.path.join(workdir, "job.jsonl")) as batch_job:
+            extractpdf.extract_images_caption_and_metadata(
+                args.pdf, savedir, batch_job=batch_job,
+                encoding_profile=args.encoding_profile, profiler=profiler)
+
+    report = profiler.write_report(args.report) if args.report else profiler.report()
+    profiler.stop()
+
+    for stage in report["stages"]:
+        print(f"stage {stage['stage']}: {stage['seconds']:.1f}s, "
+              f"peak rss {stage['peak_rss'] / MB:.1f} MB, "
+              f"traced peak {stage['traced_peak'] / MB:.1f} MB")
+        for allocator in stage.get("top_allocators", [])[:5]:
+            print(f"  {allocator['size_diff'] / 1024:10.1f} KiB  {allocator['location']}")
+
+    print(f"{len(report['pages'])} pages, largest traced peaks:")
+    for page in report["largest_pages"][:5]:
+        print(f"  page {page['page']}: traced peak +{page['traced_peak_diff'] / MB:.1f} MB, "
+              f"rss diff {(page['rss_diff'] or 0) / MB:+.1f} MB")
+
+    peak_rss_mb = report["peak_rss"] / MB
+    traced_peak_mb = max(stage["traced_peak"] for stage in report["stages"]) / MB
+    failed = False
+    if peak_rss_mb > args.max_rss_mb:
+        print(f"FAIL: peak rss {peak_rss_mb:.1f} MB > {args.max_rss_mb} MB")
+        failed = True
+    if traced_peak_mb > args.max_traced_mb:
+        print(f"FAIL: traced peak {traced_peak_mb:.1f} MB > {args.max_traced_mb} MB")
+        failed = True
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
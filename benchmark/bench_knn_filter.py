@@ -0,0 +1,91 @@
+# Recall vs latency of filtered kNN queries against the local fake index
+# Usage: python -m benchmark.bench_knn_filter [--docs 5000] [--queries 200]
+import argparse
+import time
+
+import numpy as np
+
+import lib.opensearch as opensearch
+from lib.localindex import LocalIndex
+
+
+# Legacy query body: term + knn inside bool.must (post-filter, fixed k=5)
+def build_legacy_query(vector_query, image_type, size):
+    return {
+        "size": size,
+        "_source": {"excludes": ["content_vector"]},
+        "query": {
+            "bool": {
+                "must": [
+                    {"term": {"image_type": image_type}},
+                    {"knn": {"content_vector": {"vector": vector_query, "k": 5}}}
+                ]
+            }
+        }
+    }
+
+
+def build_corpus(index, doc_count, dimensions, sub_ratio, rng):
+    centers = rng.standard_normal((32, dimensions)).astype(np.float32)
+    for i in range(doc_count):
+        vector = centers[rng.integers(len(centers))] + \
+            0.5 * rng.standard_normal(dimensions).astype(np.float32)
+        image_type = "sub" if rng.random() < sub_ratio else "main"
+        index.index({"page_number": i, "text": f"page {i}", "image_type": image_type,
+                     "content_vector": vector.tolist()}, doc_id=str(i))
+    return centers
+
+
+def exact_top(index, vector, image_type, size):
+    body = opensearch.build_knn_query(
+        vector, image_type, size=size, k=size, ef_search=len(index))
+    return {hit["_id"] for hit in index.search(body)["hits"]["hits"]}
+
+
+def run(index, name, queries, build_body, image_type, size):
+    recalls = []
+    returned = []
+    started = time.perf_counter()
+    for vector, truth in queries:
+        hits = index.search(build_body(vector))["hits"]["hits"]
+        ids = {hit["_id"] for hit in hits}
+        returned.append(len(hits))
+        recalls.append(len(ids & truth) / size)
+    elapsed_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    print(f"{name:<28} recall@{size}: {np.mean(recalls):.3f}  "
+          f"hits/query: {np.mean(returned):.2f}  latency: {elapsed_ms:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dimensions", type=int, default=1024)
+    parser.add_argument("--size", type=int, default=5)
+    parser.add_argument("--sub-ratio", type=float, default=0.2)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    index = LocalIndex(dimensions=args.dimensions)
+    centers = build_corpus(index, args.docs, args.dimensions, args.sub_ratio, rng)
+
+    for image_type in ["sub", "main"]:
+        queries = []
+        for _ in range(args.queries):
+            vector = (centers[rng.integers(len(centers))] +
+                      0.5 * rng.standard_normal(args.dimensions)).tolist()
+            queries.append((vector, exact_top(index, vector, image_type, args.size)))
+
+        print(f"\nimage_type={image_type} docs={args.docs} size={args.size}")
+        run(index, "legacy bool.must (k=5)", queries,
+            lambda v: build_legacy_query(v, image_type, args.size),
+            image_type, args.size)
+        for ef_search in [10, 25, 50, 100, 200, 400]:
+            run(index, f"efficient filter ef={ef_search}", queries,
+                lambda v: opensearch.build_knn_query(
+                    v, image_type, size=args.size, ef_search=ef_search),
+                image_type, args.size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Interactive wait times under a saturating batch backfill, with and without
+# priority classes. Batch workers and one interactive client run as separate
+# processes sharing one QuotaScheduler state file; model calls are simulated.
+# Usage: python -m benchmark.bench_quota_scheduler [--seconds 10] [--batch-workers 4]
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from lib.quota import QuotaScheduler
+
+
+def batch_worker(state_file, args, priority, deadline, results):
+    scheduler = QuotaScheduler(args.requests_per_minute, args.tokens_per_minute,
+                               state_file=state_file)
+    calls = 0
+    while time.time() < deadline:
+        scheduler.acquire(args.batch_tokens, priority)
+        time.sleep(args.call_seconds)
+        calls += 1
+    results.put(("batch", calls, []))
+
+
+def interactive_client(state_file, args, deadline, results):
+    scheduler = QuotaScheduler(args.requests_per_minute, args.tokens_per_minute,
+                               state_file=state_file)
+    waits = []
+    while time.time() < deadline:
+        waits.append(scheduler.acquire(args.interactive_tokens, "interactive"))
+        time.sleep(args.call_seconds)
+        time.sleep(args.think_seconds)
+    results.put(("interactive", len(waits), waits))
+
+
+def run(args, batch_priority):
+    with tempfile.TemporaryDirectory() as workdir:
+        state_file = os.path.join(workdir, "quota.json")
+        deadline = time.time() + args.seconds
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=batch_worker, args=(state_file, args, batch_priority, deadline, results))
+            for _ in range(args.batch_workers)]
+        processes.append(multiprocessing.Process(
+            target=interactive_client, args=(state_file, args, deadline, results)))
+        for process in processes:
+            process.start()
+        collected = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    batch_calls = sum(calls for kind, calls, _ in collected if kind == "batch")
+    waits = next(waits for kind, _, waits in collected if kind == "interactive")
+    return batch_calls, waits
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--batch-workers", type=int, default=4)
+    parser.add_argument("--requests-per-minute", type=int, default=120)
+    parser.add_argument("--tokens-per-minute", type=int, default=200000)
+    parser.add_argument("--batch-tokens", type=int, default=4000)
+    parser.add_argument("--interactive-tokens", type=int, default=6000)
+    parser.add_argument("--call-seconds", type=float, default=0.2)
+    parser.add_argument("--think-seconds", type=float, default=0.5)
+    args = parser.parse_args()
+
+    for label, batch_priority in (("no priority", "interactive"), ("priority", "batch")):
+        batch_calls, waits = run(args, batch_priority)
+        print(f"{label:12s}: batch calls {batch_calls:4d}, interactive calls {len(waits):3d}, "
+              f"interactive wait p50 {statistics.median(waits) if waits else 0:.2f}s "
+              f"p95 {percentile(waits, 0.95):.2f}s max {max(waits, default=0):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
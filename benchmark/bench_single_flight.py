@@ -0,0 +1,81 @@
+# Upstream embedding calls with and without single-flight coalescing when
+# concurrent callers request a few repeated texts, from a thread pool and
+# from asyncio. The Bedrock client is a stand-in with fixed latency.
+# Usage: python -m benchmark.bench_single_flight [--callers 64] [--distinct 8]
+import argparse
+import asyncio
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lib.bedrock as bedrock
+
+
+class FakeClient:
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def invoke_model(self, body, **kwargs):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        text = json.loads(body)["inputText"]
+        return {"body": io.BytesIO(json.dumps({"embedding": [float(len(text))]}).encode())}
+
+
+def texts_for(args):
+    return [f"반복되는 질문 {i % args.distinct}" for i in range(args.callers)]
+
+
+def run_threads(args, call):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.callers) as executor:
+        vectors = list(executor.map(lambda text: call(None, text), texts_for(args)))
+    return vectors, time.perf_counter() - start
+
+
+async def run_async(args):
+    start = time.perf_counter()
+    vectors = await asyncio.gather(
+        *(bedrock.get_text_vector_async(None, text) for text in texts_for(args)))
+    return vectors, time.perf_counter() - start
+
+
+def uncoalesced(session, text):
+    return bedrock._invoke_embedding(session, bedrock._embedding_body(text, 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--callers", type=int, default=64)
+    parser.add_argument("--distinct", type=int, default=8, help="distinct texts")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per upstream call")
+    args = parser.parse_args()
+
+    client = FakeClient(args.latency)
+    bedrock.get_bedrock_client = lambda session, max_pool_connections=None: client
+
+    results = {}
+    for label, run in (("threads, no coalescing", lambda: run_threads(args, uncoalesced)),
+                       ("threads, single-flight", lambda: run_threads(args, bedrock.get_text_vector)),
+                       ("asyncio, single-flight", lambda: asyncio.run(run_async(args)))):
+        client.calls = 0
+        vectors, seconds = run()
+        results[label] = vectors
+        print(f"{label:24s}: {client.calls:4d} upstream calls for {args.callers} callers, "
+              f"{seconds:.2f}s")
+
+    stats = bedrock.single_flight_stats()
+    print(f"single-flight stats     : {stats}")
+    baseline = results["threads, no coalescing"]
+    mismatched = sum(1 for vectors in results.values() if vectors != baseline)
+    raise SystemExit(1 if mismatched or stats["in_flight"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Snapshot export / verify / load throughput against the local index
+# Usage: python -m benchmark.bench_snapshot [--docs 2000] [--image-kb 60]
+import argparse
+import base64
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import lib.snapshot as snapshot
+from lib.localindex import LocalIndex
+
+
+def build_index(doc_count, dimensions, image_kb, rng):
+    index = LocalIndex(dimensions=dimensions)
+    index.index_many(
+        (f"doc-p{i:05d}-main", {
+            "page_number": i,
+            "image_file_name": f"./images_mu/page_{i}_main.png",
+            "text": f"page {i} text " * 20,
+            "image_type": "main",
+            "doc_id": "doc",
+            "fingerprint": f"{i:016x}",
+            "media_type": "image/png",
+            "image": base64.b64encode(rng.bytes(image_kb * 1024)).decode("utf-8"),
+            "content_vector": rng.standard_normal(dimensions).astype(np.float32).tolist(),
+        }) for i in range(doc_count))
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--dimensions", type=int, default=1024)
+    parser.add_argument("--image-kb", type=int, default=60)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    source = build_index(args.docs, args.dimensions, args.image_kb, rng)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        snapshot_file = os.path.join(workdir, "index.parquet")
+
+        start = time.perf_counter()
+        snapshot.export_snapshot(source.documents.items(), snapshot_file,
+                                 dimensions=args.dimensions)
+        export_seconds = time.perf_counter() - start
+        size_mb = os.path.getsize(snapshot_file) / 1024 / 1024
+
+        start = time.perf_counter()
+        snapshot.verify_snapshot(snapshot_file)
+        verify_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        restored = snapshot.load_snapshot_to_local(snapshot_file)
+        load_seconds = time.perf_counter() - start
+
+    mismatched = sum(
+        1 for doc_id, document in source.documents.items()
+        if restored.get(doc_id)["text"] != document["text"] or
+        restored.get(doc_id)["image"] != document["image"] or
+        not np.allclose(restored.get(doc_id)["content_vector"], document["content_vector"]))
+
+    print(f"{args.docs} documents, {args.dimensions} dimensions, {args.image_kb} KiB images")
+    print(f"snapshot size : {size_mb:.1f} MB")
+    print(f"export        : {export_seconds:.2f}s ({args.docs / export_seconds:.0f} docs/s)")
+    print(f"verify        : {verify_seconds:.2f}s")
+    print(f"load (local)  : {load_seconds:.2f}s ({args.docs / load_seconds:.0f} docs/s)")
+    print(f"mismatched    : {mismatched}")
+    raise SystemExit(1 if mismatched else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Repaint counts for per-token vs buffered streaming rendering, and when
+# related images can be shown with incremental <refpage> parsing vs after the
+# whole answer
+# Usage: python -m benchmark.bench_streaming_render [--tokens 1500] [--token-interval 0.01]
+#        [--refpage-at 0.3]
+import argparse
+
+from lib.streaming import BufferedRenderer, TagStreamParser
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# Stand-in for st.markdown: cost grows with the size of the repainted text
+class FakePlaceholder:
+
+    def __init__(self):
+        self.repaints = 0
+        self.bytes_sent = 0
+
+    def markdown(self, text):
+        self.repaints += 1
+        self.bytes_sent += len(text.encode("utf-8"))
+
+
+def generate_tokens(count):
+    sentence = "Amazon Bedrock 은 다양한 파운데이션 모델을 제공합니다. "
+    words = sentence.split(" ")
+    for i in range(count):
+        yield words[i % len(words)] + " "
+
+
+def run_naive(tokens):
+    placeholder = FakePlaceholder()
+    full_response = ""
+    for token in tokens:
+        full_response += token
+        placeholder.markdown(full_response + " ")
+    placeholder.markdown(full_response)
+    return placeholder
+
+
+def run_buffered(tokens, token_interval, frame_interval):
+    placeholder = FakePlaceholder()
+    clock = FakeClock()
+    renderer = BufferedRenderer(
+        lambda text: placeholder.markdown(text + " "),
+        frame_interval=frame_interval, clock=clock)
+    for token in tokens:
+        clock.now += token_interval
+        renderer(token)
+    renderer.flush()
+    placeholder.markdown(renderer.text)
+    return placeholder
+
+
+# Seconds into the stream at which the refpage list is known, with the tag
+# split across deltas; also checks that no raw tag reaches the rendered text
+def run_tagged(tokens, token_interval, refpage_at):
+    position = int(len(tokens) * refpage_at)
+    tokens = tokens[:position] + ["<ref", "page>1,", "2</ref", "page>"] + tokens[position:]
+    clock = FakeClock()
+    shown_at = []
+    parser = TagStreamParser(
+        lambda event: shown_at.append(clock.now) if event[0] == "refpage" else None)
+    for token in tokens:
+        clock.now += token_interval
+        parser(token)
+    parser.close()
+    if "<" in parser.text or parser.refpages != [1, 2]:
+        raise SystemExit("tag parsing failed")
+    return shown_at[0], clock.now
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=1500)
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--frame-interval", type=float, default=0.1)
+    parser.add_argument("--refpage-at", type=float, default=0.3,
+                        help="position of the <refpage> tag in the answer (0-1)")
+    args = parser.parse_args()
+
+    tokens = list(generate_tokens(args.tokens))
+    naive = run_naive(tokens)
+    buffered = run_buffered(tokens, args.token_interval, args.frame_interval)
+
+    print(f"tokens: {len(tokens)}, stream duration: {
+          len(tokens) * args.token_interval:.1f}s (simulated)")
+    print(f"per-token : {naive.repaints:6d} repaints, {naive.bytes_sent:12d} bytes sent")
+    print(f"buffered  : {buffered.repaints:6d} repaints, {buffered.bytes_sent:12d} bytes sent")
+
+    shown_at, stream_end = run_tagged(tokens, args.token_interval, args.refpage_at)
+    print(f"related images shown at {shown_at:.2f}s (incremental) vs {stream_end:.2f}s "
+          f"(after the answer)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Figure detection on an image-heavy PDF: per-image decoding (extract_image +
+# get_image_rects for every image on every page) against one build_xref_index
+# pass. The generated PDF repeats a large logo on every page and places
+# several photos per page, some of identical pixel size.
+# Usage: python -m benchmark.bench_xref_index [--pages 40] [--images 6] [--pdf FILE]
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import lib.extractpdf as extractpdf
+
+
+def image_bytes(rng, width, height, quality=85):
+    # Smooth gradient plus noise, so JPEG sizes resemble photos
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([(x * 255 // width), (y * 255 // height),
+                     ((x + y) * 255 // (width + height))], axis=-1)
+    noise = rng.integers(0, 40, size=(height, width, 3))
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def generate_pdf(file, pages, images_per_page, rng):
+    import fitz
+
+    doc = fitz.open()
+    logo = image_bytes(rng, 1600, 1200)
+    logo_xref = 0
+    sizes = [(1200, 900), (1200, 900), (800, 600), (1024, 768)]
+    for page_num in range(pages):
+        page = doc.new_page()
+        logo_xref = page.insert_image(fitz.Rect(20, 20, 100, 80), stream=logo, xref=logo_xref)
+        page.insert_text((120, 50), f"Page {page_num}")
+        for index in range(images_per_page):
+            width, height = sizes[index % len(sizes)]
+            column, row = index % 2, index // 2
+            box = fitz.Rect(40 + column * 270, 100 + row * 220,
+                            290 + column * 270, 290 + row * 220)
+            page.insert_image(box, stream=image_bytes(rng, width, height))
+    doc.save(file)
+    doc.close()
+
+
+# Figure boxes as found before the index: every image decoded for its size
+# and again, with the whole page, for its placement
+def figures_by_decoding(doc, page, min_width, min_height):
+    image_boxes = []
+    for img in page.get_images(full=True):
+        base_image = doc.extract_image(img[0])
+        if not base_image:
+            continue
+        img_rects = page.get_image_rects(img[0])
+        img_rect = img_rects[0] if img_rects else page.rect
+        if base_image["width"] < min_width or base_image["height"] < min_height:
+            continue
+        image_boxes.append(tuple(img_rect))
+    return extractpdf.cluster_figure_regions(
+        image_boxes, [tuple(drawing["rect"]) for drawing in page.get_drawings()]
+        if image_boxes else [], page_box=tuple(page.rect))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdf", help="existing PDF instead of a generated one")
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--images", type=int, default=6, help="photos per generated page")
+    parser.add_argument("--min-width", type=int, default=20)
+    parser.add_argument("--min-height", type=int, default=20)
+    parser.add_argument("--max-xref-pages", type=int, default=5)
+    args = parser.parse_args()
+
+    import fitz
+
+    with tempfile.TemporaryDirectory() as workdir:
+        pdffile = args.pdf
+        if pdffile is None:
+            pdffile = os.path.join(workdir, "images.pdf")
+            generate_pdf(pdffile, args.pages, args.images, np.random.default_rng(0))
+
+        # Fresh documents, so neither path benefits from PyMuPDF caches
+        doc = fitz.open(pdffile)
+        start = time.perf_counter()
+        decoded = [figures_by_decoding(doc, page, args.min_width, args.min_height)
+                   for page in doc]
+        decode_seconds = time.perf_counter() - start
+        doc.close()
+
+        doc = fitz.open(pdffile)
+        start = time.perf_counter()
+        xref_index = extractpdf.build_xref_index(doc)
+        index_seconds = time.perf_counter() - start
+        indexed = [extractpdf.find_figure_regions(
+            doc, page, args.min_width, args.min_height, xref_index=xref_index)
+            for page in doc]
+        indexed_seconds = time.perf_counter() - start
+        deduped = [extractpdf.find_figure_regions(
+            doc, page, args.min_width, args.min_height, xref_index=xref_index,
+            max_xref_pages=args.max_xref_pages) for page in doc]
+        page_count = doc.page_count
+        doc.close()
+
+    repeated = sum(1 for entry in xref_index.values()
+                   if len(entry["pages"]) > args.max_xref_pages)
+    mismatched = sum(1 for a, b in zip(decoded, indexed) if a != b)
+    print(f"{page_count} pages, {len(xref_index)} image xrefs")
+    print(f"decode per image : {decode_seconds:.2f}s")
+    print(f"xref index       : {indexed_seconds:.2f}s (index pass {index_seconds:.2f}s), "
+          f"{decode_seconds / indexed_seconds:.1f}x faster")
+    print(f"figures          : {sum(map(len, indexed))}, "
+          f"{sum(map(len, deduped))} without {repeated} xrefs shown on "
+          f"more than {args.max_xref_pages} pages")
+    print(f"mismatched pages : {mismatched}")
+    raise SystemExit(1 if mismatched else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# Load test for query_service against local stubs (no AWS or OpenSearch calls)
+# The stub backend sleeps like the real pipeline: classify, retrieve, then
+# streams answer tokens from a blocking call, exercising the thread-pool bridge
+# Usage: python -m benchmark.load_test_query_service [--requests 200] [--clients 32]
+#        python -m benchmark.load_test_query_service --url http://host:8000  (running service)
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+from aiohttp import web
+
+import query_service
+
+
+class StubBackend:
+
+    def __init__(self, classify_latency=0.3, retrieve_latency=0.1,
+                 first_token_latency=0.8, tokens=200, token_interval=0.01):
+        self.classify_latency = classify_latency
+        self.retrieve_latency = retrieve_latency
+        self.first_token_latency = first_token_latency
+        self.tokens = tokens
+        self.token_interval = token_interval
+
+    def classify(self, query):
+        time.sleep(self.classify_latency)
+        return "general"
+
+    def retrieve(self, query, querytype):
+        time.sleep(self.retrieve_latency)
+        return [b"", b"", b""], ["page 1", "page 2", "page 3"], None
+
+    def answer(self, querytype, query, images, contents, streaming_callback, retrieval=None):
+        time.sleep(self.first_token_latency)
+        text = ""
+        for i in range(self.tokens):
+            time.sleep(self.token_interval)
+            chunk = f"token{i} "
+            streaming_callback(chunk)
+            text += chunk
+        text += "<refpage>1,2</refpage>"
+        streaming_callback("<refpage>1,2</refpage>")
+        return text
+
+
+async def one_request(session, url, results):
+    started = time.perf_counter()
+    first_delta = None
+    async with session.post(url + "/query", json={"query": "Bedrock 요금은?"}) as response:
+        if response.status != 200:
+            results.append((response.status, None, time.perf_counter() - started))
+            return
+        async for line in response.content:
+            if first_delta is None and line.startswith(b"event: delta"):
+                first_delta = time.perf_counter() - started
+    results.append((200, first_delta, time.perf_counter() - started))
+
+
+async def run_load(url, total_requests, clients):
+    results = []
+    queue = asyncio.Queue()
+    for _ in range(total_requests):
+        queue.put_nowait(None)
+
+    async def client(session):
+        while not queue.empty():
+            queue.get_nowait()
+            await one_request(session, url, results)
+
+    started = time.perf_counter()
+    timeout = aiohttp.ClientTimeout(total=600)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        await asyncio.gather(*(client(session) for _ in range(clients)))
+    return results, time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(results, elapsed):
+    ok = [result for result in results if result[0] == 200]
+    rejected = len(results) - len(ok)
+    print(f"requests: {len(results)}, ok: {len(ok)}, rejected/failed: {rejected}, "
+          f"elapsed: {elapsed:.1f}s, throughput: {len(ok) / elapsed:.2f} req/s")
+    if ok:
+        ttfb = [result[1] for result in ok if result[1] is not None]
+        total = [result[2] for result in ok]
+        print(f"time to first delta  p50: {statistics.median(ttfb):.2f}s  "
+              f"p95: {percentile(ttfb, 0.95):.2f}s")
+        print(f"total latency        p50: {statistics.median(total):.2f}s  "
+              f"p95: {percentile(total, 0.95):.2f}s")
+
+
+async def main_async(args):
+    if args.url:
+        results, elapsed = await run_load(args.url, args.requests, args.clients)
+        report(results, elapsed)
+        return
+
+    app = query_service.create_app(StubBackend(), args.max_concurrency, args.max_waiting)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    try:
+        results, elapsed = await run_load(
+            f"http://127.0.0.1:{args.port}", args.requests, args.clients)
+        print(f"stub service: max_concurrency={args.max_concurrency}, "
+              f"max_waiting={args.max_waiting}, clients={args.clients}")
+        report(results, elapsed)
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="load-test a running service instead of the stub")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--max-waiting", type=int, default=64)
+    parser.add_argument("--port", type=int, default=8765)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 import os
+import argparse
 import logging
 from dotenv import load_dotenv
 
 import lib.bedrock as bedrock
 import lib.extractpdf as extractpdf
 import lib.opensearch as opensearch
+import lib.batchcaption as batchcaption
+import lib.planner as planner
+import lib.profiling as profiling
+import lib.quota as quota
 from lib.logging_config import setup_logging
 
 # load .env
@@ -15,11 +20,19 @@ setup_logging()
 logger = logging.getLogger(__name__)
 
 
-def preprocessing():
+PDFFILE = "./pdf/bedrock.pdf"
+SAVEDIR = "./images_mu"
+# Stored image format profile, see extractpdf.ENCODING_PROFILES
+ENCODING_PROFILE = os.getenv("IMAGE_ENCODING_PROFILE", "png")
+
+
+def preprocessing(batch_job_file=None, page_range=None, shard=None, profiler=None):
     # Extract images and metadata
-    pdffile = "./pdf/bedrock.pdf"
-    savedir = "./images_mu"
-    extractpdf.extract_images_and_metadata(pdffile, savedir)
+    pdffile = PDFFILE
+    savedir = SAVEDIR
+    if page_range is None and shard is None:
+        with profiling.profile_stage(profiler, "extract_experimental"):
+            extractpdf.extract_images_and_metadata(pdffile, savedir, profiler=profiler)
 
     # Create a Bedrock session for Claude 3.5 Sonnet model
     bedrock_session = bedrock.get_bedrock_session(
@@ -32,12 +45,31 @@ def preprocessing():
     bedrock_modelid = os.getenv("BEDROCK_MODEL_ID")
 
     # Extract images, captions, and metadata from the PDF using Claude 3.5 Sonnet
-    metadata_file = extractpdf.extract_images_caption_and_metadata(
-        pdffile, savedir, bedrock_session=bedrock_session, bedrock_modelid=bedrock_modelid)
+    if batch_job_file is None:
+        with profiling.profile_stage(profiler, "extract"):
+            metadata_file = extractpdf.extract_images_caption_and_metadata(
+                pdffile, savedir, bedrock_session=bedrock_session, bedrock_modelid=bedrock_modelid,
+                page_range=page_range, shard=shard, encoding_profile=ENCODING_PROFILE,
+                profiler=profiler)
+        return metadata_file
+
+    # Batch mode: write caption requests to a batch-inference job file
+    with profiling.profile_stage(profiler, "extract"), \
+            batchcaption.BatchJobWriter(batch_job_file) as batch_job:
+        metadata_file = extractpdf.extract_images_caption_and_metadata(
+            pdffile, savedir, bedrock_session=bedrock_session, bedrock_modelid=bedrock_modelid,
+            batch_job=batch_job, page_range=page_range, shard=shard,
+            encoding_profile=ENCODING_PROFILE, profiler=profiler)
+    return metadata_file
+
+
+def import_batch_results(batch_results_file):
+    metadata_file = SAVEDIR + "/metadata.json"
+    batchcaption.import_batch_results(metadata_file, batch_results_file)
 
 
-def insert_to_opensearch():
-    savedir = "./images_mu"
+def insert_to_opensearch(profiler=None):
+    savedir = SAVEDIR
 
     # Create a Bedrock session for the default AWS credentials
     bedrock_session = bedrock.get_bedrock_session(
@@ -48,8 +80,222 @@ def insert_to_opensearch():
 
     # Insert the extracted metadata into OpenSearch
     metadata_file = savedir + "/metadata.json"
-    opensearch.insert_metadata_to_opensearch(
-        metadata_file, bedrock_session, os.getenv("OPENSEARCH_ENDPOINT"), os.getenv("OPENSEARCH_INDEX_NAME"), os.getenv("OPENSEARCH_USERNAME"), os.getenv("OPENSEARCH_PASSWORD"))
+    with profiling.profile_stage(profiler, "insert"):
+        indexed_ids = opensearch.insert_metadata_to_opensearch(
+            metadata_file, bedrock_session, os.getenv("OPENSEARCH_ENDPOINT"), os.getenv("OPENSEARCH_INDEX_NAME"), os.getenv("OPENSEARCH_USERNAME"), os.getenv("OPENSEARCH_PASSWORD"),
+            profiler=profiler)
+
+    # Entries indexed before deterministic ids would otherwise stay as
+    # duplicates; only pages re-inserted just now (metadata.json may cover a
+    # --page-range run only)
+    opensearch.delete_legacy_entries(
+        extractpdf.document_id(PDFFILE), savedir + "/", opensearch.main_entry_pages(indexed_ids), os.getenv("OPENSEARCH_ENDPOINT"), os.getenv("OPENSEARCH_INDEX_NAME"), os.getenv("OPENSEARCH_USERNAME"), os.getenv("OPENSEARCH_PASSWORD"))
+
+
+# Re-caption, re-embed and upsert only pages whose fingerprint changed,
+# and delete entries of vanished pages and stale sub-images
+# The changed pages are extracted into metadata.incremental.json (with their
+# own part file) and then replace their entries in metadata.json, so
+# metadata.json keeps describing the whole document as it is on disk
+def incremental_sync(profiler=None):
+    pdffile = PDFFILE
+    savedir = SAVEDIR
+    opensearch_args = (os.getenv("OPENSEARCH_ENDPOINT"), os.getenv("OPENSEARCH_INDEX_NAME"),
+                       os.getenv("OPENSEARCH_USERNAME"), os.getenv("OPENSEARCH_PASSWORD"))
+
+    doc_id = extractpdf.document_id(pdffile)
+    fingerprints = extractpdf.compute_page_fingerprints(pdffile)
+    indexed = opensearch.get_indexed_fingerprints(doc_id, *opensearch_args)
+    if indexed is None:
+        logger.error("Could not read indexed fingerprints, aborting incremental sync")
+        return
+
+    changed = [page for page, fingerprint in fingerprints.items()
+               if indexed.get(page) != fingerprint]
+    vanished = [page for page in indexed if page not in fingerprints]
+    logger.info(f"Incremental sync of {pdffile} ({doc_id}): {len(changed)} changed, "
+                f"{len(vanished)} vanished, {len(fingerprints) - len(changed)} unchanged pages")
+
+    # Figure images of changed pages are re-rendered, but a page may now have
+    # fewer figures; vanished pages lose all their images
+    extractpdf.remove_page_files(savedir, changed, keep_main=True)
+    extractpdf.remove_page_files(savedir, vanished)
+
+    indexed_ids = []
+    metadata_file = None
+    if changed:
+        bedrock_session = bedrock.get_bedrock_session(
+            os.getenv("AWS_ACCESS_KEY_ID"),
+            os.getenv("AWS_SECRET_ACCESS_KEY"),
+            os.getenv("AWS_REGION")
+        )
+        with profiling.profile_stage(profiler, "extract"):
+            metadata_file = extractpdf.extract_images_caption_and_metadata(
+                pdffile, savedir, bedrock_session=bedrock_session,
+                bedrock_modelid=os.getenv("BEDROCK_MODEL_ID"), page_range=changed,
+                encoding_profile=ENCODING_PROFILE, profiler=profiler,
+                metadata_file=savedir + "/metadata.incremental.json",
+                part_file=savedir + "/metadata.incremental.jsonl")
+    if changed or vanished:
+        extractpdf.replace_metadata_pages(
+            savedir + "/metadata.json", metadata_file, changed + vanished)
+    if changed:
+        with profiling.profile_stage(profiler, "insert"):
+            indexed_ids = opensearch.insert_metadata_to_opensearch(
+                metadata_file, bedrock_session, *opensearch_args, profiler=profiler)
+
+    opensearch.delete_pages_from_opensearch(
+        doc_id, changed + vanished, *opensearch_args, keep_ids=indexed_ids)
+    opensearch.delete_legacy_entries(
+        doc_id, savedir + "/", opensearch.main_entry_pages(indexed_ids), *opensearch_args)
+
+
+# Project calls, tokens, time and size for PDFs (files or directories)
+# without calling Bedrock or OpenSearch
+def dry_run(pdf_paths, concurrency=1, output_tokens=300, input_price=None, output_price=None):
+    pdffiles = []
+    for path in pdf_paths:
+        if os.path.isdir(path):
+            pdffiles.extend(sorted(os.path.join(path, filename) for filename in os.listdir(path)
+                                   if filename.lower().endswith(".pdf")))
+        else:
+            pdffiles.append(path)
+
+    plans = [planner.plan_document(pdffile, encoding_profile=ENCODING_PROFILE)
+             for pdffile in pdffiles]
+    projection = planner.project(
+        plans, output_tokens=output_tokens, concurrency=concurrency,
+        requests_per_minute=int(os.getenv("BEDROCK_REQUESTS_PER_MINUTE") or 0) or None,
+        tokens_per_minute=int(os.getenv("BEDROCK_TOKENS_PER_MINUTE") or 0) or None,
+        input_price_per_mtok=input_price, output_price_per_mtok=output_price)
+    print(planner.format_projection(projection))
+    return projection
+
+
+def merge_metadata_parts():
+    extractpdf.merge_metadata_parts(SAVEDIR)
+
+
+# "10:20" -> (10, 20), pages 10..19
+def parse_page_range(value):
+    start, end = value.split(":")
+    return (int(start) if start else 0, int(end) if end else float("inf"))
+
+
+# "2/4" -> (1, 4), the second of four shards
+def parse_shard(value):
+    index, count = value.split("/")
+    return (int(index) - 1, int(count))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Extract PDF pages, caption them and insert them into OpenSearch")
+    parser.add_argument("--batch-job",
+                        help="write caption requests to this batch-inference JSONL "
+                        "instead of calling Bedrock, then stop")
+    parser.add_argument("--batch-results",
+                        help="import captions from this batch results JSONL, then insert")
+    parser.add_argument("--run-batch-locally", action="store_true",
+                        help="run --batch-job with the local stub runner into --batch-results, "
+                        "then stop (stub captions are not inserted)")
+    parser.add_argument("--page-range", type=parse_page_range,
+                        help="process pages START:END only (0-based, END exclusive)")
+    parser.add_argument("--shard", type=parse_shard,
+                        help="process shard I/N (1-based) of the pages and write its "
+                        "metadata part file only; run --merge once all shards are copied "
+                        "into the save directory")
+    parser.add_argument("--merge", action="store_true",
+                        help="merge metadata part files into metadata.json, then insert")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only re-process pages whose content changed since the last "
+                        "run and delete pages that no longer exist")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only estimate Bedrock calls, tokens, time and index size "
+                        "for --pdf; no external service is called")
+    parser.add_argument("--pdf", nargs="+", default=[PDFFILE],
+                        help="PDF files or directories for --dry-run")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="parallel captioning calls assumed by --dry-run")
+    parser.add_argument("--output-tokens", type=int, default=300,
+                        help="caption length in tokens assumed by --dry-run")
+    parser.add_argument("--input-price", type=float,
+                        help="USD per million input tokens, for the --dry-run cost estimate")
+    parser.add_argument("--output-price", type=float,
+                        help="USD per million output tokens, for the --dry-run cost estimate")
+    parser.add_argument("--profile-memory", metavar="REPORT_FILE",
+                        help="record RSS and tracemalloc top allocators per stage and "
+                        "page, and write a JSON report to this file")
+    parser.add_argument("--cprofile", metavar="PROFILE_FILE",
+                        help="write cProfile stats of the run to this file")
+    args = parser.parse_args()
+    if args.run_batch_locally and not (args.batch_job and args.batch_results):
+        parser.error("--run-batch-locally requires --batch-job and --batch-results")
+    return args
+
+
+def run(args, profiler=None):
+    if args.dry_run:
+        dry_run(args.pdf, args.concurrency, args.output_tokens,
+                args.input_price, args.output_price)
+        return
+
+    if args.incremental:
+        incremental_sync(profiler)
+        return
+
+    if args.merge:
+        with profiling.profile_stage(profiler, "merge"):
+            merge_metadata_parts()
+        if args.batch_results:
+            import_batch_results(args.batch_results)
+        insert_to_opensearch(profiler)
+        return
+
+    if args.shard:
+        preprocessing(batch_job_file=args.batch_job,
+                      page_range=args.page_range, shard=args.shard, profiler=profiler)
+        logger.info(f"Shard {args.shard[0] + 1}/{args.shard[1]} done. Collect all part "
+                    f"files into {SAVEDIR} and run with --merge")
+        return
+
+    if args.batch_job:
+        preprocessing(batch_job_file=args.batch_job, page_range=args.page_range,
+                      profiler=profiler)
+        # Stub captions only exercise the pipeline; they are never inserted
+        if args.run_batch_locally:
+            batchcaption.run_batch_job_locally(args.batch_job, args.batch_results)
+            logger.info(f"Stub results written to {args.batch_results}")
+            return
+        logger.info(f"Batch job written to {args.batch_job}. Run it as a Bedrock "
+                    f"batch-inference job, then re-run with --batch-results")
+        return
+
+    if args.batch_results:
+        import_batch_results(args.batch_results)
+    else:
+        preprocessing(page_range=args.page_range, profiler=profiler)
+    insert_to_opensearch(profiler)
+
+
+if __name__ == "__main__":
+    args = parse_args()
 
-preprocessing()
-insert_to_opensearch()
+    profiler = profiling.IngestionProfiler() if args.profile_memory else None
+    cprofiler = None
+    if args.cprofile:
+        import cProfile
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    # Captioning yields the shared Bedrock quota to interactive callers
+    bedrock.set_quota_scheduler(quota.scheduler_from_env())
+    try:
+        with bedrock.quota_priority("batch"):
+            run(args, profiler)
+    finally:
+        if cprofiler is not None:
+            cprofiler.disable()
+            cprofiler.dump_stats(args.cprofile)
+            logger.info(f"cProfile stats written to {args.cprofile}")
+        if profiler is not None:
+            profiler.write_report(args.profile_memory)
@@ -0,0 +1,104 @@
+# Semantic answer cache
+# Serves a stored answer when a new question's embedding is close to a cached
+# one, the query type matches and retrieval returned the same pages in the
+# same order (<refpage> numbers refer to page positions)
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(vector):
+    norm = math.sqrt(sum(x * x for x in vector))
+    if norm == 0:
+        return None
+    return [x / norm for x in vector]
+
+
+# - similarity_threshold : minimum cosine similarity to serve a cached answer
+# - max_entries : oldest entries are evicted beyond this
+# - generation_check_interval : seconds between index generation checks
+class SemanticAnswerCache:
+
+    def __init__(self, similarity_threshold=0.95, max_entries=256,
+                 generation_check_interval=30.0):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.generation_check_interval = generation_check_interval
+        self.entries = []
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._last_generation_check = None
+        self._lock = threading.Lock()
+
+    def lookup(self, query_vector, querytype, page_ids):
+        query_vector = _normalize(query_vector) if query_vector else None
+        if query_vector is None:
+            return None
+        page_ids = tuple(page_ids)
+
+        with self._lock:
+            best, best_similarity = None, self.similarity_threshold
+            for entry in self.entries:
+                if entry["querytype"] != querytype or entry["page_ids"] != page_ids:
+                    continue
+                similarity = sum(x * y for x, y in zip(query_vector, entry["vector"]))
+                if similarity >= best_similarity:
+                    best, best_similarity = entry, similarity
+
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        logger.info(f"Answer cache hit (similarity {best_similarity:.3f}), "
+                    f"hits: {self.hits}, misses: {self.misses}")
+        return best["answer"]
+
+    def store(self, query_vector, querytype, page_ids, answer):
+        query_vector = _normalize(query_vector) if query_vector else None
+        if query_vector is None or not answer:
+            return
+        with self._lock:
+            self.entries.append({
+                "vector": query_vector,
+                "querytype": querytype,
+                "page_ids": tuple(page_ids),
+                "answer": answer,
+                "created": time.time(),
+            })
+            del self.entries[:-self.max_entries]
+
+    def invalidate(self):
+        with self._lock:
+            self.entries = []
+        logger.info("Answer cache invalidated")
+
+    # Clear the cache when the index generation changed
+    # get_generation is called at most every generation_check_interval seconds
+    def refresh_generation(self, get_generation):
+        now = time.monotonic()
+        if (self._last_generation_check is not None and
+                now - self._last_generation_check < self.generation_check_interval):
+            return
+        self._last_generation_check = now
+
+        generation = get_generation()
+        if generation is None:
+            return
+        if self.generation is not None and generation != self.generation:
+            logger.info(f"Index generation changed: {self.generation} -> {generation}")
+            self.invalidate()
+        self.generation = generation
+
+
+# Replay a cached answer through a streaming callback in small chunks
+def stream_cached_answer(answer, streaming_callback, chunk_size=16, delay=0.0):
+    for start in range(0, len(answer), chunk_size):
+        streaming_callback(answer[start:start + chunk_size])
+        if delay:
+            time.sleep(delay)
+    return answer
@@ -0,0 +1,146 @@
+# Offline batch captioning
+# Caption requests are written as a Bedrock batch-inference JSONL job file
+# ({"recordId", "modelInput"} per line) and the job's output JSONL
+# ({"recordId", "modelInput", "modelOutput" | "error"}) is imported back
+# into metadata.json by record id
+import json
+import logging
+import os
+
+import lib.bedrock as bedrock
+
+logger = logging.getLogger(__name__)
+
+
+def main_record_id(page_num):
+    return f"page{page_num:05d}-main"
+
+
+def sub_record_id(page_num, img_index):
+    return f"page{page_num:05d}-img{img_index:03d}-sub"
+
+
+# Append-only writer for a batch job input file
+class BatchJobWriter:
+
+    def __init__(self, job_file):
+        self.job_file = job_file
+        self.record_count = 0
+        job_dir = os.path.dirname(job_file)
+        if job_dir and not os.path.exists(job_dir):
+            os.makedirs(job_dir)
+        self._file = open(job_file, "w", encoding="utf-8")
+
+    def add_record(self, record_id, model_input):
+        record = {"recordId": record_id, "modelInput": model_input}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.record_count += 1
+
+    def close(self):
+        self._file.close()
+        logger.info(f"Batch job file written: {self.job_file} ({self.record_count} records)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def stub_invoke(record_id, model_input):
+    text = f"[stub caption for {record_id}]"
+    if record_id.endswith("-sub"):
+        text += "\n<sameimage>false</sameimage>"
+    return {"content": [{"type": "text", "text": text}]}
+
+
+# Execute a job file locally, one record at a time, writing a results file
+# in the batch output format. invoke(record_id, model_input) returns the
+# model output body; defaults to a stub that echoes the record id.
+# For a real small-scale run use:
+#   invoke=lambda record_id, body: bedrock.invoke_model_body(session, model_id, body)
+def run_batch_job_locally(job_file, results_file, invoke=stub_invoke):
+    processed = 0
+    with open(job_file, "r", encoding="utf-8") as job, \
+            open(results_file, "w", encoding="utf-8") as results:
+        for line in job:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            try:
+                record["modelOutput"] = invoke(record["recordId"], record["modelInput"])
+            except Exception as e:
+                logger.error(f"Record {record['recordId']} failed: {e}")
+                record["error"] = {"errorMessage": str(e)}
+            results.write(json.dumps(record, ensure_ascii=False) + "\n")
+            processed += 1
+
+    logger.info(f"Local batch run: {processed} records -> {results_file}")
+    return results_file
+
+
+# Fill image_text in metadata.json from a batch results file
+# Sub-images the model reports as the same as their page are removed
+# metadata.json is streamed entry by entry into a replacement file; only the
+# result texts are held in memory, keyed by record id
+# Returns counts of updated, removed and missing records
+def import_batch_results(metadata_file, results_file):
+    # lib.extractpdf imports this module
+    import lib.extractpdf as extractpdf
+
+    outputs = {}
+    with open(results_file, "r", encoding="utf-8") as results:
+        for line in results:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record_id = record.get("recordId")
+            if "modelOutput" not in record:
+                outputs[record_id] = None
+                logger.error(f"Record {record_id} has no output: {record.get('error')}")
+                continue
+            outputs[record_id] = bedrock.parse_response_text(record["modelOutput"])
+
+    counts = {"updated": 0, "removed": 0, "missing": 0}
+    seen = set()
+
+    def updated_entries():
+        for key, item in extractpdf.iter_metadata_entries(metadata_file):
+            record_id = item.get("record_id")
+            if record_id is None:
+                yield key, item
+                continue
+            if record_id not in outputs:
+                counts["missing"] += 1
+                yield key, item
+                continue
+            seen.add(record_id)
+
+            extracted_text = outputs[record_id]
+            if extracted_text is None:
+                yield key, item
+                continue
+            if item["type"] == "sub":
+                is_same_image, text = bedrock.parse_structured_text(extracted_text)
+                if is_same_image:
+                    logger.info(f"Removed {key} (Same with main image)")
+                    counts["removed"] += 1
+                    continue
+                item["image_text"] = text
+            else:
+                item["image_text"] = extracted_text.strip()
+            del item["record_id"]
+            counts["updated"] += 1
+            yield key, item
+
+    extractpdf.write_metadata_entries(metadata_file, updated_entries())
+
+    for record_id in outputs.keys() - seen:
+        logger.warning(f"Unknown record id in results: {record_id}")
+    updated, removed, missing = counts["updated"], counts["removed"], counts["missing"]
+    if missing:
+        logger.warning(f"{missing} records have no result and keep their record_id")
+
+    logger.info(f"Imported batch results: {updated} updated, {removed} removed, "
+                f"{missing} missing")
+    return updated, removed, missing
@@ -1,16 +1,25 @@
 import base64
+import contextlib
+import contextvars
+import hashlib
 import json
 import logging
-import lib.logging_config as logging_config
-import boto3
+import lib.contextpack as contextpack
+import lib.conversation as conversation
+import lib.singleflight as singleflight
 import os
 import re
+import threading
+import weakref
+from collections import OrderedDict
 
-# logging_config.setup_logging()
 logger = logging.getLogger(__name__)
 
 
+# boto3 is imported lazily so modules importing lib.bedrock start fast
 def get_bedrock_session(aws_access_key_id, aws_secret_access_key, region_name):
+    import boto3
+
     return boto3.Session(
         aws_access_key_id=aws_access_key_id,
         aws_secret_access_key=aws_secret_access_key,
@@ -18,22 +27,154 @@ def get_bedrock_session(aws_access_key_id, aws_secret_access_key, region_name):
     )
 
 
-def get_text_vector(session, input_text, dimensions=1024):
+# Bedrock runtime clients are thread-safe and expensive to create,
+# so one client is shared per session
+_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+# max_pool_connections sizes the client's HTTP pool (botocore default is 10);
+# it only applies when the session's client is first created
+def get_bedrock_client(session, max_pool_connections=None):
+    with _clients_lock:
+        client = _clients.get(session)
+        if client is None:
+            if max_pool_connections is not None:
+                from botocore.config import Config
+
+                client = session.client(
+                    service_name='bedrock-runtime',
+                    config=Config(max_pool_connections=max_pool_connections))
+            else:
+                client = session.client(service_name='bedrock-runtime')
+            _clients[session] = client
+        return client
+
+
+# Optional lib.quota.QuotaScheduler shared with other processes, and the
+# priority class of calls made in the current context
+_quota_scheduler = None
+_quota_priority = contextvars.ContextVar("quota_priority", default="interactive")
+
+
+def set_quota_scheduler(scheduler):
+    global _quota_scheduler
+    _quota_scheduler = scheduler
+
+
+def get_quota_scheduler():
+    return _quota_scheduler
+
+
+# Run model calls in this block with the given priority ("interactive" or "batch")
+@contextlib.contextmanager
+def quota_priority(priority):
+    token = _quota_priority.set(priority)
+    try:
+        yield
+    finally:
+        _quota_priority.reset(token)
+
+
+# Estimated tokens a request counts against the quota: input plus max_tokens
+def estimate_body_tokens(body):
+    tokens = body.get("max_tokens", 0)
+    if isinstance(body.get("system"), str):
+        tokens += conversation.estimate_text_tokens(body["system"])
+    for message in body.get("messages", []):
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += conversation.estimate_text_tokens(content)
+            continue
+        for block in content:
+            if block["type"] == "text":
+                tokens += conversation.estimate_text_tokens(block["text"])
+            elif block["type"] == "image":
+                width, height = contextpack.get_image_size(
+                    base64.b64decode(block["source"]["data"]))
+                tokens += contextpack.estimate_image_tokens(width, height)
+    return tokens
+
+
+# Wait for quota before a model call (body as dict or serialized JSON); the
+# caller fills the yielded dict with the response usage so the reservation
+# is corrected afterwards
+@contextlib.contextmanager
+def quota_slot(body):
+    if _quota_scheduler is None:
+        yield {}
+        return
+    if isinstance(body, str):
+        body = json.loads(body)
+    reserved = estimate_body_tokens(body)
+    _quota_scheduler.acquire(reserved, _quota_priority.get())
+    usage = {}
+    try:
+        yield usage
+    finally:
+        actual = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+        _quota_scheduler.settle(reserved, actual or reserved)
+
+
+# Identical embedding and model calls in flight at the same time (concurrent
+# chats, ingestion workers hitting repeated text or images) share one
+# upstream call, keyed by a hash of the model id and request body
+_single_flight = singleflight.SingleFlight("bedrock")
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"  # Titan Text v2
 
-    if not input_text or len(input_text.strip()) == 0:
-        return None
 
-    bedrock = session.client(service_name='bedrock-runtime')
+def request_key(model_id, serialized_body):
+    return hashlib.sha256(f"{model_id}\n{serialized_body}".encode("utf-8")).hexdigest()
 
-    request_body = {
+
+# Calls made, executed upstream and served by joining an identical call
+def single_flight_stats():
+    return _single_flight.stats()
+
+
+# Memoized base64 form of image bytes (bytes objects cache their hash)
+_base64_cache = OrderedDict()
+_base64_cache_lock = threading.Lock()
+BASE64_CACHE_SIZE = 64
+
+
+def remember_image_base64(image_bytes, image_base64):
+    with _base64_cache_lock:
+        _base64_cache[image_bytes] = image_base64
+        _base64_cache.move_to_end(image_bytes)
+        while len(_base64_cache) > BASE64_CACHE_SIZE:
+            _base64_cache.popitem(last=False)
+
+
+# Accepts raw bytes or a BytesIO-like object
+def encode_image_base64(image):
+    if hasattr(image, "getvalue"):
+        image = image.getvalue()
+
+    with _base64_cache_lock:
+        image_base64 = _base64_cache.get(image)
+        if image_base64 is not None:
+            _base64_cache.move_to_end(image)
+            return image_base64
+
+    image_base64 = base64.b64encode(image).decode('utf-8')
+    remember_image_base64(image, image_base64)
+    return image_base64
+
+
+def _embedding_body(input_text, dimensions):
+    return json.dumps({
         "inputText": input_text,
         "dimensions": dimensions
-    }
+    })
+
+
+def _invoke_embedding(session, body):
+    bedrock = get_bedrock_client(session)
 
-    body = json.dumps(request_body)
     response = bedrock.invoke_model(
         body=body,
-        modelId="amazon.titan-embed-text-v2:0",  # Titan Text v2
+        modelId=EMBEDDING_MODEL_ID,
         accept="application/json",
         contentType="application/json"
     )
@@ -44,33 +185,90 @@ def get_text_vector(session, input_text, dimensions=1024):
     return embedding
 
 
-def extract_text_from_image_using_bedrock(session, model_id, imagefile):
+def get_text_vector(session, input_text, dimensions=1024):
 
-    logger.info("Starting extract_text_from_image_using_bedrock function")
+    if not input_text or len(input_text.strip()) == 0:
+        return None
+
+    body = _embedding_body(input_text, dimensions)
+    return _single_flight.do(request_key(EMBEDDING_MODEL_ID, body),
+                             _invoke_embedding, session, body)
 
-    if not session:
-        logger.error("Session is not provided. Returning from function.")
-        return
 
-    logger.info("Creating Bedrock runtime client")
-    bedrock_client = session.client(service_name='bedrock-runtime')
+# get_text_vector for asyncio code; the call runs in executor (default: the
+# loop's) and joins identical calls from threads or other coroutines
+async def get_text_vector_async(session, input_text, dimensions=1024, executor=None):
+
+    if not input_text or len(input_text.strip()) == 0:
+        return None
 
-    # Read image file and encode to base64
+    body = _embedding_body(input_text, dimensions)
+    return await _single_flight.do_async(request_key(EMBEDDING_MODEL_ID, body),
+                                         _invoke_embedding, session, body,
+                                         executor=executor)
+
+
+# Read image file and encode to base64
+def read_image_base64(imagefile):
     logger.info(f"Reading image file: {imagefile}")
     with open(imagefile, "rb") as image_file:
         image_bytes = image_file.read()
     image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-    logger.info("Image successfully encoded to base64")
+    logger.info(f"{imagefile} successfully encoded to base64")
+    return image_base64
+
+
+# Media type of an image file from its magic bytes
+def image_file_media_type(imagefile):
+    with open(imagefile, "rb") as image_file:
+        return contextpack.detect_media_type(image_file.read(16))
 
-    # Create prompt
-    logger.info("Creating prompt")
+
+# Invoke model with a request body and return the parsed response body
+# Identical bodies in flight (same image captioned twice) share one call
+def invoke_model_body(session, model_id, body):
+    serialized_body = json.dumps(body)
+    return _single_flight.do(request_key(model_id, serialized_body),
+                             _invoke_model_serialized, session, model_id, body,
+                             serialized_body)
+
+
+def _invoke_model_serialized(session, model_id, body, serialized_body):
+    bedrock_client = get_bedrock_client(session)
+
+    logger.info("Invoking model")
+    with quota_slot(body) as usage:
+        response = bedrock_client.invoke_model(
+            body=serialized_body,
+            modelId=model_id,
+            accept="application/json",
+            contentType="application/json"
+        )
+        response_body = json.loads(response['body'].read())
+        usage.update(response_body.get('usage', {}))
+
+    return response_body
+
+
+# Extract the first text block of a Claude response body
+def parse_response_text(response_body):
+    if ('content' in response_body and
+        isinstance(response_body['content'], list) and
+        len(response_body['content']) > 0 and
+            'text' in response_body['content'][0]):
+        return response_body['content'][0]['text']
+    return "결과를 가져오지 못했습니다."
+
+
+# Request body for extracting all text from a single image
+def build_text_extraction_body(image_base64, media_type="image/png"):
     prompt = "이미지에서 표에 있는 텍스트를 포함하여 모든 텍스트를 추출해주세요. 추출된 텍스트 내용만 출력해주세요."
     contents = [
         {
             "type": "image",
             "source": {
                 "type": "base64",
-                "media_type": "image/png",
+                "media_type": media_type,
                 "data": image_base64
             }
         },
@@ -80,9 +278,7 @@ def extract_text_from_image_using_bedrock(session, model_id, imagefile):
         }
     ]
 
-    # Prepare request body
-    logger.info("Preparing request body")
-    body = {
+    return {
         "anthropic_version": "bedrock-2023-05-31",
         "max_tokens": 2000,
         "messages": [
@@ -93,61 +289,32 @@ def extract_text_from_image_using_bedrock(session, model_id, imagefile):
             }
         ]
     }
-    logger.info("Request body prepared")
-
-    # Invoke model
-    logger.info("Invoking model")
-    serialized_body = json.dumps(body)
-    response = bedrock_client.invoke_model(
-        body=serialized_body,
-        modelId=model_id,
-        accept="application/json",
-        contentType="application/json"
-    )
 
-    # Get response body
-    response_body = json.loads(response['body'].read())
 
-    if ('content' in response_body and
-        isinstance(response_body['content'], list) and
-        len(response_body['content']) > 0 and
-            'text' in response_body['content'][0]):
-        extracted_text = response_body['content'][0]['text']
-    else:
-        extracted_text = "결과를 가져오지 못했습니다."
-
-    return extracted_text.strip()
-
-
-# bimage = big image (image including all text and image)
-# simage = small image (image to check where simage is in bimage)
-def extract_structured_text_from_image_using_bedrock(session, model_id, bimagefile, simagefile):
+def extract_text_from_image_using_bedrock(session, model_id, imagefile):
 
-    logger.info(
-        "Starting extract_structured_text_from_image_using_bedrock function")
+    logger.info("Starting extract_text_from_image_using_bedrock function")
 
     if not session:
         logger.error("Session is not provided. Returning from function.")
         return
 
-    logger.info("Creating Bedrock runtime client")
-    bedrock_client = session.client(service_name='bedrock-runtime')
+    image_base64 = read_image_base64(imagefile)
+
+    # Prepare request body
+    logger.info("Preparing request body")
+    body = build_text_extraction_body(image_base64, image_file_media_type(imagefile))
+    logger.info("Request body prepared")
+
+    response_body = invoke_model_body(session, model_id, body)
+    extracted_text = parse_response_text(response_body)
 
-    # Read image file and encode to base64
-    logger.info(f"Reading image file: {bimagefile}")
-    with open(bimagefile, "rb") as image_file:
-        bimage_bytes = image_file.read()
-    bimage_base64 = base64.b64encode(bimage_bytes).decode('utf-8')
-    logger.info(f"{bimagefile} successfully encoded to base64")
+    return extracted_text.strip()
 
-    logger.info(f"Reading image file: {simagefile}")
-    with open(simagefile, "rb") as image_file:
-        simage_bytes = image_file.read()
-    simage_base64 = base64.b64encode(simage_bytes).decode('utf-8')
-    logger.info(f"{simagefile} successfully encoded to base64")
 
-    # Create prompt
-    logger.info("Creating prompt")
+# Request body for describing simage within bimage and detecting if they are the same
+def build_structured_text_body(bimage_base64, simage_base64,
+                               bimage_media_type="image/png", simage_media_type="image/png"):
     prompt = """
     첫번째 이미지는 전체 이미지고 두번째 이미지는 전체 이미지 중 한 부분일수도 있고 동일한 이미지일수도 있습니다.
     첫번째 이미지와 두번째 이미지가 해상도만 다르고 동일한 이미지라면, 
@@ -174,7 +341,7 @@ def extract_structured_text_from_image_using_bedrock(session, model_id, bimagefi
             "type": "image",
             "source": {
                 "type": "base64",
-                "media_type": "image/png",
+                "media_type": bimage_media_type,
                 "data": bimage_base64
             }
         },
@@ -182,7 +349,7 @@ def extract_structured_text_from_image_using_bedrock(session, model_id, bimagefi
             "type": "image",
             "source": {
                 "type": "base64",
-                "media_type": "image/png",
+                "media_type": simage_media_type,
                 "data": simage_base64
             }
         },
@@ -192,9 +359,7 @@ def extract_structured_text_from_image_using_bedrock(session, model_id, bimagefi
         }
     ]
 
-    # Prepare request body
-    logger.info("Preparing request body")
-    body = {
+    return {
         "anthropic_version": "bedrock-2023-05-31",
         "max_tokens": 2000,
         "messages": [
@@ -205,32 +370,10 @@ def extract_structured_text_from_image_using_bedrock(session, model_id, bimagefi
             }
         ]
     }
-    logger.info("Request body prepared")
 
-    # Invoke model
-    logger.info("Invoking model")
-    serialized_body = json.dumps(body)
-    response = bedrock_client.invoke_model(
-        body=serialized_body,
-        modelId=model_id,
-        accept="application/json",
-        contentType="application/json"
-    )
 
-    # Get response body
-    response_body = json.loads(response['body'].read())
-
-    if ('content' in response_body and
-        isinstance(response_body['content'], list) and
-        len(response_body['content']) > 0 and
-            'text' in response_body['content'][0]):
-        extracted_text = response_body['content'][0]['text']
-    else:
-        extracted_text = "결과를 가져오지 못했습니다."
-
-    logger.info(f"Extracted text: {extracted_text}")
-
-    # Extract text content and <sameimage> tag value
+# Split structured caption text and <sameimage> tag value
+def parse_structured_text(extracted_text):
     is_same_image = False
 
     # Find <sameimage> tag positions
@@ -250,15 +393,44 @@ def extract_structured_text_from_image_using_bedrock(session, model_id, bimagefi
         # If <sameimage> tag is not present, use the entire text
         text = extracted_text.strip()
 
-    # Return results
     return is_same_image, text
 
 
+# bimage = big image (image including all text and image)
+# simage = small image (image to check where simage is in bimage)
+def extract_structured_text_from_image_using_bedrock(session, model_id, bimagefile, simagefile):
+
+    logger.info(
+        "Starting extract_structured_text_from_image_using_bedrock function")
+
+    if not session:
+        logger.error("Session is not provided. Returning from function.")
+        return
+
+    bimage_base64 = read_image_base64(bimagefile)
+    simage_base64 = read_image_base64(simagefile)
+
+    # Prepare request body
+    logger.info("Preparing request body")
+    body = build_structured_text_body(bimage_base64, simage_base64,
+                                      image_file_media_type(bimagefile),
+                                      image_file_media_type(simagefile))
+    logger.info("Request body prepared")
+
+    response_body = invoke_model_body(session, model_id, body)
+    extracted_text = parse_response_text(response_body)
+
+    logger.info(f"Extracted text: {extracted_text}")
+
+    # Return results
+    return parse_structured_text(extracted_text)
+
+
 # Classify request type and return type
 # 1. imagesearch : 특정 이미지 찾기 요청
 # 2. general : 일반적인 정보 요청
 def classify_request_type(session, model_id, user_query):
-    sonnet = session.client(service_name='bedrock-runtime')
+    sonnet = get_bedrock_client(session)
 
     # 요청 유형 분류를 위한 프롬프트 구성
     classification_prompt = f"""
@@ -298,14 +470,16 @@ def classify_request_type(session, model_id, user_query):
     try:
         serialized_body = json.dumps(body)
 
-        response = sonnet.invoke_model(
-            body=serialized_body,
-            modelId=model_id,
-            accept="application/json",
-            contentType="application/json"
-        )
+        with quota_slot(body) as usage:
+            response = sonnet.invoke_model(
+                body=serialized_body,
+                modelId=model_id,
+                accept="application/json",
+                contentType="application/json"
+            )
 
-        response_body = json.loads(response['body'].read())
+            response_body = json.loads(response['body'].read())
+            usage.update(response_body.get('usage', {}))
 
         # Extract classification result
         if ('content' in response_body and
@@ -328,37 +502,39 @@ def classify_request_type(session, model_id, user_query):
 
     return classification_result
 
-# Function to handle streaming data
-
-
-def chunk_handler(chunk):
-    print(chunk, end='')
 
 # Function to get streaming response from Bedrock Model
 # Helper function for query_bedrock_with_images_and_text_with_streaming function
-
-
+# - streaming_callback : called with each raw text delta (may be None); callers
+#   that need the control tags parsed feed a lib.streaming.TagStreamParser from it
+# Returns the raw answer, tags included
 def get_streaming_response(session, model_id, prompt, streaming_callback):
 
-    bedrock = session.client(service_name='bedrock-runtime')
+    bedrock = get_bedrock_client(session)
 
-    # Get streaming response from Bedrock Model
-    response = bedrock.invoke_model_with_response_stream(
-        modelId=model_id,
-        body=prompt,
-        accept='application/json',
-        contentType='application/json'
-    )
-
-    # Initialize all_chunks to store all chunks
-    all_chunks = ""
+    with quota_slot(prompt) as usage:
+        # Get streaming response from Bedrock Model
+        response = bedrock.invoke_model_with_response_stream(
+            modelId=model_id,
+            body=prompt,
+            accept='application/json',
+            contentType='application/json'
+        )
 
-    for event in response.get('body'):
-        chunk = json.loads(event['chunk']['bytes'])
-        if chunk['type'] == 'content_block_delta':
-            if chunk['delta']['type'] == 'text_delta':
-                streaming_callback(chunk['delta']['text'])
-                all_chunks += chunk['delta']['text']
+        # Initialize all_chunks to store all chunks
+        all_chunks = ""
+
+        for event in response.get('body'):
+            chunk = json.loads(event['chunk']['bytes'])
+            if chunk['type'] == 'content_block_delta':
+                if chunk['delta']['type'] == 'text_delta':
+                    if streaming_callback is not None:
+                        streaming_callback(chunk['delta']['text'])
+                    all_chunks += chunk['delta']['text']
+            elif chunk['type'] == 'message_start':
+                usage.update(chunk['message'].get('usage', {}))
+            elif chunk['type'] == 'message_delta':
+                usage.update(chunk.get('usage', {}))
 
     return all_chunks
 
@@ -367,9 +543,22 @@ def get_streaming_response(session, model_id, prompt, streaming_callback):
 def query_bedrock_with_images_and_text_with_streaming(session, model_id,
                                                       querytype, search_text,
                                                       images, texts,
-                                                      streaming_callback=chunk_handler):
+                                                      streaming_callback=None,
+                                                      image_token_budget=None,
+                                                      image_long_edge=1092,
+                                                      image_format="JPEG",
+                                                      history=None,
+                                                      use_images=True):
     contents = []
 
+    # Fit images into the vision-token budget (downscale, shrink or drop low ranks)
+    if use_images and image_token_budget is not None:
+        pages = contextpack.pack_context(
+            images, texts, token_budget=image_token_budget,
+            long_edge=image_long_edge, image_format=image_format)
+        images = [page["image"] for page in pages]
+        texts = [page["text"] for page in pages]
+
     # Debug message to check if length of images and metadata
     logger.info(f"length of images: {
                 len(images)}, length of texts: {len(texts)}")
@@ -383,10 +572,22 @@ def query_bedrock_with_images_and_text_with_streaming(session, model_id,
 
     for idx, (image, text) in enumerate(zip(images, texts)):
 
+        # Follow-up turns may send the cached page text instead of the image
+        if not use_images:
+            contents.append({
+                "type": "text",
+                "text": str(idx + 1) + "페이지 내용 시작\n" + text + "\n" +
+                str(idx + 1) + "페이지 내용 끝" + "\n\n"
+            })
+            continue
+
+        if hasattr(image, "getvalue"):
+            image = image.getvalue()
+
         # debug message to print idx and image size
-        logger.info(f"idx: {idx}, image size: {len(image.getvalue())}")
+        logger.info(f"idx: {idx}, image size: {len(image)}")
 
-        image_base64 = base64.b64encode(image.getvalue()).decode('utf-8')
+        image_base64 = encode_image_base64(image)
 
         # Append text to contents
         contents.append({
@@ -398,7 +599,7 @@ def query_bedrock_with_images_and_text_with_streaming(session, model_id,
             "type": "image",
             "source": {
                 "type": "base64",
-                "media_type": "image/jpeg",
+                "media_type": contextpack.detect_media_type(image),
                 "data": image_base64
             }
         })
@@ -456,7 +657,7 @@ def query_bedrock_with_images_and_text_with_streaming(session, model_id,
         "anthropic_version": "bedrock-2023-05-31",
         "max_tokens": 2000,
         "temperature": 0,
-        "messages": [
+        "messages": (history or []) + [
             {
                 "role": "user",
                 "content": contents
@@ -0,0 +1,164 @@
+# Pack retrieved page images into the answer prompt under a vision-token budget
+import io
+import logging
+import math
+import struct
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Claude resizes images whose long edge exceeds this before tokenizing
+MAX_LONG_EDGE = 1568
+# Approximate vision tokens per pixel (tokens = width * height / 750)
+PIXELS_PER_TOKEN = 750
+
+MEDIA_TYPES = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+}
+
+
+# Detect media type from magic bytes
+def detect_media_type(image_bytes):
+    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_bytes.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    if image_bytes[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/png"
+
+
+# Read pixel dimensions from the image header without decoding
+# Falls back to PIL for formats the header parser does not handle
+def get_image_size(image_bytes):
+    media_type = detect_media_type(image_bytes)
+
+    if media_type == "image/png" and image_bytes[12:16] == b"IHDR":
+        return struct.unpack(">II", image_bytes[16:24])
+
+    if media_type == "image/jpeg":
+        offset = 2
+        while offset + 9 < len(image_bytes):
+            if image_bytes[offset] != 0xFF:
+                offset += 1
+                continue
+            marker = image_bytes[offset + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                offset += 2
+                continue
+            length = struct.unpack(">H", image_bytes[offset + 2:offset + 4])[0]
+            # SOF0..SOF15 except DHT(C4), JPG(C8), DAC(CC)
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(
+                    ">HH", image_bytes[offset + 5:offset + 9])
+                return width, height
+            offset += 2 + length
+
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return image.size
+
+
+# Estimate vision tokens for an image of the given pixel size
+def estimate_image_tokens(width, height):
+    long_edge = max(width, height)
+    if long_edge > MAX_LONG_EDGE:
+        scale = MAX_LONG_EDGE / long_edge
+        width, height = width * scale, height * scale
+    return math.ceil(width * height / PIXELS_PER_TOKEN)
+
+
+# Derived renditions keyed by (source bytes, long_edge, format, quality)
+_rendition_cache = OrderedDict()
+_rendition_cache_lock = threading.Lock()
+RENDITION_CACHE_SIZE = 128
+
+
+# Downscale image so its long edge is at most long_edge and re-encode it
+# Returns (image_bytes, media_type, width, height)
+def downscale_image(image_bytes, long_edge, image_format="JPEG", quality=85):
+    key = (image_bytes, long_edge, image_format, quality)
+    with _rendition_cache_lock:
+        rendition = _rendition_cache.get(key)
+        if rendition is not None:
+            _rendition_cache.move_to_end(key)
+            return rendition
+
+    width, height = get_image_size(image_bytes)
+    media_type = MEDIA_TYPES[image_format]
+    if max(width, height) <= long_edge and detect_media_type(image_bytes) == media_type:
+        rendition = (image_bytes, media_type, width, height)
+    else:
+        from PIL import Image
+
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if max(width, height) > long_edge:
+                scale = long_edge / max(width, height)
+                image = image.resize(
+                    (max(1, round(width * scale)), max(1, round(height * scale))),
+                    Image.LANCZOS)
+            if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            output = io.BytesIO()
+            if image_format == "PNG":
+                image.save(output, image_format, optimize=True)
+            else:
+                image.save(output, image_format, quality=quality)
+            rendition = (output.getvalue(), media_type, image.width, image.height)
+
+    with _rendition_cache_lock:
+        _rendition_cache[key] = rendition
+        while len(_rendition_cache) > RENDITION_CACHE_SIZE:
+            _rendition_cache.popitem(last=False)
+    return rendition
+
+
+# Fit ranked page images into a vision-token budget
+# - every page is first downscaled to long_edge
+# - lower-ranked pages are then shrunk (halving down to min_long_edge)
+# - pages are dropped from the lowest rank if still over budget,
+#   so the remaining pages keep their 1..n prompt numbering
+# The top-ranked page is always kept
+# Returns list of dicts: image, media_type, text, width, height, tokens
+def pack_context(images, texts, token_budget=6000, long_edge=1092,
+                 min_long_edge=512, image_format="JPEG", quality=85):
+    pages = []
+    for image, text in zip(images, texts):
+        if hasattr(image, "getvalue"):
+            image = image.getvalue()
+        pages.append({"source": image, "text": text, "long_edge": long_edge})
+
+    def render(page):
+        data, media_type, width, height = downscale_image(
+            page["source"], page["long_edge"], image_format, quality)
+        page.update(image=data, media_type=media_type, width=width, height=height,
+                    tokens=estimate_image_tokens(width, height))
+
+    for page in pages:
+        render(page)
+
+    def total_tokens():
+        return sum(page["tokens"] for page in pages)
+
+    # Shrink from the lowest-ranked page upwards
+    for page in reversed(pages[1:]):
+        while total_tokens() > token_budget and page["long_edge"] // 2 >= min_long_edge:
+            page["long_edge"] //= 2
+            render(page)
+
+    while total_tokens() > token_budget and len(pages) > 1:
+        dropped = pages.pop()
+        logger.info(f"Dropped page from context: {dropped['tokens']} tokens")
+
+    logger.info(f"Packed {len(pages)} pages, {total_tokens()} estimated image tokens "
+                f"(budget {token_budget})")
+
+    for page in pages:
+        del page["source"]
+    return pages
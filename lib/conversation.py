@@ -0,0 +1,105 @@
+# Conversation context for multi-turn chat
+# Keeps prior turns as text and decides when pages must be re-retrieved
+import logging
+import math
+import re
+
+logger = logging.getLogger(__name__)
+
+
+# Rough token estimate for mixed Korean/English text
+def estimate_text_tokens(text):
+    return math.ceil(len(text) / 3)
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = math.sqrt(sum(x * x for x in a))
+    norm_b = math.sqrt(sum(y * y for y in b))
+    if norm_a == 0 or norm_b == 0:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+
+# Remove control tags (<refpage>, <debug>) from an answer, e.g. for display
+def strip_answer_tags(text):
+    text = re.sub(r'<refpage>.*?</refpage>', '', text, flags=re.DOTALL)
+    text = re.sub(r'<debug>.*?</debug>', '', text, flags=re.DOTALL)
+    return text.strip()
+
+
+# - history_token_budget : max estimated tokens of prior turns resent per question
+# - page_text_token_budget : max estimated tokens of page text used on follow-ups
+# - images_on_followup : resend page images on follow-ups instead of page text
+# - drift_threshold : re-retrieve when the query embedding's cosine similarity
+#   to the retrieval query falls below this value
+class ConversationContext:
+
+    def __init__(self, history_token_budget=2000, page_text_token_budget=3000,
+                 images_on_followup=False, drift_threshold=0.6):
+        self.history_token_budget = history_token_budget
+        self.page_text_token_budget = page_text_token_budget
+        self.images_on_followup = images_on_followup
+        self.drift_threshold = drift_threshold
+        self.turns = []
+        self.images = []
+        self.texts = []
+        self.querytype = None
+        self.retrieval_query = None
+        self.retrieval_vector = None
+        self.turns_since_retrieval = 0
+
+    def needs_retrieval(self, query_vector):
+        if self.retrieval_vector is None or not self.images:
+            return True
+        if query_vector is None:
+            return False
+        similarity = cosine_similarity(query_vector, self.retrieval_vector)
+        logger.info(f"Similarity to retrieval query: {similarity:.3f}")
+        return similarity < self.drift_threshold
+
+    def set_retrieval(self, query, querytype, query_vector, images, texts):
+        self.retrieval_query = query
+        self.querytype = querytype
+        self.retrieval_vector = query_vector
+        self.images = images
+        self.texts = texts
+        self.turns_since_retrieval = 0
+
+    # Images are sent on the first turn after retrieval only, unless configured
+    def use_images(self):
+        return self.turns_since_retrieval == 0 or self.images_on_followup
+
+    # Page texts trimmed to an equal share of the page text budget
+    def page_texts(self):
+        if not self.texts:
+            return []
+        per_page = self.page_text_token_budget // len(self.texts)
+        max_chars = per_page * 3
+        return [text if len(text) <= max_chars else text[:max_chars] + " ..."
+                for text in self.texts]
+
+    # Prior turns as Bedrock messages, newest kept first under the budget
+    def history_messages(self):
+        messages = []
+        used = 0
+        for user_turn, assistant_turn in reversed(self.turns):
+            tokens = estimate_text_tokens(user_turn) + estimate_text_tokens(assistant_turn)
+            if used + tokens > self.history_token_budget:
+                break
+            used += tokens
+            messages[:0] = [
+                {"role": "user", "content": [{"type": "text", "text": user_turn}]},
+                {"role": "assistant", "content": [{"type": "text", "text": assistant_turn}]},
+            ]
+        logger.info(f"History: {len(messages) // 2} of {len(self.turns)} turns, "
+                    f"{used} estimated tokens")
+        return messages
+
+    # The answer keeps its <refpage> tags so the model sees prior turns in the
+    # format it was asked for; <debug> output is dropped
+    def add_turn(self, user_query, answer):
+        if strip_answer_tags(answer):
+            answer = re.sub(r'<debug>.*?</debug>', '', answer, flags=re.DOTALL).strip()
+            self.turns.append((user_query, answer))
+        self.turns_since_retrieval += 1
@@ -1,35 +1,140 @@
 # extract images from pdf
-import sys
+# PyMuPDF (fitz) and PIL are imported inside the extraction functions,
+# so importing this module does not load them
+import hashlib
 import json
 import os
 import logging
+import tempfile
 
-import lib.logging_config as logging_config
 import lib.bedrock as bedrock
+import lib.batchcaption as batchcaption
+import lib.contextpack as contextpack
+import lib.profiling as profiling
 
-# logging_config.setup_logging()
 logger = logging.getLogger(__name__)
 
-# Add parent directory to sys.path
-sys.path.append('..')  # noqa
 
-# Root library
-import fitz  # noqa
-from PIL import Image  # noqa
+# Select page numbers to process
+# - page_range : (start, end) with end exclusive, or an iterable of page numbers
+# - shard : (index, count) splits the selected pages into count contiguous blocks
+def select_pages(page_count, page_range=None, shard=None):
+    if page_range is None:
+        pages = list(range(page_count))
+    elif isinstance(page_range, tuple) and len(page_range) == 2:
+        start, end = page_range
+        pages = list(range(max(0, start), min(page_count, end)))
+    else:
+        pages = sorted(page for page in set(page_range) if 0 <= page < page_count)
+
+    if shard is not None:
+        index, count = shard
+        if not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count}")
+        begin = len(pages) * index // count
+        end = len(pages) * (index + 1) // count
+        pages = pages[begin:end]
+
+    logger.info(f"Selected {len(pages)} of {page_count} pages "
+                f"(page_range: {page_range}, shard: {shard})")
+    return pages
+
+
+# Stable document id from the file path, so a revised PDF keeps its ids while
+# same-named PDFs in different directories don't collide. The path is taken
+# relative to the working directory (the repository root the scripts run
+# from), so shards of one PDF on different hosts agree on the id.
+def document_id(pdffile):
+    path = os.path.relpath(pdffile).replace(os.sep, "/")
+    return hashlib.sha256(path.encode("utf-8")).hexdigest()[:16]
+
+
+# Content fingerprint of a page: content stream, page box and the raw
+# (undecoded) streams of the images it draws
+def page_fingerprint(doc, page):
+    digest = hashlib.sha256()
+    digest.update(repr(tuple(page.rect)).encode())
+    digest.update(page.read_contents())
+    for img in page.get_images(full=True):
+        digest.update(repr(img[:7]).encode())
+        digest.update(doc.xref_stream_raw(img[0]) or b"")
+    return digest.hexdigest()
+
+
+# Fingerprints of every page: {page_num: fingerprint}
+def compute_page_fingerprints(pdffile):
+    import fitz
 
+    doc = fitz.open(pdffile)
+    fingerprints = {page_num: page_fingerprint(doc, page)
+                    for page_num, page in enumerate(doc)}
+    doc.close()
+    return fingerprints
+
+
+# Encoding profiles for stored renditions, per rendition type
+# - format : PNG, JPEG or WEBP
+# - quality : JPEG/WEBP quality (ignored for PNG, which is saved optimized)
+# - dpi : render resolution, None uses the extraction function's dpi
+# - color : RGB, L (grayscale) or auto (grayscale when the page has no color)
+ENCODING_PROFILES = {
+    "png": {
+        "main": {"format": "PNG", "quality": None, "dpi": None, "color": "RGB"},
+        "sub": {"format": "PNG", "quality": None, "dpi": None, "color": "RGB"},
+    },
+    "compact": {
+        "main": {"format": "WEBP", "quality": 80, "dpi": None, "color": "auto"},
+        "sub": {"format": "JPEG", "quality": 85, "dpi": None, "color": "RGB"},
+    },
+    "small": {
+        "main": {"format": "WEBP", "quality": 70, "dpi": 110, "color": "auto"},
+        "sub": {"format": "WEBP", "quality": 80, "dpi": 130, "color": "RGB"},
+    },
+}
+
+FILE_EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
+
+
+# Resolve a profile name (or a {"main": ..., "sub": ...} dict) for a rendition type
+def get_encoding_profile(encoding_profile, rendition_type):
+    if isinstance(encoding_profile, str):
+        encoding_profile = ENCODING_PROFILES[encoding_profile]
+    return encoding_profile[rendition_type]
+
+
+# True if the image has (almost) no color, e.g. a text-only page
+def is_grayscale(pil_image, tolerance=12):
+    thumbnail = pil_image.convert("RGB").resize((64, 64))
+    for r, g, b in thumbnail.getdata():
+        if max(r, g, b) - min(r, g, b) > tolerance:
+            return False
+    return True
+
+
+# Encode a pixmap with a rendition profile and save it as savepath + extension
+# Returns (file path, media type)
+def save_rendition(pix, savepath, profile):
+    from PIL import Image
+
+    pil_image = Image.frombytes(
+        "RGB", [pix.width, pix.height], pix.samples)
+    if profile["color"] == "L" or (profile["color"] == "auto" and is_grayscale(pil_image)):
+        pil_image = pil_image.convert("L")
+
+    image_format = profile["format"]
+    image_path = f"{savepath}.{FILE_EXTENSIONS[image_format]}"
+    if image_format == "PNG":
+        pil_image.save(image_path, "PNG", optimize=True)
+    else:
+        pil_image.save(image_path, image_format, quality=profile["quality"])
+    return image_path, contextpack.MEDIA_TYPES[image_format]
 
-# Extract images and metadata
-# Experimental function
-# not for production use
-def extract_images_and_metadata(
-        pdffile, savedir,
-        min_width=100, min_height=100, left_margin=20, right_margin=20, bottom_margin=50,
-        dpi=150):
 
-    # Create save directory and delete existing files
+# Create save directory; delete existing files only for a full (unsharded) run
+def prepare_savedir(savedir, clear=True):
     if not os.path.exists(savedir):
         os.makedirs(savedir)
-    else:
+    elif clear:
         for filename in os.listdir(savedir):
             file_path = os.path.join(savedir, filename)
             if os.path.isfile(file_path) or os.path.islink(file_path):
@@ -37,233 +142,727 @@ def extract_images_and_metadata(
             elif os.path.isdir(file_path):
                 os.rmdir(file_path)
 
-    # Open PDF file
-    doc = fitz.open(pdffile)
-    metadata = {}
-
-    # Extract images and metadata from each page
-    for page_num, page in enumerate(doc):
-
-        # If you want to skip pages, use the following code
-        # if (page_num < 30):
-        #     continue
-        # if (page_num > 30):
-        #     break
 
-        # Convert page to image
-        pix = page.get_pixmap(dpi=200)
-        image_path = os.path.join(savedir, f"page_{page_num}_main.png")
-        pix.save(image_path)
-
-        # Extract images
-        images = page.get_images(full=True)
+# Metadata part file for a shard, one JSON line per metadata entry
+def metadata_part_file(savedir, shard=None):
+    index, count = shard if shard is not None else (0, 1)
+    return os.path.join(savedir, f"metadata.part-{index:03d}-of-{count:03d}.jsonl")
+
+
+def write_metadata_part(part, page_metadata):
+    for key, value in page_metadata.items():
+        part.write(json.dumps({"key": key, "metadata": value}, ensure_ascii=False) + "\n")
+    part.flush()
+
+
+def _boxes_near(a, b, gap):
+    return (a[0] - gap <= b[2] and b[0] - gap <= a[2] and
+            a[1] - gap <= b[3] and b[1] - gap <= a[3])
+
+
+def _union_box(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+# Cluster image boxes (x0, y0, x1, y1) into figure regions
+# - image boxes overlapping or within gap points of each other are merged
+# - drawing boxes within gap points of an image join its figure (axes, labels,
+#   connectors) and can bridge separate figures; drawings are only matched
+#   against the image boxes, never against a figure grown by other drawings,
+#   so chains of lines and table rules don't pull in the rest of the page
+# - drawings alone never form a figure
+# - drawings covering more than max_drawing_ratio of the page (backgrounds,
+#   frames) are ignored
+# - figures that still overlap after growing are merged
+# Returns merged boxes in reading order (top to bottom, left to right)
+def cluster_figure_regions(image_boxes, drawing_boxes=(), page_box=None, gap=10,
+                           max_drawing_ratio=0.5):
+    images = [tuple(box) for box in image_boxes]
+
+    drawings = []
+    page_area = None
+    if page_box is not None:
+        page_area = (page_box[2] - page_box[0]) * (page_box[3] - page_box[1])
+    for box in drawing_boxes:
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        if page_area and area > page_area * max_drawing_ratio:
+            continue
+        drawings.append(tuple(box))
+
+    # Group images: near each other, or touched by the same drawing
+    groups = list(range(len(images)))
+
+    def find(i):
+        while groups[i] != i:
+            groups[i] = groups[groups[i]]
+            i = groups[i]
+        return i
+
+    for i, box in enumerate(images):
+        for j in range(i):
+            if _boxes_near(box, images[j], gap):
+                groups[find(i)] = find(j)
+
+    touched = []
+    for drawing in drawings:
+        near = [i for i, box in enumerate(images) if _boxes_near(drawing, box, gap)]
+        for i in near[1:]:
+            groups[find(i)] = find(near[0])
+        if near:
+            touched.append((drawing, near[0]))
+
+    boxes = {}
+    for i, box in enumerate(images):
+        root = find(i)
+        boxes[root] = _union_box(boxes[root], box) if root in boxes else box
+    for drawing, i in touched:
+        root = find(i)
+        boxes[root] = _union_box(boxes[root], drawing)
+
+    # Merge grown figures that overlap
+    figures = list(boxes.values())
+    changed = True
+    while changed:
+        changed = False
+        merged = []
+        for box in figures:
+            for i, other in enumerate(merged):
+                if _boxes_near(box, other, 0):
+                    merged[i] = _union_box(box, other)
+                    changed = True
+                    break
+            else:
+                merged.append(box)
+        figures = merged
+
+    return sorted(figures, key=lambda box: (box[1], box[0]))
+
+
+def _box_area(box):
+    return max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+
+
+# Geometric same-as-page check for a sub-image region
+# True if the region covers at least same_ratio of the page, False if at most
+# distinct_ratio, None when ambiguous (resolved by the pixel check)
+def is_full_page_region(region_box, page_box, same_ratio=0.9, distinct_ratio=0.5):
+    ratio = _box_area(region_box) / _box_area(page_box)
+    if ratio >= same_ratio:
+        return True
+    if ratio <= distinct_ratio:
+        return False
+    return None
+
+
+# Difference hash of a pixmap, taken over its non-blank content so a crop
+# that only drops empty margins hashes like the full page
+def pixmap_dhash(pix, hash_size=16, blank_level=245):
+    from PIL import Image
+
+    gray = Image.frombytes("RGB", [pix.width, pix.height], pix.samples).convert("L")
+    content_box = gray.point(lambda value: 255 if value < blank_level else 0).getbbox()
+    if content_box:
+        gray = gray.crop(content_box)
+    pixels = list(gray.resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+# Fraction of differing bits between two hashes of hash_size x hash_size bits
+def hash_distance(a, b, hash_size=16):
+    return (a ^ b).bit_count() / (hash_size * hash_size)
+
+
+# Stream (key, entry) pairs of a metadata.json object, reading chunk by chunk,
+# so memory stays proportional to a single entry
+def iter_metadata_entries(metadata_file, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    with open(metadata_file, "r", encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+
+        def skip_whitespace():
+            nonlocal buffer, pos, eof
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return
+                buffer, pos = f.read(chunk_size), 0
+                eof = not buffer
+
+        def expect(chars):
+            skip_whitespace()
+            if pos >= len(buffer) or buffer[pos] not in chars:
+                raise ValueError(f"{metadata_file}: expected one of {chars!r} at offset {pos}")
+            return buffer[pos]
+
+        # Decode one JSON value, reading more while it is incomplete
+        def decode_value():
+            nonlocal buffer, pos, eof
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                more = f.read(chunk_size)
+                eof = not more
+                buffer, pos = buffer[pos:] + more, 0
+
+        expect("{")
+        pos += 1
+        if expect('}"') == "}":
+            return
+        while True:
+            key = decode_value()
+            expect(":")
+            pos += 1
+            yield key, decode_value()
+            separator = expect(",}")
+            pos += 1
+            if separator == "}":
+                return
+
+
+# Write (key, entry) pairs as a metadata.json object through a temporary file
+# in the same directory, replaced atomically; returns the number of entries
+def write_metadata_entries(metadata_file, entries):
+    metadata_dir = os.path.dirname(os.path.abspath(metadata_file))
+    fd, temp_file = tempfile.mkstemp(dir=metadata_dir, prefix=".metadata-")
+    count = 0
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write("{")
+            for key, entry in entries:
+                f.write("," if count else "")
+                f.write("\n    " + json.dumps(key, ensure_ascii=False) +
+                        ": " + json.dumps(entry, ensure_ascii=False))
+                count += 1
+            f.write("\n}\n")
+        os.replace(temp_file, metadata_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+    return count
+
+
+# Replace the entries of the given pages in metadata_file with the entries of
+# update_file (e.g. an incremental run over those pages); pages without new
+# entries are dropped. Both files are streamed.
+def replace_metadata_pages(metadata_file, update_file, page_numbers):
+    page_numbers = set(page_numbers)
+
+    def entries():
+        if os.path.exists(metadata_file):
+            for key, item in iter_metadata_entries(metadata_file):
+                if item["page"] not in page_numbers:
+                    yield key, item
+        if update_file is not None:
+            yield from iter_metadata_entries(update_file)
+
+    count = write_metadata_entries(metadata_file, entries())
+    logger.info(f"Replaced {len(page_numbers)} pages in {metadata_file} ({count} entries)")
+    return metadata_file
 
-        for img_index, img in enumerate(images):
-            xref = img[0]
-            logger.info(f"Page {page_num}, Image {img_index}: xref: {xref}")
-            base_image = doc.extract_image(xref)
 
-            if base_image:
-                try:
-                    # Extract image location and size information
-                    img_rects = page.get_image_rects(xref)
-                    if not img_rects:
-                        raise IndexError("No image rectangles found")
-                    # Actual image location in the page
-                    img_rect = img_rects[0]
-                except IndexError:
-                    logger.error(
-                        f"Page {page_num}, Image {img_index}: No location information")
-                    # Use the entire page as the image area
-                    img_rect = page.rect
-
-                # Original image width and height (size in PDF page)
-                pdf_width = img_rect.width
-                pdf_height = img_rect.height
-
-                # Actual image data size
-                image_width = base_image["width"]
-                image_height = base_image["height"]
-
-                logger.info(f"- PDF size: {pdf_width}x{pdf_height}")
-                logger.info(f"- Actual image size: {image_width}x{image_height}")  # noqa
-
-                # Check minimum size (based on actual image size)
-                if image_width < min_width or image_height < min_height:
-                    logger.info(f"Skipped (Minimum size not met)")
-                    continue
+# Delete the rendered images of the given pages from the save directory:
+# figure images always (a re-run may find fewer figures), page images too
+# unless keep_main
+def remove_page_files(savedir, page_numbers, keep_main=False):
+    prefixes = [f"page_{page_num}_img_" for page_num in page_numbers]
+    if not keep_main:
+        prefixes += [f"page_{page_num}_main." for page_num in page_numbers]
+    prefixes = tuple(prefixes)
+    if not os.path.isdir(savedir):
+        return 0
+    removed = 0
+    for filename in os.listdir(savedir):
+        if filename.startswith(prefixes):
+            os.unlink(os.path.join(savedir, filename))
+            removed += 1
+    logger.info(f"Removed {removed} image files of {len(page_numbers)} pages")
+    return removed
+
+
+# Merge metadata part files (from one or several hosts) into metadata.json
+# Entries are streamed so memory stays proportional to a single entry
+# Without part_files, the save directory must hold the parts of exactly one
+# shard count; parts of several runs (e.g. of-001 next to of-004) raise
+# ValueError instead of being mixed
+def merge_metadata_parts(savedir, part_files=None, metadata_file=None):
+    if part_files is None:
+        part_files = sorted(
+            os.path.join(savedir, filename) for filename in os.listdir(savedir)
+            if filename.startswith("metadata.part-") and filename.endswith(".jsonl"))
+    if metadata_file is None:
+        metadata_file = os.path.join(savedir, "metadata.json")
+
+    counts = {}
+    for part_file in part_files:
+        name = os.path.basename(part_file)
+        if not name.startswith("metadata.part-"):
+            continue
+        index, count = name[len("metadata.part-"):-len(".jsonl")].split("-of-")
+        counts.setdefault(int(count), set()).add(int(index))
+    if len(counts) > 1:
+        raise ValueError(f"Metadata parts of several shard counts {sorted(counts)} in "
+                         f"{savedir}; remove the stale ones before merging")
+
+    # Warn about missing shards
+    for count, indexes in counts.items():
+        missing = sorted(set(range(count)) - indexes)
+        if missing:
+            logger.warning(f"Missing metadata parts for shards {missing} of {count}")
+
+    def part_entries():
+        for part_file in part_files:
+            with open(part_file, "r", encoding="utf-8") as part:
+                for line in part:
+                    if line.strip():
+                        entry = json.loads(line)
+                        yield entry["key"], entry["metadata"]
+
+    entries = write_metadata_entries(metadata_file, part_entries())
+
+    logger.info(f"Merged {len(part_files)} metadata parts ({entries} entries) into {
+                metadata_file}")
+    return metadata_file
 
-                # Expand image area (left, right, bottom direction)
-                expanded_rect = fitz.Rect(
-                    img_rect.x0 - left_margin,
-                    img_rect.y0,
-                    img_rect.x1 + right_margin,
-                    img_rect.y1 + bottom_margin
-                )
 
-                # Adjust expanded area to fit within page range
-                page_rect = page.rect
-                expanded_rect = expanded_rect.intersect(page_rect)
+# Extract images and metadata
+# Experimental function
+# not for production use
+def extract_images_and_metadata(
+        pdffile, savedir,
+        min_width=100, min_height=100, left_margin=20, right_margin=20, bottom_margin=50,
+        dpi=150, page_range=None, shard=None, profiler=None):
 
-                # Extract high resolution image (expanded area)
-                pix = page.get_pixmap(matrix=fitz.Matrix(
-                    dpi/72, dpi/72), clip=expanded_rect)
-
-                # Convert to PIL image and save
-                pil_image = Image.frombytes(
-                    "RGB", [pix.width, pix.height], pix.samples)
-                image_filename = f"page_{page_num}_img_{
-                    img_index}_small.png"
-                image_path = os.path.join(savedir, image_filename)
-                pil_image.save(image_path, "PNG")
-                logger.info(f"Saved expanded high resolution image: {
-                            image_filename}")
+    # Create save directory and delete existing files
+    prepare_savedir(savedir, clear=page_range is None and shard is None)
 
-                # Save metadata
-                metadata[image_filename] = {
-                    "page": page_num,
-                    "image_text": "",
-                    "file_name": image_filename,
-                    "pdf_width": pdf_width,
-                    "pdf_height": pdf_height,
-                    "image_width": image_width,
-                    "image_height": image_height,
-                    "extracted_width": pix.width,
-                    "extracted_height": pix.height,
-                    "original_rect": {"x0": img_rect.x0, "y0": img_rect.y0, "x1": img_rect.x1, "y1": img_rect.y1},
-                    "expanded_rect": {"x0": expanded_rect.x0, "y0": expanded_rect.y0, "x1": expanded_rect.x1, "y1": expanded_rect.y1}
-                }
+    import fitz
+    from PIL import Image
 
-    metadata_file = os.path.join(savedir, "metadata.json")
-    with open(metadata_file, "w", encoding="utf-8") as metadata_file:
-        json.dump(metadata, metadata_file, ensure_ascii=False, indent=4)
+    # Open PDF file
+    doc = fitz.open(pdffile)
+    pages = select_pages(doc.page_count, page_range, shard)
+    part = open(metadata_part_file(savedir, shard), "w", encoding="utf-8")
 
+    # Extract images and metadata from each page
+    for page_num in pages:
+        with profiling.profile_page(profiler, page_num):
+            page = doc[page_num]
+            page_metadata = {}
+
+            # Convert page to image
+            pix = page.get_pixmap(dpi=200)
+            image_path = os.path.join(savedir, f"page_{page_num}_main.png")
+            pix.save(image_path)
+
+            # Extract images
+            images = page.get_images(full=True)
+
+            for img_index, img in enumerate(images):
+                xref = img[0]
+                logger.info(f"Page {page_num}, Image {img_index}: xref: {xref}")
+                base_image = doc.extract_image(xref)
+
+                if base_image:
+                    try:
+                        # Extract image location and size information
+                        img_rects = page.get_image_rects(xref)
+                        if not img_rects:
+                            raise IndexError("No image rectangles found")
+                        # Actual image location in the page
+                        img_rect = img_rects[0]
+                    except IndexError:
+                        logger.error(
+                            f"Page {page_num}, Image {img_index}: No location information")
+                        # Use the entire page as the image area
+                        img_rect = page.rect
+
+                    # Original image width and height (size in PDF page)
+                    pdf_width = img_rect.width
+                    pdf_height = img_rect.height
+
+                    # Actual image data size
+                    image_width = base_image["width"]
+                    image_height = base_image["height"]
+
+                    logger.info(f"- PDF size: {pdf_width}x{pdf_height}")
+                    logger.info(f"- Actual image size: {image_width}x{image_height}")  # noqa
+
+                    # Check minimum size (based on actual image size)
+                    if image_width < min_width or image_height < min_height:
+                        logger.info(f"Skipped (Minimum size not met)")
+                        continue
+
+                    # Expand image area (left, right, bottom direction)
+                    expanded_rect = fitz.Rect(
+                        img_rect.x0 - left_margin,
+                        img_rect.y0,
+                        img_rect.x1 + right_margin,
+                        img_rect.y1 + bottom_margin
+                    )
+
+                    # Adjust expanded area to fit within page range
+                    page_rect = page.rect
+                    expanded_rect = expanded_rect.intersect(page_rect)
+
+                    # Extract high resolution image (expanded area)
+                    pix = page.get_pixmap(matrix=fitz.Matrix(
+                        dpi/72, dpi/72), clip=expanded_rect)
+
+                    # Convert to PIL image and save
+                    pil_image = Image.frombytes(
+                        "RGB", [pix.width, pix.height], pix.samples)
+                    image_filename = f"page_{page_num}_img_{
+                        img_index}_small.png"
+                    image_path = os.path.join(savedir, image_filename)
+                    pil_image.save(image_path, "PNG")
+                    logger.info(f"Saved expanded high resolution image: {
+                                image_filename}")
+
+                    # Save metadata
+                    page_metadata[image_filename] = {
+                        "page": page_num,
+                        "image_text": "",
+                        "file_name": image_filename,
+                        "pdf_width": pdf_width,
+                        "pdf_height": pdf_height,
+                        "image_width": image_width,
+                        "image_height": image_height,
+                        "extracted_width": pix.width,
+                        "extracted_height": pix.height,
+                        "original_rect": {"x0": img_rect.x0, "y0": img_rect.y0, "x1": img_rect.x1, "y1": img_rect.y1},
+                        "expanded_rect": {"x0": expanded_rect.x0, "y0": expanded_rect.y0, "x1": expanded_rect.x1, "y1": expanded_rect.y1}
+                    }
+
+            # Append this page's metadata to the part file
+            write_metadata_part(part, page_metadata)
+
+    part.close()
     doc.close()
 
-    return metadata_file
+    if shard is not None:
+        return metadata_part_file(savedir, shard)
+    return merge_metadata_parts(savedir, [metadata_part_file(savedir)])
+
+
+# Document-level image index from one pass over the pages:
+# {xref: {"width", "height", "bpc", "colorspace", "smask",
+#         "pages": {page_num: [box, ...]}}}
+# Pixel sizes come from the get_images(full=True) tuple, so no image stream
+# is decoded for the size filter. Placement boxes come from one
+# get_image_info() per page, matched to xrefs by pixel size and bits per
+# component; xrefs that look alike that way on the same page are located by
+# name instead, or by MD5 digest (decoded once per xref and cached).
+def build_xref_index(doc, page_numbers=None):
+    index = {}
+    digests = {}
+    if page_numbers is None:
+        page_numbers = range(doc.page_count)
+
+    for page_num in page_numbers:
+        page = doc[page_num]
+        images = page.get_images(full=True)
+        if not images:
+            continue
+
+        by_shape = {}
+        for xref, smask, width, height, bpc, colorspace, *_ in images:
+            entry = index.setdefault(xref, {
+                "width": width, "height": height, "bpc": bpc,
+                "colorspace": colorspace, "smask": smask, "pages": {}})
+            entry["pages"].setdefault(page_num, [])
+            shape = by_shape.setdefault((width, height, bpc), [])
+            if xref not in shape:
+                shape.append(xref)
+
+        # Alike images drawn directly on the page are located by resource
+        # name from the content stream; only those inside form XObjects need
+        # their pixels hashed
+        hashed = []
+        for img in images:
+            if len(by_shape[(img[2], img[3], img[4])]) == 1 or img[0] in hashed:
+                continue
+            if img[-1] == 0:
+                bbox = page.get_image_bbox(img)
+                if not bbox.is_empty:
+                    index[img[0]]["pages"][page_num].append(tuple(bbox))
+                    continue
+            hashed.append(img[0])
+
+        by_digest = {}
+        if hashed:
+            import fitz
+
+            # Identical pixels in several xrefs share a digest; their
+            # placements are spread over them in drawing order
+            for xref in hashed:
+                if xref not in digests:
+                    digests[xref] = fitz.Pixmap(doc, xref).digest
+                by_digest.setdefault(digests[xref], []).append(xref)
+
+        for info in page.get_image_info(hashes=bool(hashed)):
+            xrefs = by_shape.get((info["width"], info["height"], info["bpc"]))
+            if not xrefs:
+                # Inline image, not an xref
+                continue
+            if len(xrefs) == 1:
+                xref = xrefs[0]
+            else:
+                alike = by_digest.get(info.get("digest"))
+                if not alike:
+                    continue
+                xref = min(alike, key=lambda xref: len(index[xref]["pages"][page_num]))
+            index[xref]["pages"][page_num].append(tuple(info["bbox"]))
+
+    return index
+
+
+# Stand-in for a truthy doc.extract_image(xref) without decoding the image:
+# an image XObject with a non-empty stream
+def _image_extractable(doc, xref):
+    if doc.xref_get_key(xref, "Subtype") != ("name", "/Image"):
+        return False
+    try:
+        return bool(doc.xref_stream_raw(xref))
+    except Exception:
+        return False
+
+
+# Figure regions of a page, as (x0, y0, x1, y1) boxes in reading order
+# Images below min_width x min_height actual pixels are skipped; the rest
+# (and, with merge_drawings, the vector drawings around them) are merged by
+# cluster_figure_regions so each figure is rendered and captioned once
+# - xref_index : build_xref_index() result, built for this page if not given
+# - max_xref_pages : images shown on more pages than this (logos,
+#   backgrounds) are ignored; needs an index over the whole document
+def find_figure_regions(doc, page, min_width=20, min_height=20, merge_gap=10,
+                        merge_drawings=True, xref_index=None, max_xref_pages=None):
+    page_num = page.number
+    # An xref listed twice on a page already has all its placements
+    xrefs = list(dict.fromkeys(img[0] for img in page.get_images(full=True)))
+    if xref_index is None or any(
+            page_num not in xref_index.get(xref, {}).get("pages", {}) for xref in xrefs):
+        xref_index = build_xref_index(doc, [page_num])
+    image_boxes = []
+
+    for img_index, xref in enumerate(xrefs):
+        entry = xref_index[xref]
+        logger.info(f"Page {page_num}, Image {img_index}: xref: {xref}")
+
+        # Repeated decoration shared across pages
+        if max_xref_pages is not None and len(entry["pages"]) > max_xref_pages:
+            logger.info(f"Skipped (Shown on {len(entry['pages'])} pages)")
+            continue
+
+        # Check minimum size (based on actual image size)
+        logger.info(f"- Actual image size: {entry['width']}x{entry['height']}")
+        if entry["width"] < min_width or entry["height"] < min_height:
+            logger.info(f"Skipped (Minimum size not met)")
+            continue
+
+        # Images that can't be extracted (checked once per xref)
+        if "extractable" not in entry:
+            entry["extractable"] = _image_extractable(doc, xref)
+        if not entry["extractable"]:
+            logger.info(f"Skipped (Image data not extractable)")
+            continue
+
+        # Image locations in the page; use the entire page if unknown
+        img_boxes = entry["pages"][page_num]
+        if not img_boxes:
+            logger.error(f"Page {page_num}, xref {xref}: No location information")
+            img_boxes = [tuple(page.rect)]
+        image_boxes.extend(img_boxes)
+
+    drawing_boxes = []
+    if merge_drawings and image_boxes:
+        drawing_boxes = [tuple(drawing["rect"]) for drawing in page.get_drawings()]
+    figures = cluster_figure_regions(
+        image_boxes, drawing_boxes, page_box=tuple(page.rect), gap=merge_gap)
+    logger.info(f"Page {page_num}: {len(image_boxes)} images merged into {
+                len(figures)} figures")
+    return figures
+
+
+# Expand a figure box left, right and down (captions sit below figures)
+# and clip it to the page; None if nothing of it lies on the page
+def expand_region(box, page_box, left_margin=20, right_margin=20, bottom_margin=50):
+    region = (max(box[0] - left_margin, page_box[0]),
+              max(box[1], page_box[1]),
+              min(box[2] + right_margin, page_box[2]),
+              min(box[3] + bottom_margin, page_box[3]))
+    if region[0] >= region[2] or region[1] >= region[3]:
+        return None
+    return region
 
 
 # Extract images, caption and metadata
 # Real user scenario
+# If batch_job (batchcaption.BatchJobWriter) is given, caption requests are
+# written to the batch job file instead of invoking the model, and metadata
+# entries carry a record_id until batchcaption.import_batch_results runs
+# page_range / shard limit the pages processed (see select_pages); a sharded
+# run returns its metadata part file, merge with merge_metadata_parts
+# metadata_file is where an unsharded run merges its metadata (default
+# savedir/metadata.json) and part_file the part it writes on the way (default
+# metadata_part_file(savedir, shard))
+# Image rects closer than merge_gap points (bridged by vector drawings when
+# merge_drawings is set) are captioned as one figure, see cluster_figure_regions
+# Entries carry doc_id, the page fingerprint and sub_index for deterministic ids
+# encoding_profile selects format/quality/dpi/color per rendition type
+# (see ENCODING_PROFILES); entries record the resulting media_type
+# profiler (lib.profiling.IngestionProfiler) measures memory per page
+# Sub-images that are really the whole page are skipped locally: regions
+# covering same_area_ratio of the page always, and regions between
+# distinct_area_ratio and same_area_ratio when their content hash is within
+# same_hash_distance of the page's. The model's <sameimage> tag stays as a
+# fallback for the rest.
 def extract_images_caption_and_metadata(
         pdffile, savedir,
         min_width=20, min_height=20, left_margin=20, right_margin=20, bottom_margin=50,
         dpi=150,
         bedrock_session=None,
-        bedrock_modelid=None):
+        bedrock_modelid=None,
+        batch_job=None,
+        page_range=None,
+        shard=None,
+        merge_gap=10,
+        merge_drawings=True,
+        encoding_profile="png",
+        profiler=None,
+        same_area_ratio=0.9,
+        distinct_area_ratio=0.5,
+        same_hash_distance=0.1,
+        max_xref_pages=None,
+        metadata_file=None,
+        part_file=None):
 
     # Create save directory and delete existing files
-    if not os.path.exists(savedir):
-        os.makedirs(savedir)
-    else:
-        for filename in os.listdir(savedir):
-            file_path = os.path.join(savedir, filename)
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                os.rmdir(file_path)
+    prepare_savedir(savedir, clear=page_range is None and shard is None)
+
+    import fitz
 
     # Open PDF file
     doc = fitz.open(pdffile)
-    metadata = {}
-
-    # Extract images and metadata from each page
-    metadata = {}
-    metadata_file = os.path.join(savedir, "metadata.json")
-
-    for page_num, page in enumerate(doc):
-
-        # If you want to skip pages, use the following code
-        # if (page_num < 30):
-        #     continue
-        # if (page_num > 30):
-        #     break
-
-        # Convert page to image
-        pix = page.get_pixmap(dpi=dpi)
-        image_main = os.path.join(savedir, f"page_{page_num}_main.png")
-        pix.save(image_main)
-
-        # Extract text from image using bedrock
-        main_extracted_text = bedrock.extract_text_from_image_using_bedrock(
-            bedrock_session, bedrock_modelid, image_main)
-        logger.info(f"Main extracted text: {main_extracted_text}")
-
-        metadata[image_main] = {
-            "page": page_num,
-            "type": "main",
-            "file_name": image_main,
-            "image_text": main_extracted_text,
-        }
-
-        # Extract images
-        images = page.get_images(full=True)
+    pages = select_pages(doc.page_count, page_range, shard)
+    doc_id = document_id(pdffile)
+    main_profile = get_encoding_profile(encoding_profile, "main")
+    sub_profile = get_encoding_profile(encoding_profile, "sub")
 
-        for img_index, img in enumerate(images):
-            xref = img[0]
-            logger.info(f"Page {page_num}, Image {img_index}: xref: {xref}")
-            base_image = doc.extract_image(xref)
+    # Image sizes and placements for all selected pages in one pass (the
+    # whole document when repeated images are filtered, so every shard
+    # counts the same pages)
+    with profiling.profile_stage(profiler, "xref_index"):
+        xref_index = build_xref_index(doc, pages if max_xref_pages is None else None)
 
-            if base_image:
-                try:
-                    # Extract image location and size information
-                    img_rects = page.get_image_rects(xref)
-                    if not img_rects:
-                        raise IndexError("No image rectangles found")
-                    # Actual image location in the page
-                    img_rect = img_rects[0]
-                except IndexError:
-                    logger.error(
-                        f"Page {page_num}, Image {img_index}: No location information")
-                    # Use the entire page as the image area
-                    img_rect = page.rect
-
-                # Original image width and height (size in PDF page)
-                pdf_width = img_rect.width
-                pdf_height = img_rect.height
-
-                # Actual image data size
-                image_width = base_image["width"]
-                image_height = base_image["height"]
-
-                logger.info(f"- PDF size: {pdf_width}x{pdf_height}")
-                logger.info(f"- Actual image size: {image_width}x{image_height}")  # noqa
-
-                # Check minimum size (based on actual image size)
-                if image_width < min_width or image_height < min_height:
-                    logger.info(f"Skipped (Minimum size not met)")
+    # Extract images and metadata from each page
+    if part_file is None:
+        part_file = metadata_part_file(savedir, shard)
+    part = open(part_file, "w", encoding="utf-8")
+
+    for page_num in pages:
+        with profiling.profile_page(profiler, page_num):
+            page = doc[page_num]
+            page_metadata = {}
+            fingerprint = page_fingerprint(doc, page)
+
+            # Convert page to image
+            main_pix = page.get_pixmap(dpi=main_profile["dpi"] or dpi)
+            image_main, main_media_type = save_rendition(
+                main_pix, os.path.join(savedir, f"page_{page_num}_main"), main_profile)
+            page_hash = None
+
+            # Extract text from image using bedrock
+            if batch_job is not None:
+                main_record_id = batchcaption.main_record_id(page_num)
+                batch_job.add_record(main_record_id, bedrock.build_text_extraction_body(
+                    bedrock.read_image_base64(image_main), main_media_type))
+                main_extracted_text = ""
+            else:
+                main_extracted_text = bedrock.extract_text_from_image_using_bedrock(
+                    bedrock_session, bedrock_modelid, image_main)
+                logger.info(f"Main extracted text: {main_extracted_text}")
+
+            page_metadata[image_main] = {
+                "page": page_num,
+                "type": "main",
+                "file_name": image_main,
+                "image_text": main_extracted_text,
+                "media_type": main_media_type,
+                "doc_id": doc_id,
+                "fingerprint": fingerprint,
+            }
+            if batch_job is not None:
+                page_metadata[image_main]["record_id"] = main_record_id
+
+            # Figure regions: size-filtered images merged with nearby drawings
+            figures = find_figure_regions(doc, page, min_width, min_height,
+                                          merge_gap, merge_drawings, xref_index, max_xref_pages)
+
+            for img_index, figure_box in enumerate(figures):
+                page_rect = page.rect
+                region = expand_region(
+                    figure_box, tuple(page_rect), left_margin, right_margin, bottom_margin)
+                if region is None:
+                    logger.info(f"Skipped (Region outside the page)")
                     continue
+                expanded_rect = fitz.Rect(region)
 
-                # Expand image area (left, right, bottom direction)
-                expanded_rect = fitz.Rect(
-                    img_rect.x0 - left_margin,
-                    img_rect.y0,
-                    img_rect.x1 + right_margin,
-                    img_rect.y1 + bottom_margin
-                )
-
-                # Adjust expanded area to fit within page range
-                page_rect = page.rect
-                expanded_rect = expanded_rect.intersect(page_rect)
+                # Skip regions that are the whole page without a model call
+                is_same_image = is_full_page_region(
+                    tuple(expanded_rect), tuple(page_rect), same_area_ratio, distinct_area_ratio)
+                if is_same_image:
+                    logger.info(f"Skipped (Region covers the page)")
+                    continue
 
                 # Extract high resolution image (expanded area)
+                sub_dpi = sub_profile["dpi"] or dpi
                 pix = page.get_pixmap(matrix=fitz.Matrix(
-                    dpi/72, dpi/72), clip=expanded_rect)
-
-                # Convert to PIL image and save
-                pil_image = Image.frombytes(
-                    "RGB", [pix.width, pix.height], pix.samples)
-                subimage_filename = f"page_{page_num}_img_{
-                    img_index}_small.png"
-                image_sub = os.path.join(savedir, subimage_filename)
-                pil_image.save(image_sub, "PNG")
-                logger.info(f"Saved expanded high resolution image: {
-                            subimage_filename}")
-
-                is_same_image, sub_extracted_text = bedrock.extract_structured_text_from_image_using_bedrock(
-                    bedrock_session, bedrock_modelid, image_main, image_sub)
-                logger.info(f"Is same image: {is_same_image}")
-                logger.info(f"Sub extracted text: {sub_extracted_text}")
+                    sub_dpi/72, sub_dpi/72), clip=expanded_rect)
+
+                # Ambiguous size: compare the crop's content with the page raster
+                if is_same_image is None:
+                    if page_hash is None:
+                        page_hash = pixmap_dhash(main_pix)
+                    distance = hash_distance(pixmap_dhash(pix), page_hash)
+                    logger.info(f"Hash distance to page: {distance:.3f}")
+                    if distance <= same_hash_distance:
+                        logger.info(f"Skipped (Same content as page)")
+                        continue
+
+                # Encode and save
+                image_sub, sub_media_type = save_rendition(
+                    pix, os.path.join(savedir, f"page_{page_num}_img_{img_index}_small"),
+                    sub_profile)
+                logger.info(f"Saved expanded high resolution image: {image_sub}")
+
+                if batch_job is not None:
+                    # Same-image check is resolved when the results are imported
+                    sub_record_id = batchcaption.sub_record_id(page_num, img_index)
+                    batch_job.add_record(sub_record_id, bedrock.build_structured_text_body(
+                        bedrock.read_image_base64(image_main),
+                        bedrock.read_image_base64(image_sub),
+                        main_media_type, sub_media_type))
+                    is_same_image, sub_extracted_text = False, ""
+                else:
+                    is_same_image, sub_extracted_text = bedrock.extract_structured_text_from_image_using_bedrock(
+                        bedrock_session, bedrock_modelid, image_main, image_sub)
+                    logger.info(f"Is same image: {is_same_image}")
+                    logger.info(f"Sub extracted text: {sub_extracted_text}")
 
                 # Check if image is same with main image
                 if is_same_image:
@@ -271,17 +870,25 @@ def extract_images_caption_and_metadata(
                     continue
 
                 # Save metadata
-                metadata[image_sub] = {
+                page_metadata[image_sub] = {
                     "page": page_num,
                     "type": "sub",
                     "file_name": image_sub,
                     "image_text": sub_extracted_text,
+                    "media_type": sub_media_type,
+                    "doc_id": doc_id,
+                    "fingerprint": fingerprint,
+                    "sub_index": img_index,
                 }
+                if batch_job is not None:
+                    page_metadata[image_sub]["record_id"] = sub_record_id
 
-        # Update metadata.json file after processing each page
-        with open(metadata_file, "w", encoding="utf-8") as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=4)
+            # Append this page's metadata to the part file after processing each page
+            write_metadata_part(part, page_metadata)
 
+    part.close()
     doc.close()
 
-    return metadata_file
+    if shard is not None:
+        return part_file
+    return merge_metadata_parts(savedir, [part_file], metadata_file)
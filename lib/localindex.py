@@ -0,0 +1,205 @@
+# Local in-memory stand-in for the OpenSearch index
+# Used by benchmarks and local stubs; not for production use
+import logging
+import math
+import re
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class LocalIndex:
+
+    # coarse_dimensions: size of the random projection used to emulate
+    # approximate (HNSW-like) candidate selection before exact rescoring
+    def __init__(self, dimensions=1024, coarse_dimensions=32, default_ef_search=100, seed=0):
+        self.dimensions = dimensions
+        self.default_ef_search = default_ef_search
+        self.documents = {}
+        self._ids = []
+        self._vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self._coarse = np.zeros((0, coarse_dimensions), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        self._projection = rng.standard_normal(
+            (dimensions, coarse_dimensions)).astype(np.float32)
+
+    def __len__(self):
+        return len(self.documents)
+
+    # Index (or overwrite) a document, returns its id
+    def index(self, document, doc_id=None):
+        if doc_id is None:
+            doc_id = uuid.uuid4().hex
+        if doc_id in self.documents:
+            self.delete(doc_id)
+
+        self.documents[doc_id] = document
+        self._ids.append(doc_id)
+
+        vector = document.get("content_vector")
+        if vector is None:
+            vector = np.zeros(self.dimensions, dtype=np.float32)
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        self._vectors = np.vstack([self._vectors, vector])
+        self._coarse = np.vstack([self._coarse, vector @ self._projection])
+        return doc_id
+
+    # Index (id, document) pairs with one append of the vector arrays
+    def index_many(self, documents):
+        vectors = []
+        for doc_id, document in documents:
+            if doc_id in self.documents:
+                self.delete(doc_id)
+            self.documents[doc_id] = document
+            self._ids.append(doc_id)
+            vector = document.get("content_vector")
+            vectors.append(np.zeros(self.dimensions, dtype=np.float32) if vector is None
+                           else np.asarray(vector, dtype=np.float32))
+        if not vectors:
+            return
+        vectors = np.vstack(vectors)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = np.divide(vectors, norms, out=vectors, where=norms > 0)
+        self._vectors = np.vstack([self._vectors, vectors])
+        self._coarse = np.vstack([self._coarse, vectors @ self._projection])
+
+    def get(self, doc_id):
+        return self.documents.get(doc_id)
+
+    def delete(self, doc_id):
+        if doc_id not in self.documents:
+            return False
+        position = self._ids.index(doc_id)
+        del self.documents[doc_id]
+        del self._ids[position]
+        self._vectors = np.delete(self._vectors, position, axis=0)
+        self._coarse = np.delete(self._coarse, position, axis=0)
+        return True
+
+    # Execute an OpenSearch query body and return a response-like dict
+    def search(self, body):
+        size = body.get("size", 10)
+        excludes = body.get("_source", {}).get("excludes", [])
+
+        scored = self._execute(body.get("query", {"match_all": {}}))
+        scored = scored[:size]
+
+        hits = []
+        for position, score in scored:
+            doc_id = self._ids[position]
+            source = {key: value for key, value in self.documents[doc_id].items()
+                      if key not in excludes}
+            hits.append({"_id": doc_id, "_score": float(score), "_source": source})
+
+        return {"hits": {"total": {"value": len(hits)}, "hits": hits}}
+
+    def _execute(self, query):
+        if "knn" in query:
+            return self._knn(query["knn"])
+        if "bool" in query:
+            return self._bool(query["bool"])
+        if "match_all" in query:
+            return [(position, 1.0) for position in range(len(self._ids))]
+        if "term" in query:
+            mask = self._filter_mask(query)
+            return [(position, 1.0) for position in np.flatnonzero(mask)]
+        raise ValueError(f"Unsupported query: {list(query.keys())}")
+
+    # Boolean query with post-filter semantics: knn returns its global top-k,
+    # then term clauses drop non-matching hits (the pre-efficient-filter behaviour)
+    def _bool(self, bool_query):
+        clauses = bool_query.get("must", []) + bool_query.get("filter", [])
+        scored = None
+        mask = np.ones(len(self._ids), dtype=bool)
+        for clause in clauses:
+            if "knn" in clause:
+                scored = self._knn(clause["knn"])
+            elif "match" in clause:
+                scored = self._match(clause["match"])
+            else:
+                mask &= self._filter_mask(clause)
+        if scored is None:
+            return [(position, 1.0) for position in np.flatnonzero(mask)]
+        return [(position, score) for position, score in scored if mask[position]]
+
+    def _filter_mask(self, clause):
+        if "term" not in clause:
+            raise ValueError(f"Unsupported filter: {list(clause.keys())}")
+        field, value = next(iter(clause["term"].items()))
+        if isinstance(value, dict):
+            value = value["value"]
+        return np.array([self.documents[doc_id].get(field) == value
+                         for doc_id in self._ids], dtype=bool)
+
+    # Approximate kNN: pick ef_search candidates by coarse projected score,
+    # rescore them exactly and return the top k (efficient filter applied first)
+    def _knn(self, knn_query):
+        field, params = next(iter(knn_query.items()))
+        if field != "content_vector":
+            raise ValueError(f"Unsupported knn field: {field}")
+
+        k = params["k"]
+        ef_search = params.get("method_parameters", {}).get(
+            "ef_search", self.default_ef_search)
+        ef_search = max(ef_search, k)
+
+        candidates = np.arange(len(self._ids))
+        if "filter" in params:
+            candidates = candidates[self._filter_mask(params["filter"])]
+        if len(candidates) == 0:
+            return []
+
+        vector = np.asarray(params["vector"], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+
+        if len(candidates) > ef_search:
+            coarse_scores = self._coarse[candidates] @ (vector @ self._projection)
+            keep = np.argpartition(-coarse_scores, ef_search - 1)[:ef_search]
+            candidates = candidates[keep]
+
+        # cosinesimil score as reported by OpenSearch: (1 + cos) / 2
+        scores = (1.0 + self._vectors[candidates] @ vector) / 2.0
+        order = np.argsort(-scores)[:k]
+        return [(int(candidates[i]), float(scores[i])) for i in order]
+
+    # BM25 over a simple word tokenizer (stands in for the nori analyzer)
+    def _match(self, match_query, k1=1.2, b=0.75):
+        field, params = next(iter(match_query.items()))
+        if isinstance(params, dict):
+            params = params["query"]
+        terms = set(_tokenize(params))
+
+        tokenized = [_tokenize(str(self.documents[doc_id].get(field, "")))
+                     for doc_id in self._ids]
+        if not tokenized:
+            return []
+        average_length = sum(len(tokens) for tokens in tokenized) / len(tokenized) or 1.0
+        document_frequency = {term: sum(1 for tokens in tokenized if term in tokens)
+                              for term in terms}
+
+        scored = []
+        for position, tokens in enumerate(tokenized):
+            score = 0.0
+            for term in terms:
+                frequency = tokens.count(term)
+                if frequency == 0:
+                    continue
+                idf = math.log(1 + (len(tokenized) - document_frequency[term] + 0.5) /
+                               (document_frequency[term] + 0.5))
+                score += idf * frequency * (k1 + 1) / (
+                    frequency + k1 * (1 - b + b * len(tokens) / average_length))
+            if score > 0:
+                scored.append((position, score))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored
+
+
+def _tokenize(text):
+    return re.findall(r"\w+", text.lower())
@@ -1,77 +1,308 @@
 import base64
 import json
-import requests
-from requests.auth import HTTPBasicAuth
 import logging
+import time
 
 import lib.bedrock as bedrock
-import lib.logging_config as logging_config
+import lib.contextpack as contextpack
+import lib.extractpdf as extractpdf
+import lib.profiling as profiling
 
 logger = logging.getLogger(__name__)
 
+# Pooled HTTP session shared by all OpenSearch requests in the process
+# requests is imported on first use to keep module import cheap
+_http_session = None
 
+
+# pool_maxsize sizes the connection pool; it only applies on first creation
+def get_http_session(pool_maxsize=None):
+    global _http_session
+    if _http_session is None:
+        import requests
+
+        _http_session = requests.Session()
+        if pool_maxsize is not None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+    return _http_session
+
+
+# Index metadata entries; entries with a doc_id are upserted by deterministic id
+# Returns the ids of the indexed documents
+# profiler (lib.profiling.IngestionProfiler) measures memory per entry
 def insert_metadata_to_opensearch(metadata_file, bedrock_session,
                                   opensearch_endpoint, index_name,
-                                  username, password):
-    with open(metadata_file, 'r', encoding='utf-8') as f:
-        metadatas = json.load(f)
+                                  username, password, profiler=None):
+    indexed_ids = []
+    for file_name, item in extractpdf.iter_metadata_entries(metadata_file):
+        with profiling.profile_page(profiler, file_name):
+
+            # Extract page number
+            item_page_number = item['page']
+
+            # Extract image path
+            item_image_file_name = file_name
+
+            # Extract image text
+            item_text = item['image_text']
+
+            # Extract image type
+            item_type = item['type']
+
+            logger.info(f"item_page_number: {item_page_number}")
+            logger.info(f"item_image_file_name: {item_image_file_name}")
+            logger.info(f"item_text: {item_text}")
+            logger.info(f"item_type: {item_type}")
+
+            # 이미지 데이터를 base64로 인코딩
+            with open(item_image_file_name, "rb") as image_file:
+                image_data = image_file.read()
+
+            embedding = bedrock.get_text_vector(bedrock_session, item_text)
+
+            # 문서 생성
+            document = {
+                "page_number": int(item_page_number),
+                "image_file_name": item_image_file_name,
+                "text": item_text,
+                "image_type": item_type,
+                "image": base64.b64encode(image_data).decode('utf-8'),
+                "media_type": item.get('media_type') or contextpack.detect_media_type(image_data),
+            }
+            if embedding is not None:
+                document["content_vector"] = embedding
 
-    documents = []
-    for file_name, item in metadatas.items():
+            # Deterministic id and page fingerprint for incremental re-indexing
+            if 'doc_id' in item:
+                document["doc_id"] = item['doc_id']
+                document["fingerprint"] = item['fingerprint']
 
-        # Extract page number
-        item_page_number = item['page']
+            # logger.info(f"document: {document}")
 
-        # Extract image path
-        item_image_file_name = file_name
+            # 문서 인덱싱
+            if 'doc_id' in item:
+                # Upsert by deterministic id
+                doc_id = document_entry_id(item['doc_id'], item_page_number, item.get('sub_index'))
+                doc_url = f"{opensearch_endpoint}/{index_name}/_doc/{doc_id}"
+                response = get_http_session().put(doc_url, auth=(
+                    username, password), json=document)
+            else:
+                doc_url = f"{opensearch_endpoint}/{index_name}/_doc"
+                response = get_http_session().post(doc_url, auth=(
+                    username, password), json=document)
 
-        # Extract image text
-        item_text = item['image_text']
+            # 결과 출력
+            logger.info(f"Document indexing status: {response.status_code}")
+            logger.info(f"Response: {response.json()}")
+            if response.status_code in (200, 201):
+                indexed_ids.append(response.json().get('_id'))
 
-        # Extract image type
-        item_type = item['type']
+    return indexed_ids
 
-        logger.info(f"item_page_number: {item_page_number}")
-        logger.info(f"item_image_file_name: {item_image_file_name}")
-        logger.info(f"item_text: {item_text}")
-        logger.info(f"item_type: {item_type}")
 
-        # 이미지 데이터를 base64로 인코딩
-        with open(item_image_file_name, "rb") as image_file:
-            image_data = image_file.read()
+# Deterministic OpenSearch id: document hash + page + sub-image index
+def document_entry_id(doc_id, page_number, sub_index=None):
+    if sub_index is None:
+        return f"{doc_id}-p{int(page_number):05d}-main"
+    return f"{doc_id}-p{int(page_number):05d}-s{int(sub_index):03d}"
 
-        embedding = bedrock.get_text_vector(bedrock_session, item_text)
 
-        # 문서 생성
-        document = {
-            "page_number": int(item_page_number),
-            "image_file_name": item_image_file_name,
-            "text": item_text,
-            "image_type": item_type,
-            "image": base64.b64encode(image_data).decode('utf-8'),
+# Page fingerprints stored in the index for a document: {page_number: fingerprint}
+def get_indexed_fingerprints(doc_id, opensearch_endpoint, index_name,
+                             username, password, max_documents=10000):
+    query_url = f"{opensearch_endpoint}/{index_name}/_search"
+    query_body = {
+        "size": max_documents,
+        "_source": ["page_number", "fingerprint"],
+        "query": {
+            "bool": {
+                "filter": [
+                    {"term": {"doc_id": doc_id}},
+                    {"term": {"image_type": "main"}}
+                ]
+            }
+        }
+    }
+    hits = search_opensearch(query_url, username, password, query_body)
+    if hits is None:
+        return None
+
+    return {hit['_source']['page_number']: hit['_source'].get('fingerprint')
+            for hit in hits}
+
+
+# Delete a document's entries on the given pages, except the ids in keep_ids
+def delete_pages_from_opensearch(doc_id, page_numbers, opensearch_endpoint, index_name,
+                                 username, password, keep_ids=()):
+    if not page_numbers:
+        return 0
+
+    query_body = {
+        "query": {
+            "bool": {
+                "filter": [
+                    {"term": {"doc_id": doc_id}},
+                    {"terms": {"page_number": sorted(page_numbers)}}
+                ],
+                "must_not": [
+                    {"ids": {"values": list(keep_ids)}}
+                ]
+            }
         }
-        if embedding is not None:
-            document["content_vector"] = embedding
+    }
+    deleted = delete_by_query(query_body, opensearch_endpoint, index_name, username, password)
+    logger.info(f"Deleted {deleted} documents on {len(page_numbers)} pages")
+    return deleted
+
 
-        # logger.info(f"document: {document}")
+# Page numbers whose main entry is among the given deterministic ids
+def main_entry_pages(entry_ids):
+    pages = set()
+    for entry_id in entry_ids:
+        if entry_id and entry_id.endswith("-main"):
+            _, _, page = entry_id[:-len("-main")].rpartition("-p")
+            if page.isdigit():
+                pages.add(int(page))
+    return sorted(pages)
 
-        # 문서 인덱싱 URL
-        doc_url = f"{opensearch_endpoint}/{index_name}/_doc"
 
-        # 문서 인덱싱
-        response = requests.post(doc_url, auth=HTTPBasicAuth(
-            username, password), json=document)
+# Delete entries of images under image_prefix (a save directory) on the given
+# pages that were indexed before doc_id: auto-id documents without a doc_id,
+# and documents of an older document id scheme. Pass only pages whose current
+# entries were just upserted (see main_entry_pages), so pages that were not
+# re-inserted keep their legacy entries.
+def delete_legacy_entries(doc_id, image_prefix, page_numbers, opensearch_endpoint,
+                          index_name, username, password):
+    if not page_numbers:
+        return 0
 
-        # 결과 출력
-        logger.info(f"Document indexing status: {response.status_code}")
-        logger.info(f"Response: {response.json()}")
+    query_body = {
+        "query": {
+            "bool": {
+                "filter": [
+                    # image_file_name is dynamically mapped (text + keyword)
+                    {"prefix": {"image_file_name.keyword": image_prefix}},
+                    {"terms": {"page_number": sorted(page_numbers)}}
+                ],
+                "must_not": [
+                    {"term": {"doc_id": doc_id}}
+                ]
+            }
+        }
+    }
+    deleted = delete_by_query(query_body, opensearch_endpoint, index_name, username, password)
+    if deleted:
+        logger.info(f"Deleted {deleted} legacy documents on {len(page_numbers)} pages "
+                    f"under {image_prefix}")
+    return deleted
+
+
+# Run a _delete_by_query request; returns the number of deleted documents
+def delete_by_query(query_body, opensearch_endpoint, index_name, username, password):
+    delete_url = f"{opensearch_endpoint}/{index_name}/_delete_by_query?refresh=true"
+    response = get_http_session().post(delete_url, auth=(
+        username, password), json=query_body)
+    logger.info(f"Delete by query status: {response.status_code}")
+    if response.status_code != 200:
+        logger.error(f"Error response: {response.text}")
+        return 0
+    return response.json().get('deleted', 0)
+
+
+# Query-time method_parameters (ef_search) need OpenSearch 2.16+
+METHOD_PARAMETERS_MIN_VERSION = (2, 16)
+# Seconds a failed version lookup is remembered before the next attempt
+CLUSTER_VERSION_RETRY_SECONDS = 30
+_cluster_versions = {}
+_cluster_version_failures = {}
+
+
+# Cluster version as a tuple of ints; None if unknown
+# Only a parsed version is cached for good. A failed lookup (non-200 during a
+# restart, auth error, network error) is retried after
+# CLUSTER_VERSION_RETRY_SECONDS, so neither is ef_search dropped for the rest
+# of the process nor does every query pay an extra GET / meanwhile.
+def get_cluster_version(opensearch_endpoint, username, password):
+    if opensearch_endpoint in _cluster_versions:
+        return _cluster_versions[opensearch_endpoint]
+    failed_at = _cluster_version_failures.get(opensearch_endpoint)
+    if failed_at is not None and time.monotonic() - failed_at < CLUSTER_VERSION_RETRY_SECONDS:
+        return None
+
+    try:
+        response = get_http_session().get(f"{opensearch_endpoint}/", auth=(username, password))
+        if response.status_code != 200:
+            raise ValueError(f"status {response.status_code}")
+        number = response.json()["version"]["number"]
+        version = tuple(int(part) for part in number.split("-")[0].split("."))
+    except Exception as e:
+        logger.error(f"Error reading cluster version: {e}")
+        _cluster_version_failures[opensearch_endpoint] = time.monotonic()
+        return None
+
+    _cluster_version_failures.pop(opensearch_endpoint, None)
+    _cluster_versions[opensearch_endpoint] = version
+    return version
+
+
+# ef_search if the cluster accepts it in the query, otherwise None
+def supported_ef_search(ef_search, opensearch_endpoint, username, password):
+    if ef_search is None:
+        return None
+    version = get_cluster_version(opensearch_endpoint, username, password)
+    if version is None or version < METHOD_PARAMETERS_MIN_VERSION:
+        logger.warning(f"ef_search ignored: cluster version {version} does not support "
+                       f"query-time method_parameters")
+        return None
+    return ef_search
+
+
+# Build kNN query body with efficient (engine-level) filtering
+# - filter is evaluated inside the knn clause, so `size` hits of `image_type`
+#   are returned instead of filtering the global top-k afterwards; this needs
+#   a lucene (2.4+) or faiss (2.9+) HNSW field, see the mapping in readme.md
+# - ef_search sets the HNSW candidate list size (recall vs latency); only
+#   pass it for clusters that support it (supported_ef_search)
+def build_knn_query(vector_query, image_type, size=5, k=None, ef_search=None):
+    if k is None:
+        k = size
+    if k < size:
+        logger.warning(f"k ({k}) is smaller than size ({size}), using k={size}")
+        k = size
+
+    knn_clause = {
+        "vector": vector_query,
+        "k": k,
+        "filter": {
+            "term": {
+                "image_type": image_type
+            }
+        }
+    }
+    if ef_search is not None:
+        knn_clause["method_parameters"] = {"ef_search": ef_search}
+
+    return {
+        "size": size,
+        "_source": {"excludes": ["content_vector"]},
+        "query": {
+            "knn": {
+                "content_vector": knn_clause
+            }
+        }
+    }
 
 
 def query_imagesearch_to_opensearch(query, query_type, doc_count=5, bedrock_session=None,
                                     opensearch_endpoint=None, index_name=None,
-                                    username=None, password=None):
+                                    username=None, password=None,
+                                    k=None, ef_search=None, vector_query=None,
+                                    with_ids=False):
     logger.info(f"Starting query_imagesearch_to_opensearch with query: {
-                query}, doc_count: {doc_count}")
+                query}, doc_count: {doc_count}, k: {k}, ef_search: {ef_search}")
 
     if (opensearch_endpoint is None or
             index_name is None or username is None or
@@ -82,7 +313,7 @@ def query_imagesearch_to_opensearch(query, query_type, doc_count=5, bedrock_sess
         logger.error(f"index_name: {index_name}")
         logger.error(f"username: {username}")
         logger.error(f"password: {password}")
-        return [], []
+        return ([], [], []) if with_ids else ([], [])
 
     # Set OpenSearch endpoint and index name
     logger.info(f"OpenSearch endpoint: {opensearch_endpoint}")
@@ -97,82 +328,303 @@ def query_imagesearch_to_opensearch(query, query_type, doc_count=5, bedrock_sess
     logger.info(f"Query URL: {query_url}")
 
     # Query body
-    vector_query = bedrock.get_text_vector(bedrock_session, query)
+    if vector_query is None:
+        vector_query = bedrock.get_text_vector(bedrock_session, query)
     logger.info(f"Vector query generated: {len(vector_query)} dimensions")
     if (query_type == "imagesearch"):
-        query_body = {
-            "size": doc_count,
-            "_source": {"excludes": ["content_vector"]},
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "term": {
-                                "image_type": "sub"
-                            }
-                        },
-                        {
-                            "knn": {
-                                "content_vector": {
-                                    "vector": vector_query,
-                                    "k": 5
-                                }
-                            }
-                        }
-                    ]
-                }
-            }
-        }
+        image_type = "sub"
     else:
-        query_body = {
-            "size": doc_count,
-            "_source": {"excludes": ["content_vector"]},
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "term": {
-                                "image_type": "main"
-                            }
-                        },
-                        {
-                            "knn": {
-                                "content_vector": {
-                                    "vector": vector_query,
-                                    "k": 5
-                                }
+        image_type = "main"
+    ef_search = supported_ef_search(ef_search, opensearch_endpoint, username, password)
+    query_body = build_knn_query(
+        vector_query, image_type, size=doc_count, k=k, ef_search=ef_search)
+    # logger.info(f"Query body: {json.dumps(query_body, indent=2)}")
+
+    hits = search_opensearch(query_url, username, password, query_body)
+    if hits is None:
+        return ([], [], []) if with_ids else ([], [])
+
+    return extract_images_and_contents(hits, with_ids)
+
+
+# Build BM25 query body on the nori-analyzed page text
+def build_match_query(query, image_type, size=10, analyzer="nori_analyzer"):
+    return {
+        "size": size,
+        "_source": {"excludes": ["content_vector"]},
+        "query": {
+            "bool": {
+                "must": [
+                    {
+                        "match": {
+                            "text": {
+                                "query": query,
+                                "analyzer": analyzer
                             }
                         }
-                    ]
-                }
+                    }
+                ],
+                "filter": [
+                    {
+                        "term": {
+                            "image_type": image_type
+                        }
+                    }
+                ]
             }
         }
-    # logger.info(f"Query body: {json.dumps(query_body, indent=2)}")
+    }
+
+
+# Fuse ranked hit lists into a single ranking
+# - rrf : reciprocal rank fusion, sum of weight / (rank_constant + rank)
+# - normalized : min-max normalized scores combined with weights
+# Returns list of (hit, score) sorted by fused score
+def fuse_hits(hit_lists, weights=None, method="rrf", rank_constant=60):
+    if weights is None:
+        weights = [1.0] * len(hit_lists)
+
+    fused = {}
+    hits_by_id = {}
+    for hits, weight in zip(hit_lists, weights):
+        if not hits:
+            continue
+        scores = [hit['_score'] for hit in hits]
+        low, high = min(scores), max(scores)
+        for rank, hit in enumerate(hits, 1):
+            if method == "rrf":
+                score = weight / (rank_constant + rank)
+            elif method == "normalized":
+                if high > low:
+                    score = weight * (hit['_score'] - low) / (high - low)
+                else:
+                    score = weight
+            else:
+                raise ValueError(f"Unknown fusion method: {method}")
+            fused[hit['_id']] = fused.get(hit['_id'], 0.0) + score
+            hits_by_id.setdefault(hit['_id'], hit)
+
+    ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+    return [(hits_by_id[hit_id], score) for hit_id, score in ranked]
+
+
+# Hybrid retrieval: nori BM25 match + kNN vector query, fused and cut
+# - candidate_count : hits fetched from each retriever before fusion
+# - doc_count : maximum number of pages returned
+# - score_threshold : drop fused hits scoring below this fraction of the top hit
+#   (normalized fusion only, default 0.5; RRF scores depend on ranks alone, so
+#   a fraction of the top RRF score says nothing about relevance)
+# - min_retrievers : with RRF, hits must be returned by at least this many
+#   retrievers (both by default, capped at the ones that returned hits); the
+#   top fused hit is always kept
+def query_hybrid_to_opensearch(query, query_type, doc_count=3, bedrock_session=None,
+                               opensearch_endpoint=None, index_name=None,
+                               username=None, password=None,
+                               candidate_count=10, fusion="rrf",
+                               vector_weight=1.0, text_weight=1.0,
+                               score_threshold=None, min_retrievers=2,
+                               k=None, ef_search=None,
+                               vector_query=None, with_ids=False):
+    logger.info(f"Starting query_hybrid_to_opensearch with query: {
+                query}, doc_count: {doc_count}, fusion: {fusion}")
+
+    if (opensearch_endpoint is None or
+            index_name is None or username is None or
+            password is None):
+        logger.error(
+            "opensearch_endpoint, index_name, username, password must be provided")
+        return ([], [], []) if with_ids else ([], [])
+
+    query_url = f"{opensearch_endpoint}/{index_name}/_search"
+    if (query_type == "imagesearch"):
+        image_type = "sub"
+    else:
+        image_type = "main"
+
+    if vector_query is None:
+        vector_query = bedrock.get_text_vector(bedrock_session, query)
+    ef_search = supported_ef_search(ef_search, opensearch_endpoint, username, password)
+    vector_hits = search_opensearch(query_url, username, password, build_knn_query(
+        vector_query, image_type, size=candidate_count, k=k, ef_search=ef_search))
+    text_hits = search_opensearch(query_url, username, password, build_match_query(
+        query, image_type, size=candidate_count))
 
-    # HTTP request
-    response = requests.get(query_url, auth=HTTPBasicAuth(
+    if vector_hits is None and text_hits is None:
+        return ([], [], []) if with_ids else ([], [])
+
+    ranked = fuse_hits([vector_hits or [], text_hits or []],
+                       weights=[vector_weight, text_weight], method=fusion)
+    if not ranked:
+        return ([], [], []) if with_ids else ([], [])
+
+    if fusion == "normalized":
+        if score_threshold is None:
+            score_threshold = 0.5
+        top_score = ranked[0][1]
+        hits = [hit for hit, score in ranked[:doc_count]
+                if score >= top_score * score_threshold]
+    else:
+        if score_threshold is not None:
+            logger.warning(f"score_threshold is ignored with {fusion} fusion")
+        found_by = [{hit['_id'] for hit in hits}
+                    for hits in (vector_hits, text_hits) if hits]
+        required = min(min_retrievers, len(found_by))
+        hits = [hit for rank, (hit, score) in enumerate(ranked)
+                if rank == 0 or sum(hit['_id'] in ids for ids in found_by) >= required]
+        hits = hits[:doc_count]
+    logger.info(f"Hybrid candidates: vector {len(vector_hits or [])}, text {
+                len(text_hits or [])}, fused {len(ranked)}, kept {len(hits)}")
+
+    return extract_images_and_contents(hits, with_ids)
+
+
+# Run a search request and return the hits, or None on error
+def search_opensearch(query_url, username, password, query_body):
+    response = get_http_session().get(query_url, auth=(
         username, password), json=query_body)
     logger.info(f"Response status code: {response.status_code}")
 
-    # Process response
     if response.status_code == 200:
         response_json = response.json()
         # logger.info(f"Response JSON: {json.dumps(response_json, indent=2)}")
-        images = []
-        contents = []
-        for hit in response_json['hits']['hits']:
-            # Extract image binary
-            image_binary = hit['_source']['image']
-            images.append(image_binary)
-            # Extract content
-            content = hit['_source']['text']
-            contents.append(content)
-
-        logger.info(f"Number of images retrieved: {len(images)}")
-        logger.info(f"Number of contents retrieved: {len(contents)}")
-        return images, contents
+        return response_json['hits']['hits']
     else:
         logger.error(f"Error in OpenSearch query. Status code: {
                      response.status_code}")
         logger.error(f"Error response: {response.text}")
-        return [], []
+        return None
+
+
+# Returns (images, contents), plus the hit ids when with_ids is set
+def extract_images_and_contents(hits, with_ids=False):
+    images = []
+    contents = []
+    ids = [hit['_id'] for hit in hits]
+    for hit in hits:
+        # Extract image binary, decoded once and its base64 form memoized
+        image_base64 = hit['_source']['image']
+        image_binary = base64.b64decode(image_base64)
+        bedrock.remember_image_base64(image_binary, image_base64)
+        images.append(image_binary)
+        # Extract content
+        content = hit['_source']['text']
+        contents.append(content)
+
+    logger.info(f"Number of images retrieved: {len(images)}")
+    logger.info(f"Number of contents retrieved: {len(contents)}")
+    if with_ids:
+        return images, contents, ids
+    return images, contents
+
+
+# Index generation: changes whenever documents are indexed or deleted
+# Used to invalidate caches built on search results
+def get_index_generation(opensearch_endpoint, index_name, username, password):
+    stats_url = f"{opensearch_endpoint}/{index_name}/_stats/indexing,docs"
+    try:
+        response = get_http_session().get(stats_url, auth=(username, password))
+    except Exception as e:
+        logger.error(f"Error reading index stats: {e}")
+        return None
+    if response.status_code != 200:
+        logger.error(f"Error reading index stats. Status code: {response.status_code}")
+        return None
+
+    primaries = response.json()['_all']['primaries']
+    return (primaries['indexing']['index_total'],
+            primaries['indexing']['delete_total'],
+            primaries['docs']['count'])
+
+
+# Iterate over all documents of an index with the scroll API
+# Yields hits ({"_id", "_source"}) in batches of batch_size per request
+def scan_opensearch(opensearch_endpoint, index_name, username, password,
+                    batch_size=500, scroll="2m"):
+    session = get_http_session()
+    response = session.post(
+        f"{opensearch_endpoint}/{index_name}/_search?scroll={scroll}",
+        auth=(username, password),
+        json={"size": batch_size, "sort": ["_doc"], "query": {"match_all": {}}})
+    response.raise_for_status()
+    response_json = response.json()
+    scroll_id = response_json.get('_scroll_id')
+    try:
+        while response_json['hits']['hits']:
+            yield from response_json['hits']['hits']
+            response = session.post(
+                f"{opensearch_endpoint}/_search/scroll", auth=(username, password),
+                json={"scroll": scroll, "scroll_id": scroll_id})
+            response.raise_for_status()
+            response_json = response.json()
+            scroll_id = response_json.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id:
+            session.delete(f"{opensearch_endpoint}/_search/scroll",
+                           auth=(username, password), json={"scroll_id": scroll_id})
+
+
+# Index (id, document) pairs with one _bulk request
+# Returns the number of documents indexed; failed items are logged
+def bulk_index_opensearch(documents, opensearch_endpoint, index_name, username, password):
+    lines = []
+    for doc_id, document in documents:
+        lines.append(json.dumps({"index": {"_index": index_name, "_id": doc_id}}))
+        lines.append(json.dumps(document, ensure_ascii=False))
+    if not lines:
+        return 0
+
+    response = get_http_session().post(
+        f"{opensearch_endpoint}/_bulk", auth=(username, password),
+        data=("\n".join(lines) + "\n").encode('utf-8'),
+        headers={"Content-Type": "application/x-ndjson"})
+    response.raise_for_status()
+    response_json = response.json()
+
+    failed = [item['index'] for item in response_json['items']
+              if item['index'].get('error')]
+    for item in failed[:5]:
+        logger.error(f"Bulk item {item['_id']} failed: {item['error']}")
+    if failed:
+        logger.error(f"{len(failed)} of {len(response_json['items'])} bulk items failed")
+    return len(response_json['items']) - len(failed)
+
+
+# Index mappings and the settings needed to recreate it (knn, analysis)
+def get_index_definition(opensearch_endpoint, index_name, username, password):
+    session = get_http_session()
+    response = session.get(f"{opensearch_endpoint}/{index_name}", auth=(username, password))
+    response.raise_for_status()
+    definition = response.json()[index_name]
+    index_settings = definition['settings']['index']
+    return {
+        "settings": {"index": {key: index_settings[key]
+                               for key in ("knn", "analysis") if key in index_settings}},
+        "mappings": definition['mappings'],
+    }
+
+
+# Create the index from a definition unless it exists; returns True if created
+def create_index(opensearch_endpoint, index_name, username, password, definition):
+    session = get_http_session()
+    index_url = f"{opensearch_endpoint}/{index_name}"
+    if session.head(index_url, auth=(username, password)).status_code == 200:
+        return False
+    response = session.put(index_url, auth=(username, password), json=definition)
+    response.raise_for_status()
+    logger.info(f"Created index {index_name}")
+    return True
+
+
+# Set index.refresh_interval, returns the previous value (None = default)
+def set_refresh_interval(opensearch_endpoint, index_name, username, password, interval):
+    session = get_http_session()
+    settings_url = f"{opensearch_endpoint}/{index_name}/_settings"
+    response = session.get(f"{settings_url}/index.refresh_interval",
+                           auth=(username, password))
+    response.raise_for_status()
+    previous = response.json()[index_name]['settings'].get(
+        'index', {}).get('refresh_interval')
+    response = session.put(settings_url, auth=(username, password),
+                           json={"index": {"refresh_interval": interval}})
+    response.raise_for_status()
+    return previous
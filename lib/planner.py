@@ -0,0 +1,214 @@
+# Dry-run ingestion planner
+# Opens PDFs locally and projects the Bedrock calls, tokens, wall time and
+# index / storage size of insert_pdfpages_to_opensearch.py without calling
+# any external service. Figure detection, the same-as-page geometry check
+# and the encoding profiles are the ones extraction uses.
+import math
+import os
+import tempfile
+
+import lib.bedrock as bedrock
+import lib.contextpack as contextpack
+import lib.conversation as conversation
+import lib.extractpdf as extractpdf
+
+# Index size model per document: base64 image and caption in _source, the
+# vector both in _source (JSON floats) and in the knn engine (float32 plus
+# HNSW links)
+VECTOR_SOURCE_BYTES_PER_DIMENSION = 12
+VECTOR_ENGINE_BYTES_PER_DIMENSION = 4
+HNSW_BYTES_PER_VECTOR = 16 * 8
+CAPTION_BYTES_PER_TOKEN = 4
+
+
+def _render_size(box, dpi):
+    return (max(1, round((box[2] - box[0]) * dpi / 72)),
+            max(1, round((box[3] - box[1]) * dpi / 72)))
+
+
+def _prompt_tokens(body):
+    return sum(conversation.estimate_text_tokens(block["text"])
+               for message in body["messages"] for block in message["content"]
+               if block["type"] == "text")
+
+
+# Encoded bytes per pixel of a profile, measured on a few rendered regions
+def _bytes_per_pixel(doc, regions, profile, dpi):
+    if not regions:
+        return 0.0
+    import fitz
+
+    total_bytes = total_pixels = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        for index, (page_num, box) in enumerate(regions):
+            render_dpi = profile["dpi"] or dpi
+            pix = doc[page_num].get_pixmap(
+                matrix=fitz.Matrix(render_dpi / 72, render_dpi / 72), clip=fitz.Rect(box))
+            image_path, _ = extractpdf.save_rendition(
+                pix, os.path.join(workdir, f"sample_{index}"), profile)
+            total_bytes += os.path.getsize(image_path)
+            total_pixels += pix.width * pix.height
+    return total_bytes / total_pixels
+
+
+# Per-document counts: pages, figure regions and their render sizes
+# sample_pages pages (and their figures) are rendered and encoded locally to
+# estimate stored bytes; 0 skips sampling
+def plan_document(pdffile, dpi=150, encoding_profile="png", min_width=20, min_height=20,
+                  left_margin=20, right_margin=20, bottom_margin=50, merge_gap=10,
+                  merge_drawings=True, same_area_ratio=0.9, distinct_area_ratio=0.5,
+                  sample_pages=3, max_xref_pages=None):
+    import fitz
+
+    main_profile = extractpdf.get_encoding_profile(encoding_profile, "main")
+    sub_profile = extractpdf.get_encoding_profile(encoding_profile, "sub")
+    main_dpi = main_profile["dpi"] or dpi
+    sub_dpi = sub_profile["dpi"] or dpi
+
+    doc = fitz.open(pdffile)
+    xref_index = extractpdf.build_xref_index(doc)
+    pages = []
+    for page in doc:
+        page_box = tuple(page.rect)
+        figures = extractpdf.find_figure_regions(
+            doc, page, min_width, min_height, merge_gap, merge_drawings,
+            xref_index, max_xref_pages)
+        subs, ambiguous, skipped = [], 0, 0
+        for figure_box in figures:
+            region = extractpdf.expand_region(
+                figure_box, page_box, left_margin, right_margin, bottom_margin)
+            if region is None:
+                continue
+            same = extractpdf.is_full_page_region(
+                region, page_box, same_area_ratio, distinct_area_ratio)
+            if same:
+                skipped += 1
+                continue
+            ambiguous += same is None
+            subs.append(region)
+        pages.append({
+            "page": page.number,
+            "page_box": page_box,
+            "main_size": _render_size(page_box, main_dpi),
+            "sub_boxes": subs,
+            "sub_sizes": [_render_size(box, sub_dpi) for box in subs],
+            "ambiguous": ambiguous,
+            "skipped_full_page": skipped,
+        })
+
+    # Evenly spaced sample pages for the encoded size estimate
+    step = max(1, len(pages) // sample_pages) if sample_pages else 0
+    sampled = pages[::step][:sample_pages] if step else []
+    main_bpp = _bytes_per_pixel(
+        doc, [(page["page"], page["page_box"]) for page in sampled], main_profile, dpi)
+    sub_bpp = _bytes_per_pixel(
+        doc, [(page["page"], box) for page in sampled for box in page["sub_boxes"][:2]],
+        sub_profile, dpi) or main_bpp
+    doc.close()
+
+    return {
+        "pdffile": pdffile,
+        "pages": pages,
+        "main_bytes_per_pixel": main_bpp,
+        "sub_bytes_per_pixel": sub_bpp,
+    }
+
+
+# Project calls, tokens, time, size (and cost when prices are given) for plans
+# - output_tokens : assumed caption length per vision call
+# - seconds_per_call / seconds_per_embedding : assumed latencies
+# - concurrency : parallel vision calls
+# - requests_per_minute / tokens_per_minute : quota bound on wall time
+def project(plans, output_tokens=300, seconds_per_call=8.0, seconds_per_embedding=0.3,
+            concurrency=1, dimensions=1024, requests_per_minute=None,
+            tokens_per_minute=None, input_price_per_mtok=None, output_price_per_mtok=None):
+    main_prompt = _prompt_tokens(bedrock.build_text_extraction_body(""))
+    sub_prompt = _prompt_tokens(bedrock.build_structured_text_body("", ""))
+
+    totals = {"documents": len(plans), "pages": 0, "sub_images": 0, "ambiguous": 0,
+              "skipped_full_page": 0, "input_tokens": 0, "image_tokens": 0,
+              "stored_bytes": 0}
+    for plan in plans:
+        for page in plan["pages"]:
+            main_tokens = contextpack.estimate_image_tokens(*page["main_size"])
+            main_bytes = page["main_size"][0] * page["main_size"][1] * plan["main_bytes_per_pixel"]
+            totals["pages"] += 1
+            totals["image_tokens"] += main_tokens
+            totals["input_tokens"] += main_tokens + main_prompt
+            totals["stored_bytes"] += main_bytes
+            for width, height in page["sub_sizes"]:
+                sub_tokens = contextpack.estimate_image_tokens(width, height)
+                totals["sub_images"] += 1
+                totals["image_tokens"] += main_tokens + sub_tokens
+                totals["input_tokens"] += main_tokens + sub_tokens + sub_prompt
+                totals["stored_bytes"] += width * height * plan["sub_bytes_per_pixel"]
+            totals["ambiguous"] += page["ambiguous"]
+            totals["skipped_full_page"] += page["skipped_full_page"]
+
+    vision_calls = totals["pages"] + totals["sub_images"]
+    entries = vision_calls
+    output_total = vision_calls * output_tokens
+
+    caption_seconds = vision_calls * seconds_per_call / max(1, concurrency)
+    if requests_per_minute:
+        caption_seconds = max(caption_seconds, vision_calls / requests_per_minute * 60)
+    if tokens_per_minute:
+        caption_seconds = max(caption_seconds,
+                              (totals["input_tokens"] + output_total) / tokens_per_minute * 60)
+    # Embeddings run one at a time in insert_metadata_to_opensearch
+    insert_seconds = entries * seconds_per_embedding
+
+    index_bytes = (totals["stored_bytes"] * 4 / 3 +
+                   entries * (dimensions * (VECTOR_SOURCE_BYTES_PER_DIMENSION +
+                                            VECTOR_ENGINE_BYTES_PER_DIMENSION) +
+                              HNSW_BYTES_PER_VECTOR +
+                              output_tokens * CAPTION_BYTES_PER_TOKEN))
+
+    projection = {
+        **totals,
+        "stored_bytes": round(totals["stored_bytes"]),
+        "vision_calls": vision_calls,
+        "embedding_calls": entries,
+        "output_tokens": output_total,
+        "embedding_tokens": output_total,
+        "caption_seconds": caption_seconds,
+        "insert_seconds": insert_seconds,
+        "wall_seconds": caption_seconds + insert_seconds,
+        "index_bytes": round(index_bytes),
+        "concurrency": concurrency,
+    }
+    if input_price_per_mtok is not None and output_price_per_mtok is not None:
+        projection["cost"] = (totals["input_tokens"] * input_price_per_mtok +
+                              output_total * output_price_per_mtok) / 1e6
+    return projection
+
+
+def _format_duration(seconds):
+    hours, rest = divmod(int(math.ceil(seconds)), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s"
+
+
+def format_projection(projection):
+    mb = 1024 * 1024
+    lines = [
+        f"documents          : {projection['documents']}",
+        f"pages              : {projection['pages']}",
+        f"sub-images         : {projection['sub_images']} "
+        f"({projection['ambiguous']} may still be skipped by the pixel check, "
+        f"{projection['skipped_full_page']} full-page regions skipped)",
+        f"vision calls       : {projection['vision_calls']}",
+        f"embedding calls    : {projection['embedding_calls']}",
+        f"input tokens       : {projection['input_tokens']} "
+        f"({projection['image_tokens']} image)",
+        f"output tokens      : {projection['output_tokens']} (assumed)",
+        f"captioning time    : {_format_duration(projection['caption_seconds'])} "
+        f"at concurrency {projection['concurrency']}",
+        f"indexing time      : {_format_duration(projection['insert_seconds'])}",
+        f"total time         : {_format_duration(projection['wall_seconds'])}",
+        f"stored images      : {projection['stored_bytes'] / mb:.1f} MB",
+        f"index size         : {projection['index_bytes'] / mb:.1f} MB",
+    ]
+    if "cost" in projection:
+        lines.append(f"estimated cost     : ${projection['cost']:.2f}")
+    return "\n".join(lines)
@@ -0,0 +1,162 @@
+# Opt-in memory profiling for ingestion
+# Records RSS, peak RSS and tracemalloc peak / top allocators per stage
+# (extract, insert, ...) and per page, and writes a JSON report.
+# tracemalloc only sees Python allocations (e.g. pix.samples copies, base64
+# strings); MuPDF and PIL buffers show up in RSS only.
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+# Current resident set size in bytes, None where /proc is not available
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Peak resident set size of the process in bytes
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _mb(value):
+    return "n/a" if value is None else f"{value / MB:.1f} MB"
+
+
+def _top_allocators(snapshot, previous, top_n):
+    stats = snapshot.compare_to(previous, "lineno")
+    return [{
+        "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+        "size_diff": stat.size_diff,
+        "size": stat.size,
+        "count_diff": stat.count_diff,
+    } for stat in stats[:top_n] if stat.size_diff > 0]
+
+
+# - top_n : allocators kept per stage / page (0 disables snapshots)
+# - page_snapshots : take tracemalloc snapshots per page as well as per stage
+#   (slower on large documents)
+class IngestionProfiler:
+
+    def __init__(self, top_n=10, page_snapshots=True, frames=1):
+        self.top_n = top_n
+        self.page_snapshots = page_snapshots
+        self.stages = []
+        self.pages = []
+        self._stage = None
+        self._open = []
+        self._snapshot_filter = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def _snapshot(self):
+        if not self.top_n:
+            return None
+        return tracemalloc.take_snapshot().filter_traces(self._snapshot_filter)
+
+    @contextlib.contextmanager
+    def _measure(self, record, snapshots):
+        before = self._snapshot() if snapshots else None
+        rss_before = current_rss()
+        tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        self._open.append(record)
+        try:
+            yield record
+        finally:
+            self._open.pop()
+            traced_after, traced_peak = tracemalloc.get_traced_memory()
+            # Nested measurements reset the peak; take the highest of theirs
+            traced_peak = max(traced_peak, record.pop("_nested_peak", 0))
+            if self._open:
+                outer = self._open[-1]
+                outer["_nested_peak"] = max(outer.get("_nested_peak", 0), traced_peak)
+            rss_after = current_rss()
+            record.update({
+                "seconds": round(time.perf_counter() - start, 3),
+                "rss": rss_after,
+                "rss_diff": rss_after - rss_before if rss_after is not None else None,
+                "peak_rss": peak_rss(),
+                "traced_diff": traced_after - traced_before,
+                "traced_peak": traced_peak,
+                "traced_peak_diff": traced_peak - traced_before,
+            })
+            if before is not None:
+                record["top_allocators"] = _top_allocators(
+                    self._snapshot(), before, self.top_n)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {"stage": name}
+        self.stages.append(record)
+        outer, self._stage = self._stage, name
+        try:
+            with self._measure(record, snapshots=True):
+                yield record
+        finally:
+            self._stage = outer
+            logger.info(f"[profile] stage {name}: rss {_mb(record['rss'])}, "
+                        f"peak rss {_mb(record['peak_rss'])}, "
+                        f"traced peak {_mb(record['traced_peak'])}")
+
+    @contextlib.contextmanager
+    def page(self, page_num):
+        record = {"stage": self._stage, "page": page_num}
+        self.pages.append(record)
+        with self._measure(record, snapshots=self.page_snapshots):
+            yield record
+
+    def report(self):
+        return {
+            "peak_rss": peak_rss(),
+            "stages": self.stages,
+            "pages": self.pages,
+            "largest_pages": sorted(
+                self.pages, key=lambda page: page["traced_peak_diff"], reverse=True)[:self.top_n],
+        }
+
+    def write_report(self, report_file):
+        report = self.report()
+        with open(report_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+        logger.info(f"Memory profile written to {report_file} "
+                    f"(peak rss {_mb(report['peak_rss'])})")
+        return report
+
+    def stop(self):
+        tracemalloc.stop()
+
+
+# Measure one page (a loop body) when a profiler is given; used as a
+# context manager so the record closes even on break or error
+def profile_page(profiler, page_num):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.page(page_num)
+
+
+def profile_stage(profiler, name):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
@@ -0,0 +1,199 @@
+# Shared Bedrock quota scheduler
+# Token buckets for requests/min and tokens/min are kept in a JSON state file
+# guarded by an fcntl lock on a companion .lock file, so ingestion and serving processes on one host
+# draw from the same account quota. Priority classes:
+# - interactive : served first, may use the whole bucket
+# - batch : waits while any interactive caller is queued and leaves
+#   interactive_reserve of each bucket for interactive calls
+# Callers of the same class are served in arrival order.
+import contextlib
+import fcntl
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = ("interactive", "batch")
+
+# Waiters not seen for this long (crashed processes) are dropped from the queue
+WAITER_TIMEOUT = 10.0
+
+
+def default_state_file():
+    return os.path.join(tempfile.gettempdir(), "bedrock_quota.json")
+
+
+class QuotaScheduler:
+
+    def __init__(self, requests_per_minute, tokens_per_minute, state_file=None,
+                 interactive_reserve=0.2, poll_interval=0.05, max_poll_interval=1.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.state_file = state_file or default_state_file()
+        self.interactive_reserve = interactive_reserve
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._counter = itertools.count()
+
+    def _initial_state(self, now):
+        return {
+            "requests": float(self.requests_per_minute),
+            "tokens": float(self.tokens_per_minute),
+            "updated": now,
+            "waiters": {},
+            "stats": {priority: {"acquired": 0, "wait_total": 0.0, "wait_max": 0.0,
+                                 "last_wait": 0.0} for priority in PRIORITIES},
+        }
+
+    # Shared state, or a fresh one if missing or unreadable
+    def _read_state(self, now):
+        try:
+            with open(self.state_file, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return self._initial_state(now)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Quota state {self.state_file} unreadable ({e}), starting fresh")
+            return self._initial_state(now)
+
+    # Replace the state file atomically, so a crash never leaves it partial
+    def _write_state(self, state):
+        state_dir = os.path.dirname(os.path.abspath(self.state_file))
+        fd, temp_file = tempfile.mkstemp(dir=state_dir, prefix=".quota-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(json.dumps(state))
+            os.replace(temp_file, self.state_file)
+        except BaseException:
+            os.unlink(temp_file)
+            raise
+
+    # Read, refill and (on success) write back the shared state under the lock
+    @contextlib.contextmanager
+    def _locked_state(self):
+        with open(self.state_file + ".lock", "a", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                state = self._read_state(now)
+
+                elapsed = max(0.0, now - state["updated"])
+                state["requests"] = min(float(self.requests_per_minute),
+                                        state["requests"] + elapsed * self.requests_per_minute / 60)
+                state["tokens"] = min(float(self.tokens_per_minute),
+                                      state["tokens"] + elapsed * self.tokens_per_minute / 60)
+                state["updated"] = now
+                state["waiters"] = {
+                    waiter_id: waiter for waiter_id, waiter in state["waiters"].items()
+                    if now - waiter["heartbeat"] < WAITER_TIMEOUT}
+
+                yield state
+
+                self._write_state(state)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _reserve(self, priority):
+        if priority == "interactive":
+            return 0.0, 0.0
+        return (self.requests_per_minute * self.interactive_reserve,
+                self.tokens_per_minute * self.interactive_reserve)
+
+    # Seconds until the bucket could serve this caller, 0 if it can go now
+    def _wait_time(self, state, waiter_id, priority, tokens):
+        waiters = state["waiters"]
+        me = waiters[waiter_id]
+        for other_id, other in waiters.items():
+            if other_id == waiter_id:
+                continue
+            if priority == "batch" and other["priority"] == "interactive":
+                return self.poll_interval
+            if other["priority"] == priority and \
+                    (other["since"], other_id) < (me["since"], waiter_id):
+                return self.poll_interval
+
+        reserve_requests, reserve_tokens = self._reserve(priority)
+        missing_requests = reserve_requests + 1 - state["requests"]
+        missing_tokens = reserve_tokens + tokens - state["tokens"]
+        return max(0.0,
+                   missing_requests * 60 / self.requests_per_minute,
+                   missing_tokens * 60 / self.tokens_per_minute)
+
+    # Block until a request of `tokens` estimated tokens may be sent
+    # Returns the seconds waited
+    def acquire(self, tokens, priority="interactive"):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        # A request larger than the bucket could never be served otherwise
+        tokens = min(tokens, self.tokens_per_minute * (1 - self.interactive_reserve))
+        waiter_id = f"{os.getpid()}-{threading.get_ident()}-{next(self._counter)}"
+        start = time.time()
+
+        try:
+            while True:
+                with self._locked_state() as state:
+                    waiter = state["waiters"].setdefault(
+                        waiter_id, {"priority": priority, "since": start})
+                    waiter["heartbeat"] = state["updated"]
+
+                    wait_time = self._wait_time(state, waiter_id, priority, tokens)
+                    if wait_time == 0:
+                        state["requests"] -= 1
+                        state["tokens"] -= tokens
+                        del state["waiters"][waiter_id]
+                        waited = state["updated"] - start
+                        stats = state["stats"][priority]
+                        stats["acquired"] += 1
+                        stats["wait_total"] += waited
+                        stats["wait_max"] = max(stats["wait_max"], waited)
+                        stats["last_wait"] = waited
+                        break
+                time.sleep(min(max(wait_time, self.poll_interval), self.max_poll_interval))
+        except BaseException:
+            with self._locked_state() as state:
+                state["waiters"].pop(waiter_id, None)
+            raise
+
+        if waited > 1.0:
+            logger.info(f"Quota wait ({priority}): {waited:.1f}s for {tokens} tokens")
+        return waited
+
+    # Return the difference between the reserved and the actual token count
+    def settle(self, reserved_tokens, actual_tokens):
+        with self._locked_state() as state:
+            state["tokens"] = min(float(self.tokens_per_minute),
+                                  state["tokens"] + reserved_tokens - actual_tokens)
+
+    # Queue depth per priority, wait statistics and current bucket levels
+    def stats(self):
+        with self._locked_state() as state:
+            queue_depth = {priority: 0 for priority in PRIORITIES}
+            for waiter in state["waiters"].values():
+                queue_depth[waiter["priority"]] += 1
+            return {
+                "queue_depth": queue_depth,
+                "requests_available": round(state["requests"], 2),
+                "tokens_available": round(state["tokens"]),
+                "waits": {priority: {
+                    **stats,
+                    "wait_avg": stats["wait_total"] / stats["acquired"] if stats["acquired"] else 0.0,
+                } for priority, stats in state["stats"].items()},
+            }
+
+
+# Scheduler configured by BEDROCK_REQUESTS_PER_MINUTE / BEDROCK_TOKENS_PER_MINUTE
+# (and optionally BEDROCK_QUOTA_STATE_FILE); None when no limits are set
+def scheduler_from_env():
+    requests_per_minute = os.getenv("BEDROCK_REQUESTS_PER_MINUTE")
+    tokens_per_minute = os.getenv("BEDROCK_TOKENS_PER_MINUTE")
+    if not requests_per_minute or not tokens_per_minute:
+        return None
+    return QuotaScheduler(
+        int(requests_per_minute), int(tokens_per_minute),
+        state_file=os.getenv("BEDROCK_QUOTA_STATE_FILE") or None,
+        interactive_reserve=float(os.getenv("BEDROCK_QUOTA_INTERACTIVE_RESERVE", "0.2")))
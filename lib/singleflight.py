@@ -0,0 +1,130 @@
+# Single-flight call coalescing
+# Concurrent calls with the same key share one execution: the first caller
+# (the leader) runs the function, later callers wait for its result or
+# exception instead of issuing their own call. Keys are only held while a
+# call is in flight, so this is not a cache. Works across threads and
+# asyncio; a coroutine may join a call led by a thread and the reverse.
+# Every caller receives the same result object, so treat it as read-only.
+# If an async leader is cancelled, its waiters start the call again.
+import functools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_RETRY = object()
+
+
+class _Call:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.futures = []
+        self.waiters = 0
+        self.result = None
+        self.error = None
+        self.retry = False
+
+
+class SingleFlight:
+
+    def __init__(self, name="singleflight"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {"calls": 0, "executed": 0, "coalesced": 0, "errors": 0,
+                       "max_waiters": 0}
+
+    # Register a caller; returns (call, is_leader)
+    def _join(self, key, future=None):
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self._stats["executed"] += 1
+                return call, True
+            call.waiters += 1
+            if future is not None:
+                call.futures.append(future)
+            self._stats["coalesced"] += 1
+            self._stats["max_waiters"] = max(self._stats["max_waiters"], call.waiters)
+            return call, False
+
+    def _finish(self, key, call, result=None, error=None, retry=False):
+        with self._lock:
+            del self._calls[key]
+            if error is not None:
+                self._stats["errors"] += 1
+            futures = call.futures
+        call.result, call.error, call.retry = result, error, retry
+        call.event.set()
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_resolve, future, call)
+        if call.waiters:
+            logger.debug(f"{self.name}: {call.waiters} callers shared one call")
+
+    # Run fn(*args, **kwargs) unless the same key is already in flight
+    def do(self, key, fn, *args, **kwargs):
+        call, leader = self._join(key)
+        while not leader:
+            call.event.wait()
+            if call.retry:
+                call, leader = self._join(key)
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, call, error=e)
+            raise
+        self._finish(key, call, result=result)
+        return result
+
+    # Async variant: coroutine functions are awaited, plain functions run in
+    # the executor (default: the loop's) so the event loop is not blocked
+    async def do_async(self, key, fn, *args, executor=None, **kwargs):
+        # asyncio is imported here so thread-only users don't load it
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        call, leader = self._join(key, (loop, future))
+        while not leader:
+            result = await future
+            if result is not _RETRY:
+                return result
+            future = loop.create_future()
+            call, leader = self._join(key, (loop, future))
+
+        try:
+            if asyncio.iscoroutinefunction(fn):
+                result = await fn(*args, **kwargs)
+            else:
+                result = await loop.run_in_executor(
+                    executor, functools.partial(fn, *args, **kwargs))
+        except BaseException as e:
+            self._finish(key, call, error=e, retry=isinstance(e, asyncio.CancelledError))
+            raise
+        self._finish(key, call, result=result)
+        return result
+
+    # Counters since start plus the calls currently in flight
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._calls)}
+
+
+def _resolve(future, call):
+    # The waiting coroutine may have been cancelled meanwhile
+    if future.done():
+        return
+    if call.retry:
+        future.set_result(_RETRY)
+    elif call.error is not None:
+        future.set_exception(call.error)
+    else:
+        future.set_result(call.result)
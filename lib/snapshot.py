@@ -0,0 +1,217 @@
+# Portable index snapshots
+# Documents, vectors and images are written to a Parquet file (vectors as
+# fixed_size_list<float32>, images as raw bytes) with a manifest holding the
+# row count, vector dimensions, the file's sha256 and the index definition.
+# Snapshots load into OpenSearch (_bulk) or a LocalIndex without any
+# Bedrock calls.
+import base64
+import hashlib
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import lib.opensearch as opensearch
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+# Document fields stored as columns; anything else goes to "extra" as JSON
+STRING_FIELDS = ["image_file_name", "text", "image_type", "doc_id", "fingerprint",
+                 "media_type"]
+
+
+def snapshot_schema(dimensions):
+    return pa.schema(
+        [pa.field("id", pa.string(), nullable=False),
+         pa.field("page_number", pa.int32())] +
+        [pa.field(field, pa.string()) for field in STRING_FIELDS] +
+        [pa.field("image", pa.binary()),
+         pa.field("content_vector", pa.list_(pa.float32(), dimensions)),
+         pa.field("extra", pa.string())],
+        metadata={"format_version": str(FORMAT_VERSION)})
+
+
+def manifest_file(snapshot_file):
+    return snapshot_file + ".manifest.json"
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _to_row(doc_id, document, dimensions):
+    vector = document.get("content_vector")
+    if vector is not None and len(vector) != dimensions:
+        raise ValueError(f"Document {doc_id}: vector has {len(vector)} dimensions, "
+                         f"expected {dimensions}")
+    image = document.get("image")
+    extra = {key: value for key, value in document.items()
+             if key not in STRING_FIELDS and key not in
+             ("page_number", "image", "content_vector")}
+    row = {
+        "id": doc_id,
+        "page_number": document.get("page_number"),
+        "image": base64.b64decode(image) if image else None,
+        "content_vector": vector,
+        "extra": json.dumps(extra, ensure_ascii=False) if extra else None,
+    }
+    for field in STRING_FIELDS:
+        row[field] = document.get(field)
+    return row
+
+
+def _vector_rows(column):
+    if column.null_count == 0:
+        dimensions = column.type.list_size
+        return column.flatten().to_numpy().reshape(-1, dimensions).tolist()
+    return column.to_pylist()
+
+
+def _from_batch(batch):
+    columns = {name: batch.column(name) for name in batch.schema.names}
+    vectors = _vector_rows(columns.pop("content_vector"))
+    values = {name: column.to_pylist() for name, column in columns.items()}
+
+    for row, vector in enumerate(vectors):
+        document = {}
+        if values["page_number"][row] is not None:
+            document["page_number"] = values["page_number"][row]
+        for field in STRING_FIELDS:
+            if values[field][row] is not None:
+                document[field] = values[field][row]
+        if values["image"][row] is not None:
+            document["image"] = base64.b64encode(values["image"][row]).decode("utf-8")
+        if vector is not None:
+            document["content_vector"] = vector
+        if values["extra"][row]:
+            document.update(json.loads(values["extra"][row]))
+        yield values["id"][row], document
+
+
+# Write (id, document) pairs to a snapshot file and its manifest
+# Returns the manifest
+def export_snapshot(documents, snapshot_file, dimensions=1024, batch_size=500,
+                    index_definition=None):
+    schema = snapshot_schema(dimensions)
+    rows = 0
+    start = time.perf_counter()
+    with pq.ParquetWriter(snapshot_file, schema) as writer:
+        batch = []
+        for doc_id, document in documents:
+            batch.append(_to_row(doc_id, document, dimensions))
+            if len(batch) >= batch_size:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                rows += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            rows += len(batch)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "rows": rows,
+        "dimensions": dimensions,
+        "sha256": file_sha256(snapshot_file),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "index_definition": index_definition,
+    }
+    with open(manifest_file(snapshot_file), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+
+    logger.info(f"Exported {rows} documents to {snapshot_file} in "
+                f"{time.perf_counter() - start:.1f}s")
+    return manifest
+
+
+# Read and verify the manifest; raises ValueError on a checksum or row mismatch
+def verify_snapshot(snapshot_file):
+    with open(manifest_file(snapshot_file), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format: {manifest['format_version']}")
+
+    sha256 = file_sha256(snapshot_file)
+    if sha256 != manifest["sha256"]:
+        raise ValueError(f"Checksum mismatch for {snapshot_file}: "
+                         f"{sha256} != {manifest['sha256']}")
+    rows = pq.ParquetFile(snapshot_file).metadata.num_rows
+    if rows != manifest["rows"]:
+        raise ValueError(f"Row count mismatch for {snapshot_file}: "
+                         f"{rows} != {manifest['rows']}")
+    return manifest
+
+
+# Yield lists of (id, document) pairs from a snapshot
+def read_snapshot(snapshot_file, batch_size=500):
+    for batch in pq.ParquetFile(snapshot_file).iter_batches(batch_size=batch_size):
+        yield list(_from_batch(batch))
+
+
+# Documents of an OpenSearch index as (id, document) pairs
+def documents_from_opensearch(opensearch_endpoint, index_name, username, password,
+                              batch_size=500):
+    for hit in opensearch.scan_opensearch(opensearch_endpoint, index_name, username,
+                                          password, batch_size=batch_size):
+        yield hit['_id'], hit['_source']
+
+
+# Bulk-load a verified snapshot into OpenSearch
+# - the index is created from the snapshot's definition when missing
+# - refresh is disabled while loading and restored afterwards
+# - concurrency _bulk requests of bulk_size documents are sent in parallel
+# Returns the number of documents indexed
+def load_snapshot_to_opensearch(snapshot_file, opensearch_endpoint, index_name,
+                                username, password, bulk_size=200, concurrency=4):
+    manifest = verify_snapshot(snapshot_file)
+    if manifest.get("index_definition"):
+        opensearch.create_index(opensearch_endpoint, index_name, username, password,
+                                manifest["index_definition"])
+
+    previous_interval = opensearch.set_refresh_interval(
+        opensearch_endpoint, index_name, username, password, "-1")
+    indexed = 0
+    start = time.perf_counter()
+    try:
+        # At most 2 * concurrency batches are read ahead of the bulk requests
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = deque()
+            for documents in read_snapshot(snapshot_file, batch_size=bulk_size):
+                pending.append(executor.submit(
+                    opensearch.bulk_index_opensearch, documents,
+                    opensearch_endpoint, index_name, username, password))
+                if len(pending) >= 2 * concurrency:
+                    indexed += pending.popleft().result()
+            while pending:
+                indexed += pending.popleft().result()
+    finally:
+        opensearch.set_refresh_interval(
+            opensearch_endpoint, index_name, username, password, previous_interval)
+        opensearch.get_http_session().post(
+            f"{opensearch_endpoint}/{index_name}/_refresh", auth=(username, password))
+
+    logger.info(f"Loaded {indexed} of {manifest['rows']} documents into {index_name} in "
+                f"{time.perf_counter() - start:.1f}s")
+    return indexed
+
+
+# Load a verified snapshot into a LocalIndex (a new one if not given)
+def load_snapshot_to_local(snapshot_file, index=None, batch_size=500):
+    manifest = verify_snapshot(snapshot_file)
+    if index is None:
+        from lib.localindex import LocalIndex
+        index = LocalIndex(dimensions=manifest["dimensions"])
+
+    for documents in read_snapshot(snapshot_file, batch_size=batch_size):
+        index.index_many(documents)
+    logger.info(f"Loaded {len(index)} documents into the local index")
+    return index
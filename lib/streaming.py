@@ -0,0 +1,161 @@
+# Helpers for rendering streamed model output
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_ENDINGS = (".", "!", "?", "。", "\n")
+
+
+# Coalesce streamed text deltas and repaint at a bounded frame rate
+# - render : called with the full text accumulated so far
+# - frame_interval : minimum seconds between repaints
+# - sentence boundaries repaint early, after half a frame interval
+# Use the instance as streaming_callback and call flush() when done
+class BufferedRenderer:
+
+    def __init__(self, render, frame_interval=0.1, flush_on_sentence=True,
+                 clock=time.monotonic):
+        self.render = render
+        self.frame_interval = frame_interval
+        self.flush_on_sentence = flush_on_sentence
+        self.clock = clock
+        self.text = ""
+        self.chunk_count = 0
+        self.repaint_count = 0
+        self._painted_length = 0
+        self._last_paint = None
+
+    def __call__(self, chunk):
+        self.text += chunk
+        self.chunk_count += 1
+
+        now = self.clock()
+        if self._last_paint is None:
+            self._repaint(now)
+            return
+
+        elapsed = now - self._last_paint
+        if elapsed >= self.frame_interval:
+            self._repaint(now)
+        elif (self.flush_on_sentence and
+              self.text.rstrip(" ").endswith(SENTENCE_ENDINGS) and
+              elapsed >= self.frame_interval / 2):
+            self._repaint(now)
+
+    # Repaint any pending text
+    def flush(self):
+        if self._painted_length != len(self.text):
+            self._repaint(self.clock())
+        logger.info(f"Streaming render: {self.chunk_count} chunks, {
+                    self.repaint_count} repaints")
+        return self.text
+
+    def _repaint(self, now):
+        self.render(self.text)
+        self.repaint_count += 1
+        self._painted_length = len(self.text)
+        self._last_paint = now
+
+
+# Control tags the answer prompts ask the model for
+CONTROL_TAGS = ("refpage", "debug")
+
+
+# Page numbers listed in a <refpage> body ("1, 2,3"); other tokens are ignored
+def parse_page_list(text):
+    return [int(page.strip()) for page in text.split(",") if page.strip().isdigit()]
+
+
+# Incremental parser for control tags in a streamed answer
+# feed() takes raw text deltas and returns events, as soon as they are known:
+# - ("text", delta) : answer text outside control tags
+# - ("refpage", [page, ...]) : when </refpage> arrives
+# - ("debug", text) : when </debug> arrives
+# Text that could be the start of a tag is held back until the next delta
+# decides it. Each event is also passed to on_event, so the instance can be
+# used as a streaming_callback; call close() when the stream ends (also on
+# errors). `raw` keeps the unparsed answer, tags included.
+class TagStreamParser:
+
+    def __init__(self, on_event=None, tags=CONTROL_TAGS):
+        self.on_event = on_event
+        self.tags = tags
+        self.raw = ""
+        self.text = ""
+        self.refpages = []
+        self._buffer = ""
+        self._tag = None
+
+    def __call__(self, chunk):
+        return self.feed(chunk)
+
+    def feed(self, chunk):
+        self.raw += chunk
+        self._buffer += chunk
+        events = []
+        while self._buffer:
+            if self._tag is not None:
+                closing = f"</{self._tag}>"
+                end = self._buffer.find(closing)
+                if end < 0:
+                    break
+                events.append(self._tag_event(self._tag, self._buffer[:end]))
+                self._buffer = self._buffer[end + len(closing):]
+                self._tag = None
+                continue
+
+            start = self._buffer.find("<")
+            if start < 0:
+                self._add_text(events, self._buffer)
+                self._buffer = ""
+                break
+            self._add_text(events, self._buffer[:start])
+            self._buffer = self._buffer[start:]
+
+            opened = next((tag for tag in self.tags
+                           if self._buffer.startswith(f"<{tag}>")), None)
+            if opened is not None:
+                self._buffer = self._buffer[len(opened) + 2:]
+                self._tag = opened
+            elif any(f"<{tag}>".startswith(self._buffer) for tag in self.tags):
+                # Possibly a tag split across deltas
+                break
+            else:
+                self._add_text(events, "<")
+                self._buffer = self._buffer[1:]
+        return self._emit(events)
+
+    # Flush held-back text; an unclosed tag ends with the stream
+    def close(self):
+        events = []
+        if self._tag is not None:
+            logger.warning(f"Stream ended inside <{self._tag}>")
+            events.append(self._tag_event(self._tag, self._buffer))
+        else:
+            self._add_text(events, self._buffer)
+        self._buffer = ""
+        self._tag = None
+        return self._emit(events)
+
+    def _add_text(self, events, text):
+        if not text:
+            return
+        self.text += text
+        if events and events[-1][0] == "text":
+            events[-1] = ("text", events[-1][1] + text)
+        else:
+            events.append(("text", text))
+
+    def _tag_event(self, tag, body):
+        if tag == "refpage":
+            pages = parse_page_list(body)
+            self.refpages.extend(page for page in pages if page not in self.refpages)
+            return ("refpage", pages)
+        return (tag, body)
+
+    def _emit(self, events):
+        if self.on_event is not None:
+            for event in events:
+                self.on_event(event)
+        return events
@@ -0,0 +1,249 @@
+# Headless query API
+# classify -> retrieve -> streamed answer as server-sent events
+#
+# POST /query  {"query": "..."}  -> text/event-stream
+#   event: querytype  data: {"querytype": "general"}
+#   event: pages      data: {"contents": [...]}
+#   event: delta      data: {"text": "..."}
+#   event: done       data: {"refpages": [1, 2]}
+#   event: error      data: {"message": "..."}
+# GET /health -> {"status": "ok", "active": n, "waiting": n, "single_flight": {...},
+#                 "quota": {...}}
+#
+# Usage: python query_service.py [--port 8000] [--max-concurrency 8]
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+import lib.bedrock as bedrock
+import lib.opensearch as opensearch
+import lib.quota as quota
+from lib.answercache import SemanticAnswerCache, stream_cached_answer
+from lib.logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+# Bedrock + OpenSearch pipeline with clients shared by all requests
+# Methods are blocking and run on the service's thread pool
+class BedrockOpenSearchBackend:
+
+    def __init__(self, max_pool_connections=10, doc_count=3, image_token_budget=6000):
+        self.session = bedrock.get_bedrock_session(
+            os.environ["AWS_ACCESS_KEY_ID"],
+            os.environ["AWS_SECRET_ACCESS_KEY"],
+            os.environ["AWS_REGION"]
+        )
+        bedrock.get_bedrock_client(self.session, max_pool_connections=max_pool_connections)
+        bedrock.set_quota_scheduler(quota.scheduler_from_env())
+        opensearch.get_http_session(pool_maxsize=max_pool_connections)
+        self.model_id = os.environ["BEDROCK_MODEL_ID"]
+        self.opensearch_endpoint = os.environ["OPENSEARCH_ENDPOINT"]
+        self.opensearch_index_name = os.environ["OPENSEARCH_INDEX_NAME"]
+        self.opensearch_username = os.environ["OPENSEARCH_USERNAME"]
+        self.opensearch_password = os.environ["OPENSEARCH_PASSWORD"]
+        self.doc_count = doc_count
+        self.image_token_budget = image_token_budget
+        self.answer_cache = SemanticAnswerCache(
+            similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95")))
+
+    def classify(self, query):
+        return bedrock.classify_request_type(self.session, self.model_id, query)
+
+    # Returns images, contents and retrieval info used as the answer cache key
+    def retrieve(self, query, querytype):
+        query_vector = bedrock.get_text_vector(self.session, query)
+        images, contents, page_ids = opensearch.query_hybrid_to_opensearch(
+            query, querytype, self.doc_count, self.session,
+            self.opensearch_endpoint, self.opensearch_index_name,
+            self.opensearch_username, self.opensearch_password,
+            vector_query=query_vector, with_ids=True)
+        return images, contents, {"query_vector": query_vector, "page_ids": page_ids}
+
+    def answer(self, querytype, query, images, contents, streaming_callback, retrieval=None):
+        if retrieval is not None:
+            self.answer_cache.refresh_generation(lambda: opensearch.get_index_generation(
+                self.opensearch_endpoint, self.opensearch_index_name,
+                self.opensearch_username, self.opensearch_password))
+            cached_answer = self.answer_cache.lookup(
+                retrieval["query_vector"], querytype, retrieval["page_ids"])
+            if cached_answer is not None:
+                return stream_cached_answer(cached_answer, streaming_callback)
+
+        final_response = bedrock.query_bedrock_with_images_and_text_with_streaming(
+            self.session, self.model_id, querytype, query, images, contents,
+            streaming_callback=streaming_callback,
+            image_token_budget=self.image_token_budget)
+
+        if retrieval is not None:
+            self.answer_cache.store(
+                retrieval["query_vector"], querytype, retrieval["page_ids"], final_response)
+        return final_response
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def parse_refpages(text):
+    return [int(page.strip())
+            for pages in re.findall(r'<refpage>(.*?)</refpage>', text)
+            for page in pages.split(',') if page.strip().isdigit()]
+
+
+# - max_concurrency : pipelines running at once (also the thread pool size)
+# - max_waiting : requests allowed to queue for a slot before returning 429
+def create_app(backend, max_concurrency=8, max_waiting=32):
+    app = web.Application()
+    app["backend"] = backend
+    app["semaphore"] = asyncio.Semaphore(max_concurrency)
+    app["executor"] = ThreadPoolExecutor(max_workers=max_concurrency,
+                                         thread_name_prefix="query")
+    app["max_waiting"] = max_waiting
+    app["stats"] = {"active": 0, "waiting": 0, "served": 0, "rejected": 0}
+
+    async def close_executor(app):
+        app["executor"].shutdown(wait=False)
+
+    app.on_cleanup.append(close_executor)
+    app.router.add_post("/query", handle_query)
+    app.router.add_get("/health", handle_health)
+    return app
+
+
+async def handle_health(request):
+    health = {"status": "ok", **request.app["stats"],
+              "single_flight": bedrock.single_flight_stats()}
+    scheduler = bedrock.get_quota_scheduler()
+    if scheduler is not None:
+        health["quota"] = await asyncio.get_running_loop().run_in_executor(
+            request.app["executor"], scheduler.stats)
+    return web.json_response(health)
+
+
+async def handle_query(request):
+    app = request.app
+    stats = app["stats"]
+
+    try:
+        body = await request.json()
+        query = body["query"]
+    except (ValueError, KeyError):
+        return web.json_response({"error": "body must be JSON with a 'query' field"},
+                                 status=400)
+
+    if stats["waiting"] >= app["max_waiting"]:
+        stats["rejected"] += 1
+        return web.json_response({"error": "too many requests"}, status=429)
+
+    stats["waiting"] += 1
+    try:
+        await app["semaphore"].acquire()
+    finally:
+        stats["waiting"] -= 1
+
+    stats["active"] += 1
+    try:
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+        })
+        await response.prepare(request)
+        await run_pipeline(app, query, response)
+        try:
+            await response.write_eof()
+        except Exception as e:
+            logger.info(f"Could not finish response, client gone: {e}")
+        stats["served"] += 1
+        return response
+    finally:
+        stats["active"] -= 1
+        app["semaphore"].release()
+
+
+# Raised in the streaming callback to stop generating for a gone client
+class ClientDisconnected(Exception):
+    pass
+
+
+# Executor work is always waited for before returning, so the caller's
+# concurrency slot is held until the worker thread is free again
+async def run_pipeline(app, query, response):
+    backend = app["backend"]
+    executor = app["executor"]
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    pending = []
+
+    def run_blocking(fn, *args):
+        future = loop.run_in_executor(executor, fn, *args)
+        pending.append(future)
+        return future
+
+    try:
+        querytype = await run_blocking(backend.classify, query)
+        await response.write(format_event("querytype", {"querytype": querytype}))
+
+        images, contents, retrieval = await run_blocking(backend.retrieve, query, querytype)
+        await response.write(format_event("pages", {"contents": contents}))
+
+        # Bridge the blocking streaming callback to the event loop
+        deltas = asyncio.Queue()
+
+        def streaming_callback(chunk):
+            if cancelled.is_set():
+                raise ClientDisconnected()
+            loop.call_soon_threadsafe(deltas.put_nowait, chunk)
+
+        answer = run_blocking(backend.answer, querytype, query, images, contents,
+                              streaming_callback, retrieval)
+        answer.add_done_callback(lambda future: deltas.put_nowait(None))
+
+        while (chunk := await deltas.get()) is not None:
+            await response.write(format_event("delta", {"text": chunk}))
+
+        final_response = await answer
+        await response.write(format_event("done", {"refpages": parse_refpages(final_response)}))
+    except Exception as e:
+        logger.error(f"Query failed: {e}")
+        try:
+            await response.write(format_event("error", {"message": str(e)}))
+        except Exception as write_error:
+            logger.info(f"Could not send error event, client gone: {write_error}")
+    finally:
+        cancelled.set()
+        for future in pending:
+            if not future.done():
+                try:
+                    await asyncio.shield(future)
+                except BaseException:
+                    pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Multimodal PDF search query API")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--max-waiting", type=int, default=32)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    load_dotenv(override=True)
+    setup_logging()
+
+    backend = BedrockOpenSearchBackend(
+        max_pool_connections=args.max_concurrency,
+        image_token_budget=int(os.getenv("IMAGE_TOKEN_BUDGET", "6000")))
+    web.run_app(create_app(backend, args.max_concurrency, args.max_waiting),
+                host=args.host, port=args.port)
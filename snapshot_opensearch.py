@@ -0,0 +1,90 @@
+# Export the OpenSearch index to a portable snapshot, or load a snapshot
+# into OpenSearch without re-captioning or re-embedding; verify checks a
+# snapshot, with --local also by loading it into a temporary local index
+#
+# Usage:
+#   python snapshot_opensearch.py export snapshots/index.parquet
+#   python snapshot_opensearch.py import snapshots/index.parquet [--index NAME]
+#   python snapshot_opensearch.py verify snapshots/index.parquet [--local]
+import argparse
+import logging
+import os
+
+from dotenv import load_dotenv
+
+import lib.opensearch as opensearch
+import lib.snapshot as snapshot
+from lib.logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def opensearch_args(index_name=None):
+    return (os.getenv("OPENSEARCH_ENDPOINT"), index_name or os.getenv("OPENSEARCH_INDEX_NAME"),
+            os.getenv("OPENSEARCH_USERNAME"), os.getenv("OPENSEARCH_PASSWORD"))
+
+
+def export_index(snapshot_file, dimensions, batch_size):
+    snapshot_dir = os.path.dirname(snapshot_file)
+    if snapshot_dir and not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    definition = opensearch.get_index_definition(*opensearch_args())
+    return snapshot.export_snapshot(
+        snapshot.documents_from_opensearch(*opensearch_args(), batch_size=batch_size),
+        snapshot_file, dimensions=dimensions, batch_size=batch_size,
+        index_definition=definition)
+
+
+def import_index(snapshot_file, index_name, bulk_size, concurrency):
+    return snapshot.load_snapshot_to_opensearch(
+        snapshot_file, *opensearch_args(index_name),
+        bulk_size=bulk_size, concurrency=concurrency)
+
+
+# Round-trip check: decode every row into a throwaway local index and compare
+# the count with the manifest (duplicate ids collapse). The index is returned
+# for callers that want to query it; nothing is persisted.
+def verify_local(snapshot_file, manifest):
+    index = snapshot.load_snapshot_to_local(snapshot_file)
+    if len(index) != manifest["rows"]:
+        raise ValueError(f"Local load of {snapshot_file} has {len(index)} documents, "
+                         f"manifest lists {manifest['rows']}")
+    logger.info(f"Local round trip OK: {len(index)} documents")
+    return index
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Index snapshot export / import")
+    parser.add_argument("command", choices=["export", "import", "verify"])
+    parser.add_argument("snapshot_file")
+    parser.add_argument("--index", help="target index for import "
+                        "(default: OPENSEARCH_INDEX_NAME)")
+    parser.add_argument("--dimensions", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="documents per scroll page / Parquet row group")
+    parser.add_argument("--bulk-size", type=int, default=200,
+                        help="documents per _bulk request")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="parallel _bulk requests")
+    parser.add_argument("--local", action="store_true",
+                        help="with verify, also load every document into a temporary "
+                        "in-memory index as a round-trip check (nothing is persisted)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    load_dotenv(override=True)
+    setup_logging()
+
+    if args.command == "export":
+        export_index(args.snapshot_file, args.dimensions, args.batch_size)
+    elif args.command == "import":
+        import_index(args.snapshot_file, args.index, args.bulk_size, args.concurrency)
+    else:
+        manifest = snapshot.verify_snapshot(args.snapshot_file)
+        logger.info(f"Snapshot OK: {manifest['rows']} documents, "
+                    f"{manifest['dimensions']} dimensions, created {manifest['created']}")
+        if args.local:
+            verify_local(args.snapshot_file, manifest)
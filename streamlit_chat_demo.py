@@ -1,13 +1,14 @@
 import os
-from io import BytesIO
-import base64
-import re
 import streamlit as st  # type: ignore
 from dotenv import load_dotenv  # type: ignore
 import logging
 
 import lib.bedrock as bedrock
 import lib.opensearch as opensearch
+import lib.quota as quota
+from lib.streaming import BufferedRenderer, TagStreamParser
+from lib.conversation import ConversationContext, strip_answer_tags
+from lib.answercache import SemanticAnswerCache, stream_cached_answer
 from lib.logging_config import setup_logging
 
 
@@ -27,6 +28,8 @@ if 'contents' not in st.session_state:
     st.session_state.contents = []
 if 'valid_pages' not in st.session_state:
     st.session_state.valid_pages = []
+if 'conversation' not in st.session_state:
+    st.session_state.conversation = ConversationContext()
 if 'bedrock_session' not in st.session_state:
     st.session_state.bedrock_session = None
 
@@ -41,19 +44,51 @@ def add_debug_log(message):
     st.session_state.debug_log.append(message)
 
 
-# Create a Bedrock session if it doesn't exist
-if st.session_state.bedrock_session is None:
+# Vision-token budget for the page images sent with each answer (.env is
+# loaded first so its value applies on a fresh start)
+load_dotenv(override=True)
+IMAGE_TOKEN_BUDGET = int(os.getenv("IMAGE_TOKEN_BUDGET", "6000"))
+
+
+# Bedrock session and OpenSearch HTTP pool are shared by all browser sessions
+@st.cache_resource
+def get_shared_bedrock_session():
     load_dotenv(override=True)
-    st.session_state.bedrock_session = bedrock.get_bedrock_session(
-        os.environ["AWS_ACCESS_KEY_ID"],
-        os.environ["AWS_SECRET_ACCESS_KEY"],
-        os.environ["AWS_REGION"]
-    )
-    st.session_state.bedrock_sonnet35_session = bedrock.get_bedrock_session(
+    return bedrock.get_bedrock_session(
         os.environ["AWS_ACCESS_KEY_ID"],
         os.environ["AWS_SECRET_ACCESS_KEY"],
         os.environ["AWS_REGION"]
     )
+
+
+@st.cache_resource
+def get_shared_opensearch_http_session():
+    return opensearch.get_http_session()
+
+
+# Semantic answer cache shared by all browser sessions
+@st.cache_resource
+def get_shared_answer_cache():
+    return SemanticAnswerCache(
+        similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95")))
+
+
+# Bedrock quota shared with ingestion processes (None if not configured)
+@st.cache_resource
+def get_shared_quota_scheduler():
+    load_dotenv(override=True)
+    scheduler = quota.scheduler_from_env()
+    bedrock.set_quota_scheduler(scheduler)
+    return scheduler
+
+
+# Attach the shared clients to this session if it doesn't have them yet
+if st.session_state.bedrock_session is None:
+    load_dotenv(override=True)
+    st.session_state.bedrock_session = get_shared_bedrock_session()
+    st.session_state.bedrock_sonnet35_session = st.session_state.bedrock_session
+    get_shared_opensearch_http_session()
+    get_shared_quota_scheduler()
     st.session_state.bedrock_modelid = os.environ["BEDROCK_MODEL_ID"]
     st.session_state.bedrock_sonnet35_modelid = os.environ["BEDROCK_MODEL_ID"]
     st.session_state.opensearch_endpoint = os.environ["OPENSEARCH_ENDPOINT"]
@@ -61,17 +96,34 @@ if st.session_state.bedrock_session is None:
     st.session_state.opensearch_username = os.environ["OPENSEARCH_USERNAME"]
     st.session_state.opensearch_password = os.environ["OPENSEARCH_PASSWORD"]
 
+
+# Retrieved page images the answer refers to (<refpage>), in retrieval order
+def show_related_images(placeholder):
+    with placeholder.container():
+        for i, (image, content) in enumerate(zip(st.session_state.images, st.session_state.contents)):
+            if i + 1 in st.session_state.valid_pages:
+                st.image(image, caption=content, use_column_width=True)
+                st.markdown("___")
+
+
 # Title
 st.title("Multimodal PDF Search")
 
 # Layout: Create two columns
 col1, col2 = st.columns([5, 5])
 
+# Created before the answer streams so referenced images show up as soon as
+# their <refpage> tag closes
+with col2:
+    st.subheader("Related Images")
+    related_images = st.empty()
+
 with col1:
-    # Display chat messages
+    # Display chat messages (answers are kept raw, shown without control tags)
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+            st.markdown(strip_answer_tags(message["content"])
+                        if message["role"] == "assistant" else message["content"])
 
     # User input
     if user_query := st.chat_input("무엇을 도와드릴까요?"):
@@ -85,11 +137,18 @@ with col1:
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
             st.session_state.full_response = ""
+            renderer = answer_tags = None
 
             try:
-                # Perform OpenSearch query only for the first question
-                querytype = "general"
-                if len(st.session_state.messages) == 1:
+                conversation = st.session_state.conversation
+
+                # Retrieve pages on the first question or when the topic drifts
+                query_vector = bedrock.get_text_vector(
+                    st.session_state.bedrock_session, user_query)
+                # Follow-ups keep the type classified at retrieval time
+                querytype = conversation.querytype or "general"
+                page_ids = None
+                if conversation.needs_retrieval(query_vector):
 
                     # Classify request type
                     # Rerouting user query to the appropriate handler
@@ -98,66 +157,117 @@ with col1:
                         st.session_state.bedrock_modelid,
                         user_query)
 
-                    st.session_state.images, st.session_state.contents = opensearch.query_imagesearch_to_opensearch(
+                    st.session_state.images, st.session_state.contents, page_ids = opensearch.query_hybrid_to_opensearch(
                         user_query,
                         querytype,
-                        5,
+                        3,
                         st.session_state.bedrock_session,
                         st.session_state.opensearch_endpoint,
                         st.session_state.opensearch_index_name,
                         st.session_state.opensearch_username,
-                        st.session_state.opensearch_password
+                        st.session_state.opensearch_password,
+                        vector_query=query_vector,
+                        with_ids=True
                     )
+                    conversation.set_retrieval(
+                        user_query, querytype, query_vector,
+                        st.session_state.images, st.session_state.contents)
 
                     add_debug_log("Contents:")
                     for i, content in enumerate(st.session_state.contents, 1):
                         add_debug_log(f"  {i}. {content}")
+                else:
+                    add_debug_log("Follow-up: reusing retrieved pages")
                 # Execute Sonnet query streaming
 
-                def streaming_callback(chunk):
-                    st.session_state.full_response += chunk
-                    message_placeholder.markdown(
-                        st.session_state.full_response + " ")
+                # Coalesce streamed deltas and repaint at a bounded frame rate
+                renderer = BufferedRenderer(
+                    lambda text: message_placeholder.markdown(text + " "))
+
+                # Control tags are parsed as they stream: answer text goes to
+                # the renderer, referenced pages to the image panel
+                st.session_state.valid_pages = []
+
+                def on_answer_event(event):
+                    kind, value = event
+                    if kind == "text":
+                        renderer(value)
+                    elif kind == "refpage":
+                        new_pages = [page for page in value
+                                     if page not in st.session_state.valid_pages]
+                        if new_pages:
+                            st.session_state.valid_pages += new_pages
+                            show_related_images(related_images)
+                    elif kind == "debug":
+                        add_debug_log(f"Model debug: {value}")
 
                 add_debug_log(f"length of contents: {
                               len(st.session_state.contents)}")
 
-                final_response = bedrock.query_bedrock_with_images_and_text_with_streaming(
-                    st.session_state.bedrock_sonnet35_session,
-                    st.session_state.bedrock_sonnet35_modelid,
-                    querytype,
-                    user_query,
-                    [BytesIO(base64.b64decode(image))
-                     for image in st.session_state.images],
-                    st.session_state.contents,
-                    streaming_callback=streaming_callback
-                )
-
-                message_placeholder.markdown(st.session_state.full_response)
-
-                # Update valid pages
-                st.session_state.valid_pages = [
-                    int(page.strip())
-                    for pages in re.findall(r'<refpage>(.*?)</refpage>', st.session_state.full_response)
-                    for page in pages.split(',')
-                ]
+                # Answers for freshly retrieved pages can be served from the
+                # semantic cache; answers shaped by earlier turns (follow-ups,
+                # and re-retrievals after a topic drift) are neither served
+                # nor stored
+                history = conversation.history_messages()
+                use_answer_cache = page_ids is not None and not history
+                answer_cache = get_shared_answer_cache()
+                cached_answer = None
+                if use_answer_cache:
+                    answer_cache.refresh_generation(lambda: opensearch.get_index_generation(
+                        st.session_state.opensearch_endpoint,
+                        st.session_state.opensearch_index_name,
+                        st.session_state.opensearch_username,
+                        st.session_state.opensearch_password))
+                    cached_answer = answer_cache.lookup(query_vector, querytype, page_ids)
+
+                # Raw deltas go through the tag parser; it is closed even if
+                # the stream fails so held-back text still reaches the renderer
+                answer_tags = TagStreamParser(on_answer_event)
+                try:
+                    if cached_answer is not None:
+                        add_debug_log("Answer served from semantic cache")
+                        stream_cached_answer(cached_answer, answer_tags)
+                    else:
+                        bedrock.query_bedrock_with_images_and_text_with_streaming(
+                            st.session_state.bedrock_sonnet35_session,
+                            st.session_state.bedrock_sonnet35_modelid,
+                            querytype,
+                            user_query,
+                            st.session_state.images,
+                            conversation.page_texts() if not conversation.use_images()
+                            else st.session_state.contents,
+                            streaming_callback=answer_tags,
+                            image_token_budget=IMAGE_TOKEN_BUDGET,
+                            history=history,
+                            use_images=conversation.use_images()
+                        )
+                        if use_answer_cache:
+                            answer_cache.store(query_vector, querytype, page_ids, answer_tags.raw)
+                finally:
+                    answer_tags.close()
+
+                conversation.add_turn(user_query, answer_tags.raw)
+                add_debug_log(f"Streaming repaints: {renderer.repaint_count} for {
+                              renderer.chunk_count} chunks")
 
             except Exception as e:
                 st.error(f"Error during query: {str(e)}")
 
+            finally:
+                # Keep what was streamed, also when the answer failed midway;
+                # history and messages keep the raw answer, the display is
+                # stripped of control tags
+                if answer_tags is not None:
+                    st.session_state.full_response = answer_tags.raw
+                if renderer is not None:
+                    message_placeholder.markdown(renderer.flush())
+
             # Add AI message
             st.session_state.messages.append(
                 {"role": "assistant", "content": st.session_state.full_response})
 
-with col2:
-    # Display images (within a scrollable container)
-    with st.container():
-        st.subheader("Related Images")
-        for i, (image, content) in enumerate(zip(st.session_state.images, st.session_state.contents)):
-            if i + 1 in st.session_state.valid_pages:
-                image = BytesIO(base64.b64decode(image))
-                st.image(image, caption=content, use_column_width=True)
-                st.markdown("___")
+# Display images (also on reruns without a new question)
+show_related_images(related_images)
 
 # At the end of your script, outside of any columns:
 st.markdown("## Debug Logs")